@@ -531,7 +531,7 @@ class BaseTrainer(object):
     def _get_total_loss(self):
         r"""Return the total loss to be backpropagated.
         """
-        total_loss = torch.tensor(0., device=torch.device('cuda'))
+        total_loss = torch.zeros((), device=torch.device('cuda'))  # Avoid a blocking host-to-device copy.
         # Iterates over all possible losses.
         for loss_name in self.weights:
             if loss_name in self.losses:
@@ -674,10 +674,11 @@ class Checkpointer(object):
             raise FileNotFoundError(f'File not found (local): {checkpoint_path}')
 
     def reached_checkpointing_period(self, timer):
-        save_now = torch.cuda.BoolTensor([False])
+        # Decide on the host (a device tensor here would force a synchronization every iteration).
+        save_now = False
         if is_master():
             if timer.checkpoint_toc() > self.save_period:
-                save_now.fill_(True)
+                save_now = True
         if save_now:
             if is_master():
                 print('checkpointing period!')
@@ -10,6 +10,7 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 -----------------------------------------------------------------------------
 '''
 
+import numpy as np
 import torch
 import tqdm
 import threading
@@ -21,6 +22,7 @@ class Dataset(torch.utils.data.Dataset):
     def __init__(self, cfg, is_inference=False, is_test=False):
         super().__init__()
         self.split = "test" if is_test else "val" if is_inference else "train"
+        self.generator = None
 
     def _preload_worker(self, data_list, load_func, q, lock, idx_tqdm):
         # Keep preloading data in parallel.
@@ -48,6 +50,44 @@ class Dataset(torch.utils.data.Dataset):
         assert all(map(lambda x: x is not None, data_list))
         return data_list
 
+    def resize_image(self, image):
+        """Resize a PIL image to the dataset resolution and convert it to a uint8 tensor.
+        Args:
+            image (PIL.Image): The raw image.
+        Returns:
+            image (tensor [H,W,C]): The resized image (uint8).
+        """
+        image = image.resize((self.W, self.H))
+        image = torch.from_numpy(np.atleast_3d(np.array(image)))  # [H,W,C]
+        return image
+
+    def build_image_cache(self, images, shared_memory=False):
+        """Stack the preloaded (already resized) images into a single contiguous uint8 tensor, so that decoding and
+        resizing only happen once and __getitem__ only needs to index/gather pixels.
+        Args:
+            images (list of tensors [H,W,C]): The resized uint8 images.
+            shared_memory (bool): Move the cache to shared memory so that the data loader workers do not copy it.
+        Returns:
+            images (tensor [N,H,W,C]): The image cache.
+        """
+        images = torch.stack(images, dim=0)  # [N,H,W,C]
+        if shared_memory:
+            images.share_memory_()
+        return images
+
+    def get_generator(self):
+        """Get the random generator of the current process (for sampling e.g. ray indices in __getitem__).
+        The data loader seeds each worker with base_seed + worker_id (with base_seed drawn from the seeded main
+        process), so every worker has its own reproducible stream. The generator is re-created if the process seed
+        changes (e.g. when the dataset is copied to the workers).
+        Returns:
+            generator (torch.Generator): The random generator.
+        """
+        seed = torch.initial_seed()
+        if self.generator is None or self.generator.initial_seed() != seed:
+            self.generator = torch.Generator().manual_seed(seed)
+        return self.generator
+
     def __getitem__(self, idx):
         raise NotImplementedError
 
@@ -13,7 +13,6 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 import json
 import numpy as np
 import torch
-import torchvision.transforms.functional as torchvision_F
 from PIL import Image, ImageFile
 
 from projects.nerf.datasets import base
@@ -43,7 +42,8 @@ class Dataset(base.Dataset):
             self.list = self.list[:data_info.subset]
         # Preload dataset if possible.
         if cfg_data.preload:
-            self.images = self.preload_threading(self.get_image, cfg_data.num_workers)
+            images = self.preload_threading(self.get_image_resized, cfg_data.num_workers)
+            self.images = self.build_image_cache(images, shared_memory=getattr(cfg_data, "shared_memory", False))
             self.cameras = self.preload_threading(self.get_camera, cfg_data.num_workers, data_str="cameras")
 
     def __getitem__(self, idx):
@@ -59,8 +59,8 @@ class Dataset(base.Dataset):
         """
         # Keep track of sample index for convenience.
         sample = dict(idx=idx)
-        # Get the images.
-        image = self.images[idx] if self.preload else self.get_image(idx)
+        # Get the (resized, uint8) images.
+        image = self.images[idx] if self.preload else self.get_image_resized(idx)  # [H,W,C]
         image = self.preprocess_image(image)
         # Get the cameras (intrinsics and pose).
         intr, pose = self.cameras[idx] if self.preload else self.get_camera(idx)
@@ -80,10 +80,12 @@ class Dataset(base.Dataset):
         image.load()
         return image
 
+    def get_image_resized(self, idx):
+        return self.resize_image(self.get_image(idx))  # [H,W,C]
+
     def preprocess_image(self, image):
-        # Resize the image.
-        image = image.resize((self.W, self.H))
-        image = torchvision_F.to_tensor(image)
+        # Convert the uint8 pixels to [0,1].
+        image = image.permute(2, 0, 1).float() / 255  # [C,H,W]
         # Background masking.
         rgb, mask = image[:3], image[3:]
         if self.bgcolor is not None:
@@ -63,7 +63,8 @@ class Model(BaseModel):
     def _sample_random_rays(self, data):
         batch_size = len(data["pose"])
         num_pixels = self.image_size[0] * self.image_size[1]
-        ray_idx = torch.rand(batch_size, num_pixels, device=data["pose"].device).argsort(dim=1)[:, :self.num_rays]
+        ray_idx = nerf_util.sample_unique_indices(num_pixels, self.num_rays, batch_size=batch_size,
+                                                  device=data["pose"].device)
         return ray_idx  # [B,R]
 
     @torch.no_grad()
@@ -112,9 +113,7 @@ class Model(BaseModel):
         return output
 
     def render_pixels(self, pose, intr, full_image=False, ray_idx=None, stratified=False, density_reg=None):
-        center, ray = camera.get_center_and_ray(pose, intr, self.image_size)  # [B,HW,3]
-        center = nerf_util.slice_by_ray_idx(center, ray_idx)  # [B,R,3]
-        ray = nerf_util.slice_by_ray_idx(ray, ray_idx)  # [B,R,3]
+        center, ray = camera.get_center_and_ray_by_idx(pose, intr, self.image_size, ray_idx)  # [B,R,3]
         ray_unit = torch_F.normalize(ray, dim=-1)  # [B,R,3]
         output = self.render_rays(center, ray_unit, stratified=stratified, density_reg=density_reg)
         return output
@@ -17,7 +17,7 @@ from imaginaire.utils.distributed import is_master, master_only
 from imaginaire.utils.misc import to_cuda, requires_grad, to_cpu
 from tqdm import tqdm
 
-from projects.nerf.utils.misc import collate_test_data_batches, get_unique_test_data, trim_test_samples
+from projects.nerf.utils.misc import collate_test_data_batches, get_unique_test_data, trim_test_samples, SyncCounter
 
 
 class BaseTrainer(BaseTrainer):
@@ -33,17 +33,32 @@ class BaseTrainer(BaseTrainer):
         cfg.setdefault("wandb_image_iter", 9999999999999)
         cfg.setdefault("validation_epoch", 9999999999999)
         cfg.setdefault("validation_iter", 9999999999999)
+        # Sync-free mode: accumulate the losses/metrics on the device and only read them at the logging iterations.
+        cfg.trainer.setdefault("sync_free", False)
+        cfg.trainer.setdefault("count_syncs", False)
+        self.scalar_sums = dict(losses=dict(), metrics=dict())
+        self.sync_counter = SyncCounter() if cfg.trainer.count_syncs else None
+        self.syncs_per_step = None
 
     def init_losses(self, cfg):
         super().init_losses(cfg)
         self.weights = {key: value for key, value in cfg.trainer.loss_weight.items() if value}
 
     def _end_of_iteration(self, data, current_epoch, current_iteration):
+        if self.cfg.trainer.sync_free:
+            self._accumulate_scalars()
         # Log to wandb.
         if current_iteration % self.cfg.wandb_scalar_iter == 0:
             # Compute the elapsed time (as in the original base trainer).
             self.timer.time_iteration = self.elapsed_iteration_time / self.cfg.wandb_scalar_iter
             self.elapsed_iteration_time = 0
+            if self.cfg.trainer.sync_free:
+                # Log the averages over the logging period (NaN/inf in any iteration propagates to the averages).
+                self._average_scalars()
+            if self.sync_counter is not None:
+                self.sync_counter.stop()
+                self.syncs_per_step = self.sync_counter.reset() / self.cfg.wandb_scalar_iter
+                self.sync_counter.start()
             # Log scalars.
             self.log_wandb_scalars(data, mode="train")
             # Exit if the training loss has gone to NaN/inf.
@@ -72,6 +87,31 @@ class BaseTrainer(BaseTrainer):
                 self.log_wandb_scalars(data_all, mode="val")
                 self.log_wandb_images(data_all, mode="val", max_samples=self.cfg.data.val.max_viz_samples)
 
+    def _accumulate_scalars(self):
+        # Keep running sums of the losses and metrics on the device.
+        for name, scalars in [("losses", self.losses), ("metrics", self.metrics)]:
+            sums = self.scalar_sums[name]
+            for key, value in scalars.items():
+                sums[key] = sums[key] + value.detach() if key in sums else value.detach().clone()
+        self.scalar_sums.setdefault("count", 0)
+        self.scalar_sums["count"] += 1
+
+    def _average_scalars(self):
+        # Replace the losses and metrics with their averages since the last logging iteration.
+        count = self.scalar_sums.pop("count", 0)
+        if count == 0:
+            return
+        for name, scalars in [("losses", self.losses), ("metrics", self.metrics)]:
+            sums = self.scalar_sums[name]
+            scalars.update({key: value / count for key, value in sums.items()})
+            sums.clear()
+
+    def train_step(self, data, last_iter_in_epoch=False):
+        # Count the synchronizations from the first training step on (excluding validation).
+        if self.sync_counter is not None:
+            self.sync_counter.start()
+        super().train_step(data, last_iter_in_epoch=last_iter_in_epoch)
+
     @master_only
     def log_wandb_scalars(self, data, mode=None):
         scalars = dict()
@@ -80,6 +120,8 @@ class BaseTrainer(BaseTrainer):
             scalars.update({"optim/lr": self.sched.get_last_lr()[0]})
             scalars.update({"time/iteration": self.timer.time_iteration})
             scalars.update({"time/epoch": self.timer.time_epoch})
+            if self.syncs_per_step is not None:
+                scalars.update({"time/syncs_per_step": self.syncs_per_step})
         scalars.update({f"{mode}/loss/{key}": value for key, value in self.losses.items()})
         scalars.update(iteration=self.current_iteration, epoch=self.current_epoch)
         wandb.log(scalars, step=self.current_iteration)
@@ -126,6 +168,8 @@ class BaseTrainer(BaseTrainer):
         Returns:
             data_all: A dictionary of all the data.
         """
+        if self.sync_counter is not None:
+            self.sync_counter.stop()
         if self.cfg.trainer.ema_config.enabled:
             model = self.model.module.averaged_model
         else:
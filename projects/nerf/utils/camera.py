@@ -310,57 +310,59 @@ def get_center_and_ray(pose, intr, image_size):
     ray = grid_3D - center_3D  # [B,HW,3]
     return center_3D, ray
 
-def get_center_and_ray_supersampled(pose, intr, image_size, indices, num_samples=1):
+
+def get_center_and_ray_by_idx(pose, intr, image_size, ray_idx, offsets=None):
+    """Same as get_center_and_ray(), but only unprojects the pixels indexed by ray_idx (instead of the full image).
+    Args:
+        pose (tensor [3,4]/[B,3,4]): Camera pose.
+        intr (tensor [3,3]/[B,3,3]): Camera intrinsics.
+        image_size (list of int): Image size.
+        ray_idx (tensor [R]/[B,R]): Indices of the pixels (in the flattened [HW] image).
+        offsets (tensor [R,2]/[B,R,2]): Optional sub-pixel (x,y) offsets from the pixel centers.
+    Returns:
+        center_3D (tensor [R,3]/[B,R,3]): Center of the camera.
+        ray (tensor [R,3]/[B,R,3]): Ray of the camera with depth=1 (note: not unit ray).
     """
-    see above
+    H, W = image_size
+    with torch.no_grad():
+        # Compute the image coordinates of the indexed pixels.
+        y_idx = torch.div(ray_idx, W, rounding_mode="floor")
+        x_idx = ray_idx - y_idx * W
+        xy_grid = torch.stack([x_idx, y_idx], dim=-1).float().add_(0.5)  # [R,2]/[B,R,2]
+    if offsets is not None:
+        xy_grid = xy_grid + offsets
+    grid_3D = img2cam(to_hom(xy_grid), intr)  # [R,3]/[B,R,3]
+    center_3D = torch.zeros_like(grid_3D)  # [R,3]/[B,R,3]
+    # Transform from camera to world coordinates.
+    grid_3D = cam2world(grid_3D, pose)  # [R,3]/[B,R,3]
+    center_3D = cam2world(center_3D, pose)  # [R,3]/[B,R,3]
+    ray = grid_3D - center_3D  # [R,3]/[B,R,3]
+    return center_3D, ray
+
+
+def get_center_and_ray_supersampled(pose, intr, image_size, indices, num_samples=1):
+    """Get the centers and rays of randomly jittered samples within the indexed pixels (for supersampling).
+    Args:
+        pose (tensor [B,3,4]): Camera pose.
+        intr (tensor [B,3,3]): Camera intrinsics.
+        image_size (list of int): Image size.
+        indices (tensor [B,R]): Indices of the pixels to supersample.
+        num_samples (int): Number of samples per pixel.
+    Returns:
+        centers (tensor [B,R,3]): Center of the camera.
+        rays (tensor [B,R,3]): Ray of the camera with depth=1 (note: not unit ray).
 
     TO DO
     Proper quater based jittering.
 
     Ensure atleast 2 samples per pixel or something?
-
     """
-    H, W = image_size
-    with torch.no_grad():
-        #image coord grid
-        y_range = torch.arange(H, dtype=torch.float32, device=pose.device).add_(0.5)
-        x_range = torch.arange(W, dtype=torch.float32, device=pose.device).add_(0.5)
-        Y, X = torch.meshgrid(y_range, x_range, indexing="ij") # [H,W]
-        xy_grid = torch.stack([X, Y], dim=-1).view(-1, 2)
-     
-    #print(xy_grid) 
-   # print(xy_grid)
-    #print(xy_grid.shape)
-    ss_pixel_centers = xy_grid[indices]
-    #print(ss_pixel_centers.shape)
-    #print(xy_grid[indices].shape)
-    #exit(-1)
-    #print(ss_pixel_centers)
-    random_offsets = torch.rand(indices.shape[1], 2, device=pose.device) - 0.5
-    #print(random_offsets)
-    #print(ss_pixel_centers)
-    
-    ss = ss_pixel_centers + random_offsets 
-   # print(ss)
-   # print(ss.shape)
-   # exit(-1)
-    # if len(pose.shape) == 3:
-    #    batch_size = len(pose)
-    #    xy_grid = xy_grid.repeat(batch_size, 1, 1) #[B, HW, 2]
-    
-   # xy_grid = torch.cat([xy_grid, ss], dim=1) #[B, HW + N, 2]
-    #print(xy_grid.shape)
-    grid_3D = img2cam(to_hom(ss), intr) # [B, HW, 3]
-    # Transform from camera to world coordinates
-    centers = cam2world(torch.zeros_like(grid_3D), pose).repeat(num_samples, 1, 1) #[B*HW, 3]
-    rays = cam2world(grid_3D, pose) - centers 
-    #print(rays.shape)
-    # exit(-1)
-   
+    random_offsets = torch.rand(indices.shape[1], 2, device=pose.device) - 0.5  # [R,2]
+    centers, rays = get_center_and_ray_by_idx(pose, intr, image_size, indices, offsets=random_offsets)  # [B,R,3]
+    centers = centers.repeat(num_samples, 1, 1)
     return centers, rays
 
 
-
 def get_3D_points_from_dist(center, ray_unit, dist, multi=True):
     # Two possible use cases: (1) center + ray_unit * dist, or (2) center + ray * depth
     if multi:
@@ -11,6 +11,7 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 '''
 
 import torch
+import warnings
 
 from imaginaire.utils.distributed import dist_all_gather_tensor
 
@@ -69,3 +70,42 @@ def trim_test_samples(data, max_samples=None):
                 data[key] = value[:max_samples]
         else:
             raise TypeError
+
+
+class SyncCounter(object):
+
+    def __init__(self):
+        """Count the host-device synchronizations with the CUDA sync debug mode, which issues a warning for each
+        synchronizing CUDA operation (e.g. .item(), evaluating a device tensor in Python, blocking copies).
+        The other warnings raised while counting are re-emitted.
+        """
+        self.enabled = torch.cuda.is_available()
+        self.count = 0
+        self._catcher = None
+        self._records = None
+
+    def start(self):
+        if not self.enabled or self._catcher is not None:
+            return
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
+
+    def stop(self):
+        if self._catcher is None:
+            return
+        torch.cuda.set_sync_debug_mode("default")
+        self._catcher.__exit__(None, None, None)
+        for record in self._records:
+            if "synchronizing CUDA operation" in str(record.message):
+                self.count += 1
+            else:
+                warnings.showwarning(record.message, record.category, record.filename, record.lineno)
+        self._catcher = None
+        self._records = None
+
+    def reset(self):
+        count = self.count
+        self.count = 0
+        return count
@@ -83,6 +83,48 @@ def reparametrize_dist(dist, param_type="metric"):
     )[param_type]
 
 
+def sample_unique_indices(num_total, num_samples, batch_size=None, generator=None, device="cpu", max_rounds=None):
+    """Sample unique indices uniformly at random from [0,num_total) without replacement.
+    This is equivalent to torch.randperm(num_total)[:num_samples] (batched), but only costs O(num_samples) instead of
+    O(num_total) when num_samples << num_total (e.g. sampling rays from a high-resolution image): the indices are
+    drawn with replacement, and the repeated ones are redrawn until all are unique (rejection sampling).
+    Args:
+        num_total (int): Number of indices to sample from (e.g. number of pixels).
+        num_samples (int): Number of unique indices to sample.
+        batch_size (int): Number of independent samples (None for a single unbatched sample).
+        generator (torch.Generator): Random number generator (for reproducible streams, e.g. per worker).
+        device (str or torch.device): Device of the sampled indices (should match the generator).
+        max_rounds (int): If set, run this many redrawing rounds without checking for the remaining repeated indices
+            on the host, which avoids device synchronizations. Repeats may then remain (rarely when num_samples is
+            much smaller than num_total).
+    Returns:
+        indices (tensor [R] or [B,R]): Sampled indices.
+    """
+    shape = [num_samples] if batch_size is None else [batch_size, num_samples]
+    if num_samples * 2 > num_total:
+        # Rejection sampling becomes inefficient when sampling most of the indices; use random permutations instead.
+        rands = torch.rand(*shape[:-1], num_total, generator=generator, device=device)
+        return rands.argsort(dim=-1)[..., :num_samples]
+    indices = torch.randint(num_total, shape, generator=generator, device=device).view(-1, num_samples)  # [B,R]
+    num_rounds = 0
+    while max_rounds is None or num_rounds < max_rounds:
+        # Find the repeated indices (keeping their first occurrences) and redraw them.
+        indices_sorted, order = indices.sort(dim=-1, stable=True)  # [B,R]
+        repeated_sorted = torch.zeros_like(indices_sorted, dtype=torch.bool)  # [B,R]
+        repeated_sorted[:, 1:] = indices_sorted[:, 1:] == indices_sorted[:, :-1]
+        repeated = torch.zeros_like(repeated_sorted).scatter_(1, order, repeated_sorted)  # [B,R]
+        if max_rounds is None:
+            num_repeated = repeated.sum().item()
+            if num_repeated == 0:
+                break
+            indices[repeated] = torch.randint(num_total, [num_repeated], generator=generator, device=device)
+        else:
+            rand_indices = torch.randint(num_total, indices.shape, generator=generator, device=device)  # [B,R]
+            indices = torch.where(repeated, rand_indices, indices)
+        num_rounds += 1
+    return indices.view(shape)
+
+
 def ray_generator(pose, intr, image_size, num_rays, full_image=False, camera_ndc=False,
                   ray_indices=None):
     """Yield sampled rays for coordinate-based model to predict NeRF.
@@ -93,6 +135,7 @@ def ray_generator(pose, intr, image_size, num_rays, full_image=False, camera_ndc
         num_rays (int): Number of rays to sample (random rays unless full_image=True).
         full_image (bool): Sample rays from the full image.
         camera_ndc (bool): Use normalized device coordinate for camera.
+        ray_indices (tensor [bs, ray]): Pre-generated indices of the pixels to sample rays from.
     Returns:
         center_slice (tensor [bs, ray, 3]): Sampled 3-D center in the world coordinate.
         ray_slice (tensor [bs, ray, 3]): Sampled 3-D ray in the world coordinate.
@@ -107,20 +150,19 @@ def ray_generator(pose, intr, image_size, num_rays, full_image=False, camera_ndc
             # Sample rays from the full image.
             ray_indices = torch.arange(0, num_pixels, device=pose.device).repeat(batch_size, 1)  # [B,HW]
         else:
-            # Sample rays randomly. The below is equivalent to batched torch.randperm().
-            ray_indices = torch.rand(batch_size, num_pixels, device=pose.device).argsort(dim=1)[:, :num_rays]  # [B,R]
-    center, ray = camera.get_center_and_ray(pose, intr, image_size)  # [B,HW,3]
-    # Convert center/ray representations to NDC if necessary.
-    if camera_ndc == "new":
-        center, ray = camera.convert_NDC2(center, ray, intr=intr)
-    elif camera_ndc:
-        center, ray = camera.convert_NDC(center, ray, intr=intr)
+            # Sample rays randomly (equivalent to batched torch.randperm()).
+            ray_indices = sample_unique_indices(num_pixels, num_rays, batch_size=batch_size,
+                                                device=pose.device)  # [B,R]
     # Yield num_rays of sampled rays in each iteration (when random, the loop will only iterate once).
     for c in range(0, ray_indices.shape[1], num_rays):
         ray_idx = ray_indices[:, c:c + num_rays]  # [B,R]
-        batch_idx = torch.arange(batch_size, device=pose.device).repeat(ray_idx.shape[1], 1).t()  # [B,R]
-        center_slice = center[batch_idx, ray_idx]  # [B,R,3]
-        ray_slice = ray[batch_idx, ray_idx]  # [B,R,3]
+        # Only unproject the sampled pixels.
+        center_slice, ray_slice = camera.get_center_and_ray_by_idx(pose, intr, image_size, ray_idx)  # [B,R,3]
+        # Convert center/ray representations to NDC if necessary.
+        if camera_ndc == "new":
+            center_slice, ray_slice = camera.convert_NDC2(center_slice, ray_slice, intr=intr)
+        elif camera_ndc:
+            center_slice, ray_slice = camera.convert_NDC(center_slice, ray_slice, intr=intr)
         yield center_slice, ray_slice, ray_idx
 
 
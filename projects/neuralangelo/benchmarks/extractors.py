@@ -0,0 +1,135 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from functools import partial
+
+import torch
+import torch.nn.functional as torch_F
+import trimesh
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.utils.mesh import extract_mesh, refine_vertices  # noqa: E402
+
+
+def sdf_sphere(x):
+    return x.norm(dim=-1, keepdim=True) - 0.5
+
+
+def sdf_torus(x):
+    q = torch.stack([x[..., :2].norm(dim=-1) - 0.5, x[..., 2]], dim=-1)
+    return q.norm(dim=-1, keepdim=True) - 0.2
+
+
+def sdf_box(x):
+    # Box with sharp edges and corners, rotated so that its faces are not aligned with the lattice.
+    rotation = torch.tensor([[0.8, -0.6, 0.], [0.48, 0.64, -0.6], [0.36, 0.48, 0.8]], dtype=x.dtype, device=x.device)
+    q = (x @ rotation.T).abs() - 0.4
+    q_max = q.max(dim=-1, keepdim=True)[0]
+    # Select the outside/inside distance (rather than summing their clamped values) to get nonzero gradients on the
+    # surface.
+    return torch.where(q_max > 0, q.clamp(min=0).norm(dim=-1, keepdim=True), q_max)
+
+
+SHAPES = dict(sphere=sdf_sphere, torus=sdf_torus, box=sdf_box)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Accuracy of the mesh extraction methods on analytic SDFs")
+    parser.add_argument("--shapes", default=list(SHAPES), nargs="+", choices=list(SHAPES))
+    parser.add_argument("--resolutions", default=[64, 128, 256], type=int, nargs="+")
+    parser.add_argument("--refine_steps", default=4, type=int, help="Newton steps of the surface nets vertices")
+    parser.add_argument("--num_samples", default=100000, type=int, help="Number of surface samples of the meshes")
+    parser.add_argument("--sparse", action="store_true", help="Evaluate the SDF coarse-to-fine")
+    parser.add_argument("--output", default=None, help="Save the results to a JSON file")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def get_sdf_gradients(xyz, sdf_func):
+    with torch.enable_grad():
+        xyz = xyz.detach().requires_grad_(True)
+        sdfs = sdf_func(xyz)
+        gradients = torch.autograd.grad(sdfs.sum(), xyz)[0]
+    return sdfs.detach(), gradients
+
+
+def evaluate_mesh(mesh, sdf_func, num_samples, device):
+    """Measure the distance of the mesh to the surface (the SDF values at the surface samples of the mesh) and the
+    normal error (the angle between the face normals and the SDF gradients at the samples).
+    """
+    points, face_idx = trimesh.sample.sample_surface(mesh, num_samples, seed=0)
+    sdfs, gradients = get_sdf_gradients(torch.from_numpy(points).float().to(device), sdf_func)
+    normals = torch.from_numpy(mesh.face_normals[face_idx]).float().to(device)
+    cos = (torch_F.normalize(gradients, dim=-1) * normals).sum(dim=-1).clamp(-1, 1)
+    return dict(dist_mean=sdfs.abs().mean().item(), dist_max=sdfs.abs().max().item(),
+                normal_error_deg=torch.rad2deg(torch.arccos(cos)).mean().item())
+
+
+def run_extraction(sdf_func, resolution, method, refine_steps, sharp_features, sparse, device):
+    # Count the SDF evaluations of the lattice and of the vertex refinement.
+    num_evaluated = dict(lattice=0, refine=0)
+
+    def sdf_counted(points_3D):
+        num_evaluated["lattice"] += points_3D[..., 0].numel()
+        return -sdf_func(points_3D)  # Positive inside, as in extract_mesh.py.
+
+    def sdf_grad_counted(points_3D):
+        num_evaluated["refine"] += points_3D[..., 0].numel()
+        return get_sdf_gradients(points_3D, sdf_func)
+
+    intv = 2. / resolution
+    refine_func = None
+    if refine_steps > 0:
+        refine_func = partial(refine_vertices, sdf_grad_func=sdf_grad_counted, max_dist=intv, num_steps=refine_steps,
+                              sharp_features=sharp_features, device=device)
+    start = time.perf_counter()
+    mesh = extract_mesh(sdf_counted, [[-1., 1.], [-1., 1.], [-1., 1.]], intv=intv, device=device, sparse=sparse,
+                        method=method, refine_func=refine_func)
+    elapsed = time.perf_counter() - start
+    return mesh, dict(num_evaluated, seconds=elapsed, num_faces=len(mesh.faces))
+
+
+def main():
+    args = parse_args()
+    results = dict()
+    for shape in args.shapes:
+        sdf_func = SHAPES[shape]
+        results[shape] = dict()
+        for resolution in args.resolutions:
+            for name, method, refine_steps, sharp_features in [
+                    ("marching_cubes", "marching_cubes", 0, False),
+                    ("surface_nets", "surface_nets", args.refine_steps, False),
+                    ("surface_nets/sharp", "surface_nets", args.refine_steps, True)]:
+                key = f"{name}/res{resolution}"
+                mesh, stats = run_extraction(sdf_func, resolution, method, refine_steps, sharp_features, args.sparse,
+                                             args.device)
+                stats.update(evaluate_mesh(mesh, sdf_func, args.num_samples, args.device))
+                results[shape][key] = stats
+                num_evaluated = stats["lattice"] + stats["refine"]
+                print(f"[{shape}] {key:24s} SDF evals: {num_evaluated / 1e6:8.3f} M  faces: {stats['num_faces']:8d}  "
+                      f"dist mean: {stats['dist_mean']:.2e}  max: {stats['dist_max']:.2e}  "
+                      f"normal error: {stats['normal_error_deg']:6.2f} deg  time: {stats['seconds']:7.2f} s")
+    if args.output is not None:
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(dict(meta=dict(device=args.device, refine_steps=args.refine_steps, sparse=args.sparse),
+                           results=results), file, indent=4)
+        print(f"Saved the results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import sys
+import numpy as np
+import torch
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.benchmarks.utils import benchmark  # noqa: E402
+from projects.neuralangelo.utils.hashgrid import HashGridEncoding  # noqa: E402
+from projects.neuralangelo.utils.modules import tcnn  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hash grid backend parity/throughput benchmark")
+    parser.add_argument("--num_points", default=2 ** 18, type=int, help="Number of points per batch")
+    parser.add_argument("--levels", default=16, type=int)
+    parser.add_argument("--min_logres", default=5, type=int)
+    parser.add_argument("--max_logres", default=11, type=int)
+    parser.add_argument("--dict_size", default=22, type=int)
+    parser.add_argument("--dim", default=8, type=int)
+    parser.add_argument("--active_levels", default=None, type=int, help="Coarse-to-fine active levels (torch only)")
+    parser.add_argument("--iters", default=10, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def get_config(args):
+    r_min, r_max = 2 ** args.min_logres, 2 ** args.max_logres
+    growth_rate = np.exp((np.log(r_max) - np.log(r_min)) / (args.levels - 1))
+    return dict(
+        otype="HashGrid",
+        n_levels=args.levels,
+        n_features_per_level=args.dim,
+        log2_hashmap_size=args.dict_size,
+        base_resolution=r_min,
+        per_level_scale=growth_rate,
+    )
+
+
+def run(name, encoding, x, iters, device, **kwargs):
+    def forward():
+        with torch.no_grad():
+            encoding(x, **kwargs)
+
+    def forward_backward():
+        encoding(x, **kwargs).float().sum().backward()
+
+    time_fwd = benchmark(forward, device, iters=iters)
+    time_fwd_bwd = benchmark(forward_backward, device, iters=iters)
+    print(f"[{name}] forward: {time_fwd * 1e3:.2f} ms ({len(x) / time_fwd / 1e6:.2f} M points/s), "
+          f"forward+backward: {time_fwd_bwd * 1e3:.2f} ms ({len(x) / time_fwd_bwd / 1e6:.2f} M points/s)")
+
+
+def main():
+    args = parse_args()
+    config = get_config(args)
+    x = torch.rand(args.num_points, 3, device=args.device)
+    encoding_torch = HashGridEncoding(3, config).to(args.device)
+    if tcnn is not None and torch.device(args.device).type == "cuda":
+        encoding_tcnn = tcnn.Encoding(3, config)
+        # Load the tcnn parameters into the PyTorch backend and check the parity.
+        encoding_torch.load_state_dict(encoding_tcnn.state_dict())
+        with torch.no_grad():
+            feat_tcnn = encoding_tcnn(x).float()
+            feat_torch = encoding_torch(x)
+        error = (feat_tcnn - feat_torch).abs().max().item()
+        print(f"Max abs feature error (tcnn vs. torch): {error:.3e} (feature scale {feat_tcnn.abs().max().item():.3e})")
+        run("tcnn", encoding_tcnn, x, args.iters, args.device)
+    else:
+        print("tinycudann is not available on this device, only benchmarking the PyTorch backend.")
+    run("torch", encoding_torch, x, args.iters, args.device)
+    if args.active_levels is not None:
+        run(f"torch, {args.active_levels} active levels", encoding_torch, x, args.iters, args.device,
+            active_levels=args.active_levels)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import sys
+import torch
+import torch.nn.functional as torch_F
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.benchmarks.utils import benchmark, build_model  # noqa: E402
+from projects.neuralangelo.utils.occupancy import OccupancyGrid  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Occupancy grid (empty space skipping) benchmark")
+    parser.add_argument("--config", default="projects/neuralangelo/configs/base.yaml")
+    parser.add_argument("--num_rays", default=512, type=int)
+    parser.add_argument("--spread", default=0.3, type=float, help="Spread of the ray directions around the object")
+    parser.add_argument("--dict_size", default=None, type=int)
+    parser.add_argument("--iters", default=5, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    model, cfg = build_model(args.config, args.device, dict_size=args.dict_size)
+    # Without a checkpoint, the SDF is the sphere from the geometric initialization.
+    occupancy_grid = OccupancyGrid(cfg.model.render.occupancy).to(args.device)
+    occupancy_grid.update(model.neural_sdf.sdf, band=cfg.model.render.occupancy.band / model.s_var.exp().item())
+    print(f"Occupied cells: {occupancy_grid.occupied.float().mean().item() * 100:.2f}%")
+    center = torch.zeros(1, args.num_rays, 3, device=args.device)
+    center[..., 2] = -3
+    ray_unit = torch_F.normalize(torch.randn(1, args.num_rays, 3, device=args.device) * args.spread +
+                                 torch.tensor([0., 0., 1.], device=args.device), dim=-1)
+    # Count the number of points evaluated by the SDF network.
+    sdf_func = model.neural_sdf.sdf
+    num_points = [0]
+
+    def sdf_counted(points_3D):
+        num_points[0] += points_3D[..., 0].numel()
+        return sdf_func(points_3D)
+
+    for name, grid in [("without occupancy grid", None), ("with occupancy grid", occupancy_grid)]:
+        model.occupancy_grid = grid
+        near, far, outside = model.get_dist_bounds(center, ray_unit)
+        near, far, outside = model.get_object_dist_bounds(center, ray_unit, near, far, outside)
+        model.neural_sdf.sdf = sdf_counted
+        num_points[0] = 0
+        model.sample_dists_all(center, ray_unit, near, far, outside=outside)
+        del model.neural_sdf.sdf
+        elapsed = benchmark(lambda: model.render_rays(center, ray_unit), args.device, iters=args.iters)
+        print(f"[{name}] empty rays: {outside.float().mean().item() * 100:.1f}%, "
+              f"SDF samples/ray (hierarchical sampling): {num_points[0] / args.num_rays:.1f}, "
+              f"mean segment length: {(far - near)[~outside].mean().item():.3f}, "
+              f"render_rays: {elapsed * 1e3:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import sys
+import torch
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.benchmarks.utils import benchmark, build_model  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Inference (validation) rendering benchmark")
+    parser.add_argument("--config", default="projects/neuralangelo/configs/base.yaml")
+    parser.add_argument("--image_size", default=64, type=int)
+    parser.add_argument("--dict_size", default=None, type=int)
+    parser.add_argument("--iters", default=2, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    model, cfg = build_model(args.config, args.device, dict_size=args.dict_size)
+    size = args.image_size
+    # A camera at distance 3 looking at the origin.
+    intr = torch.tensor([[[size * 1.2, 0, size / 2], [0, size * 1.2, size / 2], [0, 0, 1]]], device=args.device)
+    pose = torch.tensor([[[1., 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 3]]], device=args.device)
+    sample_idx = torch.zeros(1, dtype=torch.long, device=args.device)
+    outputs = dict()
+    for marching in [False, True]:
+        model.cfg_render.marching.enabled = marching
+        name = "marching" if marching else "full"
+
+        def render():
+            torch.manual_seed(0)  # Same supersamples (if enabled) for both modes.
+            outputs[name] = model.render_image(pose, intr, [size, size], sample_idx=sample_idx)
+
+        elapsed = benchmark(render, args.device, warmup=1, iters=args.iters)
+        print(f"[render_image/{name}] {elapsed * 1e3:.2f} ms ({size * size / elapsed / 1e3:.2f} K pixels/s)")
+    for key in ["rgb", "depth", "opacity", "gradient", "mask_image"]:
+        if key in outputs["full"]:
+            error = (outputs["full"][key] - outputs["marching"][key]).abs().max().item()
+            print(f"Max abs error of {key}: {error:.3e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import sys
+import torch
+import torch.nn.functional as torch_F
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.benchmarks.utils import benchmark, build_model  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="SDF-only evaluation benchmark")
+    parser.add_argument("--config", default="projects/neuralangelo/configs/base.yaml")
+    parser.add_argument("--num_rays", default=512, type=int)
+    parser.add_argument("--block_res", default=64, type=int, help="Block resolution for mesh extraction")
+    parser.add_argument("--dict_size", default=None, type=int)
+    parser.add_argument("--iters", default=5, type=int)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    model, cfg = build_model(args.config, args.device, dict_size=args.dict_size)
+    neural_sdf = model.neural_sdf
+    cfg_render = cfg.model.render
+    # Reference: SDF through the full forward pass (the SDF path before the SDF-only fast path).
+    sdf_funcs = dict(
+        full_forward=lambda x: neural_sdf.forward(x)[0],
+        sdf_only=neural_sdf.sdf,
+    )
+    # Hierarchical sampling along rays.
+    center = torch.zeros(1, args.num_rays, 3, device=args.device)
+    center[..., 2] = -3
+    ray_unit = torch_F.normalize(torch.randn(1, args.num_rays, 3, device=args.device) * 0.1 +
+                                 torch.tensor([0., 0., 1.], device=args.device), dim=-1)
+    near, far, _ = model.get_dist_bounds(center, ray_unit)
+    num_points = args.num_rays * (cfg_render.num_samples.coarse +
+                                  cfg_render.num_samples.fine * max(cfg_render.num_sample_hierarchy - 1, 0))
+    for name, sdf_func in sdf_funcs.items():
+        neural_sdf.sdf = sdf_func
+        elapsed = benchmark(lambda: model.sample_dists_all(center, ray_unit, near, far), args.device,
+                            iters=args.iters)
+        print(f"[sample_dists_all/{name}] {elapsed * 1e3:.2f} ms ({num_points / elapsed / 1e6:.3f} M points/s)")
+    del neural_sdf.sdf
+    # Mesh extraction (one lattice block).
+    grid = torch.linspace(-1, 1, args.block_res + 1, device=args.device)
+    xyz = torch.stack(torch.meshgrid(grid, grid, grid, indexing="ij"), dim=-1)  # [X,Y,Z,3]
+    num_points = xyz[..., 0].numel()
+    for name, sdf_func in sdf_funcs.items():
+        elapsed = benchmark(lambda: sdf_func(xyz), args.device, iters=args.iters)
+        print(f"[extract_mesh block/{name}] {elapsed * 1e3:.2f} ms ({num_points / elapsed / 1e6:.3f} M points/s)")
+
+
+if __name__ == "__main__":
+    main()
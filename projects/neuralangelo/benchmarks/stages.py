@@ -0,0 +1,81 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import json
+import os
+import sys
+import torch
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.benchmarks.utils import build_model, synchronize  # noqa: E402
+from projects.neuralangelo.utils.profiler import StageProfiler  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Per-stage profiling of the rendering pipeline (training step)")
+    parser.add_argument("--config", default="projects/neuralangelo/configs/base.yaml")
+    parser.add_argument("--image_size", default=64, type=int)
+    parser.add_argument("--num_rays", default=512, type=int)
+    parser.add_argument("--dict_size", default=None, type=int)
+    parser.add_argument("--iters", default=3, type=int)
+    parser.add_argument("--output_dir", default="profile", help="Directory for the JSON report and the Chrome trace")
+    parser.add_argument("--cpu_memory", action="store_true",
+                        help="Without CUDA, also record the peak memory (in a separate run, as it slows the code down)")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    model, cfg = build_model(args.config, args.device, dict_size=args.dict_size)
+    model.train()
+    size = args.image_size
+    model.image_size_train = [size, size]
+    # A camera at distance 3 looking at the origin.
+    intr = torch.tensor([[[size * 1.2, 0, size / 2], [0, size * 1.2, size / 2], [0, 0, 1]]], device=args.device)
+    pose = torch.tensor([[[1., 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 3]]], device=args.device)
+    ray_idx = torch.randperm(size * size, device=args.device)[None, :args.num_rays]
+    data = dict(pose=pose, intr=intr, idx=torch.zeros(1, dtype=torch.long, device=args.device), ray_idx=ray_idx)
+
+    def train_step():
+        output = model(data)
+        loss = output["rgb"].abs().mean() + (output["gradients"].norm(dim=-1) - 1).abs().mean()
+        loss.backward()
+
+    train_step()  # Warm-up run (not profiled).
+    synchronize(args.device)
+    with StageProfiler() as profiler:
+        for _ in range(args.iters):
+            train_step()
+    report = profiler.report()
+    if args.cpu_memory and not torch.cuda.is_available():
+        # Tracking the CPU tensor storages would distort the timings, so the memory is recorded separately.
+        with StageProfiler(track_memory=True) as memory_profiler:
+            train_step()
+        for path, stats in memory_profiler.report().items():
+            if path in report:
+                report[path]["peak_memory_mb"] = stats["peak_memory_mb"]
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(os.path.join(args.output_dir, "stages.json"), "w") as file:
+        json.dump(report, file, indent=4)
+    profiler.save_chrome_trace(os.path.join(args.output_dir, "stages_trace.json"))
+    # Print the per-iteration averages (the backward pass is not broken down into stages).
+    for path, stats in report.items():
+        samples = f"{stats['samples'] / stats['calls']:10.0f}" if stats["samples"] is not None else " " * 10
+        memory = f"{stats['peak_memory_mb']:9.1f} MB" if stats["peak_memory_mb"] is not None else ""
+        print(f"{path:60s} {stats['total_ms'] / args.iters:9.2f} ms/iter  {samples} samples/call  {memory}")
+    print(f"Saved the report and the Chrome trace to {args.output_dir}/")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import itertools
+import json
+import math
+import os
+import platform
+import sys
+import torch
+import torch.nn.functional as torch_F
+
+sys.path.append(os.getcwd())
+from projects.nerf.utils import camera, nerf_util, render  # noqa: E402
+from projects.neuralangelo.benchmarks.utils import benchmark, build_model, peak_memory  # noqa: E402
+from projects.neuralangelo.utils.decimation import decimate_mesh  # noqa: E402
+from projects.neuralangelo.utils.mesh import extract_mesh  # noqa: E402
+from projects.neuralangelo.utils.spherical_harmonics import get_spherical_harmonics  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Micro-benchmark suite of the Neuralangelo hot paths")
+    parser.add_argument("--config", default="projects/neuralangelo/configs/base.yaml")
+    parser.add_argument("--batch_sizes", default=[1], type=int, nargs="+")
+    parser.add_argument("--rays", default=[128, 512], type=int, nargs="+")
+    parser.add_argument("--samples", default=[16, 64], type=int, nargs="+")
+    parser.add_argument("--mesh_resolutions", default=[64], type=int, nargs="+",
+                        help="Lattice resolutions for mesh extraction (not parameterized by rays x samples)")
+    parser.add_argument("--cases", default=None, nargs="+", help="Only run the cases containing these substrings")
+    parser.add_argument("--dict_size", default=14, type=int)
+    parser.add_argument("--warmup", default=1, type=int)
+    parser.add_argument("--iters", default=5, type=int)
+    parser.add_argument("--output", default=None, help="Save the results to a JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare against the results in a JSON file")
+    parser.add_argument("--tolerance", default=0.2, type=float, help="Relative slowdown/memory growth to report")
+    parser.add_argument("--fail_on_regression", action="store_true")
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    return parser.parse_args()
+
+
+def get_rays(batch_size, num_rays, device):
+    # Rays from a camera at distance 3 looking at the origin.
+    center = torch.zeros(batch_size, num_rays, 3, device=device)
+    center[..., 2] = -3
+    ray_unit = torch_F.normalize(torch.randn(batch_size, num_rays, 3, device=device) * 0.1 +
+                                 torch.tensor([0., 0., 1.], device=device), dim=-1)
+    return center, ray_unit  # [B,R,3]
+
+
+def get_samples(model, batch_size, num_rays, num_samples, device):
+    center, ray_unit = get_rays(batch_size, num_rays, device)
+    near, far, _ = model.get_dist_bounds(center, ray_unit)
+    dists = nerf_util.sample_dists(ray_unit.shape[:2], dist_range=(near[..., None], far[..., None]),
+                                   intvs=num_samples, stratified=False, device=device)  # [B,R,N,1]
+    points = camera.get_3D_points_from_dist(center, ray_unit, dists)  # [B,R,N,3]
+    return ray_unit, dists, points
+
+
+def case_alpha_compositing_weights(model, batch_size, num_rays, num_samples, device):
+    alphas = torch.rand(batch_size, num_rays, num_samples, device=device)  # [B,R,N]
+    return lambda: render.alpha_compositing_weights(alphas)
+
+
+def case_composite(model, batch_size, num_rays, num_samples, device):
+    rgbs = torch.rand(batch_size, num_rays, num_samples, 3, device=device)  # [B,R,N,3]
+    weights = torch.rand(batch_size, num_rays, num_samples, 1, device=device)  # [B,R,N,1]
+    return lambda: render.composite(rgbs, weights)
+
+
+def case_sample_dists_from_pdf(model, batch_size, num_rays, num_samples, device):
+    _, dists, _ = get_samples(model, batch_size, num_rays, num_samples, device)
+    weights = torch.rand(batch_size, num_rays, num_samples - 1, device=device)  # [B,R,N-1]
+    return lambda: nerf_util.sample_dists_from_pdf(dists, weights, model.cfg_render.num_samples.fine)
+
+
+def case_sample_dists_hierarchical(model, batch_size, num_rays, num_samples, device):
+    ray_unit, dists, points = get_samples(model, batch_size, num_rays, num_samples, device)
+    sdfs = points.norm(dim=-1, keepdim=True) - 0.5  # [B,R,N,1]
+    return lambda: model.sample_dists_hierarchical(dists, sdfs, inv_s=64)
+
+
+def case_compute_neus_alphas(model, batch_size, num_rays, num_samples, device):
+    ray_unit, dists, points = get_samples(model, batch_size, num_rays, num_samples, device)
+    sdfs = points.norm(dim=-1, keepdim=True) - 0.5  # [B,R,N,1]
+    gradients = torch_F.normalize(points, dim=-1)  # [B,R,N,3]
+    return lambda: model.compute_neus_alphas(ray_unit, sdfs, gradients, dists, progress=1.)
+
+
+def case_neural_sdf_forward(model, batch_size, num_rays, num_samples, device):
+    _, _, points = get_samples(model, batch_size, num_rays, num_samples, device)
+    return lambda: model.neural_sdf.forward(points)
+
+
+def get_case_compute_gradients(taps):
+
+    def case_compute_gradients(model, batch_size, num_rays, num_samples, device):
+        _, _, points = get_samples(model, batch_size, num_rays, num_samples, device)
+        sdfs = model.neural_sdf.sdf(points)  # [B,R,N,1]
+
+        def func():
+            model.neural_sdf.cfg_sdf.gradient.taps = taps
+            return model.neural_sdf.compute_gradients(points, training=True, sdf=sdfs)
+
+        return func
+
+    return case_compute_gradients
+
+
+def case_spherical_harmonics(model, batch_size, num_rays, num_samples, device):
+    dirs = torch_F.normalize(torch.randn(batch_size, num_rays, num_samples, 3, device=device), dim=-1)  # [B,R,N,3]
+    levels = model.neural_rgb.cfg_rgb.encoding_view.levels
+    return lambda: get_spherical_harmonics(dirs, levels)
+
+
+def case_get_center_and_ray(model, batch_size, num_rays, num_samples, device):
+    # Unproject a full (square) image with (about) as many pixels as rays.
+    size = round(math.sqrt(num_rays))
+    intr = torch.tensor([[size * 1.2, 0, size / 2], [0, size * 1.2, size / 2], [0, 0, 1]], device=device)
+    pose = torch.tensor([[1., 0, 0, 0], [0, 1, 0, 0], [0, 0, 1, 3]], device=device)
+    intr, pose = intr.repeat(batch_size, 1, 1), pose.repeat(batch_size, 1, 1)  # [B,3,3],[B,3,4]
+    return lambda: camera.get_center_and_ray(pose, intr, [size, size])
+
+
+def case_extract_mesh(resolution, device, sparse=False, method="marching_cubes"):
+
+    def sdf_func(x):
+        return x.norm(dim=-1, keepdim=True) - 0.5  # Sphere of radius 0.5.
+
+    bounds = [[-1., 1.], [-1., 1.], [-1., 1.]]
+    return lambda: extract_mesh(sdf_func, bounds, intv=2. / resolution, block_res=64, device=device, sparse=sparse,
+                                method=method)
+
+
+def case_decimate_mesh(resolution, device):
+    # Decimate the sphere mesh extracted at the given resolution to 25% of its faces.
+    mesh = case_extract_mesh(resolution, device)()
+    return lambda: list(decimate_mesh(mesh.vertices, mesh.faces, [len(mesh.faces) // 4])), len(mesh.faces)
+
+
+# Benchmarks parameterized by batch size x rays x samples: (function, number of processed elements).
+CASES = {
+    "render.alpha_compositing_weights": (case_alpha_compositing_weights, lambda B, R, N: B * R * N),
+    "render.composite": (case_composite, lambda B, R, N: B * R * N),
+    "nerf_util.sample_dists_from_pdf": (case_sample_dists_from_pdf, lambda B, R, N: B * R * N),
+    "Model.sample_dists_hierarchical": (case_sample_dists_hierarchical, lambda B, R, N: B * R * N),
+    "Model.compute_neus_alphas": (case_compute_neus_alphas, lambda B, R, N: B * R * N),
+    "SpatialMaskNeuralSDF.forward": (case_neural_sdf_forward, lambda B, R, N: B * R * N),
+    "SpatialMaskNeuralSDF.compute_gradients/taps4": (get_case_compute_gradients(4), lambda B, R, N: B * R * N),
+    "SpatialMaskNeuralSDF.compute_gradients/taps6": (get_case_compute_gradients(6), lambda B, R, N: B * R * N),
+    "get_spherical_harmonics": (case_spherical_harmonics, lambda B, R, N: B * R * N),
+    "camera.get_center_and_ray": (case_get_center_and_ray, lambda B, R, N: B * round(math.sqrt(R)) ** 2),
+}
+
+
+def run_case(name, key, func, num_elements, args):
+    elapsed = benchmark(func, args.device, warmup=args.warmup, iters=args.iters)
+    stats = dict(
+        ms=elapsed * 1e3,
+        throughput=num_elements / elapsed,  # Elements (samples/pixels/lattice points) per second.
+        peak_memory_mb=peak_memory(func, args.device) / 2 ** 20,
+    )
+    print(f"[{name}] {key:16s} {stats['ms']:10.3f} ms {stats['throughput'] / 1e6:9.3f} M/s "
+          f"{stats['peak_memory_mb']:9.2f} MB")
+    return stats
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results against a baseline.
+    Args:
+        results (dict): The results of this run.
+        baseline (dict): The baseline results (same format).
+        tolerance (float): Relative slowdown/memory growth above which a result is reported as a regression.
+    Returns:
+        regressions (list of str): Descriptions of the regressions.
+    """
+    regressions = []
+    for name, configs in results.items():
+        for key, stats in configs.items():
+            base = baseline.get(name, dict()).get(key)
+            if base is None:
+                continue
+            for metric in ["ms", "peak_memory_mb"]:
+                ratio = stats[metric] / max(base[metric], 1e-8)
+                if ratio > 1 + tolerance and stats[metric] - base[metric] > 1e-3:
+                    regressions.append(f"{name} [{key}] {metric}: {base[metric]:.3f} -> {stats[metric]:.3f} "
+                                       f"({ratio:.2f}x)")
+    return regressions
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    model, cfg = build_model(args.config, args.device, dict_size=args.dict_size)
+    results = dict()
+
+    def selected(name):
+        return args.cases is None or any(pattern in name for pattern in args.cases)
+
+    for name, (get_func, get_num_elements) in CASES.items():
+        if not selected(name):
+            continue
+        results[name] = dict()
+        for batch_size, num_rays, num_samples in itertools.product(args.batch_sizes, args.rays, args.samples):
+            torch.manual_seed(0)
+            key = f"B{batch_size}_R{num_rays}_N{num_samples}"
+            func = get_func(model, batch_size, num_rays, num_samples, args.device)
+            num_elements = get_num_elements(batch_size, num_rays, num_samples)
+            results[name][key] = run_case(name, key, func, num_elements, args)
+    for name, sparse, method in [("mesh.extract_mesh", False, "marching_cubes"),
+                                 ("mesh.extract_mesh/sparse", True, "marching_cubes"),
+                                 ("mesh.extract_mesh/surface_nets", False, "surface_nets")]:
+        if not selected(name):
+            continue
+        results[name] = dict()
+        for resolution in args.mesh_resolutions:
+            key = f"res{resolution}"
+            func = case_extract_mesh(resolution, args.device, sparse=sparse, method=method)
+            results[name][key] = run_case(name, key, func, resolution ** 3, args)
+    if selected("mesh.decimate_mesh"):
+        results["mesh.decimate_mesh"] = dict()
+        for resolution in args.mesh_resolutions:
+            key = f"res{resolution}"
+            func, num_faces = case_decimate_mesh(resolution, args.device)
+            results["mesh.decimate_mesh"][key] = run_case("mesh.decimate_mesh", key, func, num_faces, args)
+    if args.output is not None:
+        if args.device.startswith("cuda"):
+            device_name = torch.cuda.get_device_name()
+        else:
+            device_name = platform.processor() or platform.machine()
+        meta = dict(device=device_name,
+                    torch=torch.__version__, config=args.config, dict_size=args.dict_size, iters=args.iters)
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as file:
+            json.dump(dict(meta=meta, results=results), file, indent=4)
+        print(f"Saved the results to {args.output}")
+    if args.baseline is not None:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        print(f"{len(regressions)} regression(s) against {args.baseline} (tolerance {args.tolerance:.0%})")
+        if regressions and args.fail_on_regression:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import importlib
+import time
+import torch
+
+from imaginaire.config import Config
+from projects.neuralangelo.utils.modules import tcnn
+from projects.neuralangelo.utils.profiler import StorageTracker
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize()
+
+
+def benchmark(func, device, warmup=3, iters=10):
+    """Time a function (averaged over iterations, excluding warm-up runs).
+    Args:
+        func (callable): The function to benchmark (called without arguments).
+        device (str/torch.device): The device the function runs on.
+        warmup (int): Number of untimed warm-up runs.
+        iters (int): Number of timed runs.
+    Returns:
+        elapsed (float): Average wall time per call (in seconds).
+    """
+    for _ in range(warmup):
+        func()
+    synchronize(device)
+    start = time.perf_counter()
+    for _ in range(iters):
+        func()
+    synchronize(device)
+    return (time.perf_counter() - start) / iters
+
+
+def peak_memory(func, device):
+    """Measure the peak memory allocated while running a function (on top of the memory allocated before the call).
+    On CUDA, this is read from the caching allocator statistics. On CPU, the tensor storages are tracked through a
+    dispatch mode (which slows the function down, so this should not be combined with timing).
+    Args:
+        func (callable): The function to measure (called without arguments).
+        device (str/torch.device): The device the function runs on.
+    Returns:
+        peak (int): Peak memory (in bytes).
+    """
+    if torch.device(device).type == "cuda":
+        synchronize(device)
+        baseline = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        func()
+        synchronize(device)
+        return torch.cuda.max_memory_allocated(device) - baseline
+    with StorageTracker() as tracker:
+        func()
+    return tracker.peak
+
+
+def build_model(config, device, current_iteration=None, dict_size=None):
+    """Build the Neuralangelo model from a config file for benchmarking (no checkpoint, no trainer).
+    Args:
+        config (str): Path to the config file.
+        device (str/torch.device): The device to put the model on.
+        current_iteration (int): Iteration for the coarse-to-fine schedule (default: all levels active).
+        dict_size (int): Override the hash table size (log2) of the encodings to reduce memory.
+    Returns:
+        model (torch.nn.Module): The model in eval mode.
+        cfg (obj): The loaded config.
+    """
+    cfg = Config(config)
+    cfg_sdf = cfg.model.object.sdf
+    for cfg_encoding in [cfg_sdf.encoding, cfg_sdf.spatialmask.encoding]:
+        if tcnn is None or torch.device(device).type != "cuda":
+            cfg_encoding.hashgrid.backend = "torch"
+        if dict_size is not None:
+            cfg_encoding.hashgrid.dict_size = dict_size
+    model = importlib.import_module(cfg.model.type).Model(cfg.model, cfg.data).to(device)
+    model.progress = 1.
+    model.neural_sdf.warm_up_end = cfg.optim.sched.warm_up_end
+    model.neural_sdf.set_active_levels(cfg.max_iter if current_iteration is None else current_iteration)
+    model.neural_sdf.set_normal_epsilon()
+    model.eval()
+    return model, cfg
@@ -13,11 +13,11 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 import json
 import numpy as np
 import torch
-import torchvision.transforms.functional as torchvision_F
 from PIL import Image, ImageFile
 
 from projects.nerf.datasets import base
-from projects.nerf.utils import camera
+from projects.nerf.utils import camera, nerf_util
+from projects.neuralangelo.utils.pixel_sampler import ErrorMapSampler
 
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -40,9 +40,15 @@ class Dataset(base.Dataset):
             self.list = [self.list[i] for i in subset_idx]
         self.num_rays = cfg.model.render.rand_rays
         self.readjust = getattr(cfg_data, "readjust", None)
+        # Error-driven importance sampling of the training pixels.
+        self.pixel_sampler = None
+        if self.split == "train" and cfg_data.importance_sampling.enabled:
+            self.pixel_sampler = ErrorMapSampler(cfg_data.importance_sampling, len(self), [self.H, self.W])
         # Preload dataset if possible.
         if cfg_data.preload:
-            self.images = self.preload_threading(self.get_image, cfg_data.num_workers)
+            images = self.preload_threading(self.get_image_resized, cfg_data.num_workers)
+            images, self.image_sizes_raw = zip(*images)
+            self.images = self.build_image_cache(list(images), shared_memory=getattr(cfg_data, "shared_memory", False))
             self.cameras = self.preload_threading(self.get_camera, cfg_data.num_workers, data_str="cameras")
 
     def __getitem__(self, idx):
@@ -54,21 +60,29 @@ class Dataset(base.Dataset):
                  idx (scalar): The index of the sample of the dataset.
                  image (R tensor): Image idx for per-image embedding.
                  image (Rx3 tensor): Image with pixel values in [0,1] for supervision.
+                 ray_weight (R tensor): Importance weights of the rays (with importance sampling).
                  intr (3x3 tensor): The camera intrinsics of `image`.
                  pose (3x4 tensor): The camera extrinsics [R,t] of `image`.
         """
         # Keep track of sample index for convenience.
         sample = dict(idx=idx)
-        # Get the images.
-        image, image_size_raw = self.images[idx] if self.preload else self.get_image(idx)
-        image = self.preprocess_image(image)
+        # Get the (resized, uint8) images.
+        if self.preload:
+            image, image_size_raw = self.images[idx], self.image_sizes_raw[idx]  # [H,W,C]
+        else:
+            image, image_size_raw = self.get_image_resized(idx)  # [H,W,C]
         # Get the cameras (intrinsics and pose).
         intr, pose = self.cameras[idx] if self.preload else self.get_camera(idx)
         intr, pose = self.preprocess_camera(intr, pose, image_size_raw)
         # Pre-sample ray indices.
         if self.split == "train":
-            ray_idx = torch.randperm(self.H * self.W)[:self.num_rays]  # [R]
-            image_sampled = image.flatten(1, 2)[:, ray_idx].t()  # [R,3]
+            if self.pixel_sampler is not None:
+                ray_idx, ray_weight = self.pixel_sampler.sample(idx, self.num_rays, generator=self.get_generator())
+                sample.update(ray_weight=ray_weight)  # [R]
+            else:
+                ray_idx = nerf_util.sample_unique_indices(self.H * self.W, self.num_rays,
+                                                          generator=self.get_generator())  # [R]
+            image_sampled = self.preprocess_image(image.flatten(0, 1)[ray_idx])  # [R,3]
             sample.update(
                 ray_idx=ray_idx,
                 image_sampled=image_sampled,
@@ -77,7 +91,7 @@ class Dataset(base.Dataset):
             )
         else:  # keep image during inference
             sample.update(
-                image=image,
+                image=self.preprocess_image(image).permute(2, 0, 1),  # [3,H,W]
                 intr=intr,
                 pose=pose,
             )
@@ -91,11 +105,14 @@ class Dataset(base.Dataset):
         image_size_raw = image.size
         return image, image_size_raw
 
+    def get_image_resized(self, idx):
+        image, image_size_raw = self.get_image(idx)
+        image = self.resize_image(image)  # [H,W,C]
+        return image, image_size_raw
+
     def preprocess_image(self, image):
-        # Resize the image.
-        image = image.resize((self.W, self.H))
-        image = torchvision_F.to_tensor(image)
-        rgb = image[:3]
+        # Convert the uint8 pixels to [0,1].
+        rgb = image[..., :3].float() / 255  # [...,3]
         return rgb
 
     def get_camera(self, idx):
@@ -129,3 +146,69 @@ class Dataset(base.Dataset):
         # convert to CV convention used in Imaginaire
         cv = gl * torch.tensor([1, -1, -1, 1])
         return cv
+
+
+class RayBatchLoader:
+
+    def __init__(self, dataset, cfg_ray_batch, device="cuda", sync_free=False):
+        """Training data loader that samples the rays of each step across many images at once.
+        The images (uint8) and cameras are stored on the training device, and the rays and their target colors are
+        drawn there with a few vectorized ops, without data loader workers. The batches have the same format as the
+        collated samples of the dataset, with B=num_images images and R=num_rays/num_images rays per image.
+        Args:
+            dataset (obj): The (preloaded) training dataset.
+            cfg_ray_batch (obj): Ray batch config (num_images, num_rays).
+            device (str or torch.device): Device of the image/camera store and the sampled batches.
+            sync_free (bool): Sample the unique ray indices without device synchronizations.
+        """
+        assert dataset.preload, "Batch-level ray sampling requires preloading the dataset."
+        assert dataset.pixel_sampler is None, "Batch-level ray sampling does not support importance sampling."
+        self.dataset = dataset
+        self.device = device
+        self.num_images = min(cfg_ray_batch.num_images, len(dataset))
+        self.num_pixels = dataset.H * dataset.W
+        self.max_rounds = 3 if sync_free else None
+        self.num_rays_per_image = min(cfg_ray_batch.num_rays // self.num_images, self.num_pixels)
+        # Device-resident image and camera store.
+        self.images = dataset.images[..., :3].flatten(1, 2).to(device)  # [N,HW,3]
+        cameras = [dataset.preprocess_camera(*dataset.cameras[idx], dataset.image_sizes_raw[idx])
+                   for idx in range(len(dataset))]
+        intrs, poses = zip(*cameras)
+        self.intrs = torch.stack(intrs, dim=0).to(device)  # [N,3,3]
+        self.poses = torch.stack(poses, dim=0).to(device)  # [N,3,4]
+        # Mimic the data loader interface used by the trainer.
+        self.sampler = self
+
+    def set_epoch(self, epoch):
+        pass
+
+    def __len__(self):
+        # One epoch sees each image once (in expectation).
+        return max(len(self.dataset) // self.num_images, 1)
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            yield self.sample()
+
+    def sample(self):
+        """Sample a batch of random rays from random images.
+        Returns: A dictionary containing the data.
+                 idx (B tensor): The indices of the sampled images.
+                 ray_idx (BxR tensor): The indices of the sampled pixels.
+                 image_sampled (BxRx3 tensor): The pixel values in [0,1] for supervision.
+                 intr (Bx3x3 tensor): The camera intrinsics.
+                 pose (Bx3x4 tensor): The camera extrinsics [R,t].
+        """
+        idx = nerf_util.sample_unique_indices(len(self.dataset), self.num_images, device=self.device)  # [B]
+        ray_idx = nerf_util.sample_unique_indices(self.num_pixels, self.num_rays_per_image,
+                                                  batch_size=self.num_images, device=self.device,
+                                                  max_rounds=self.max_rounds)  # [B,R]
+        image_sampled = self.dataset.preprocess_image(self.images[idx[:, None], ray_idx])  # [B,R,3]
+        data = dict(
+            idx=idx,
+            ray_idx=ray_idx,
+            image_sampled=image_sampled,
+            intr=self.intrs[idx],
+            pose=self.poses[idx],
+        )
+        return data
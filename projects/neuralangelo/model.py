@@ -27,8 +27,9 @@ from collections import defaultdict
 
 from imaginaire.models.base import Model as BaseModel
 from projects.nerf.utils import nerf_util, camera, render
-from projects.neuralangelo.utils import misc
+from projects.neuralangelo.utils import misc, profiler
 from projects.neuralangelo.utils.modules import NeuralSDF, NeuralRGB, BackgroundNeRF, SpatialMaskNeuralSDF
+from projects.neuralangelo.utils.occupancy import OccupancyGrid
 
 class Model(BaseModel):
 
@@ -73,6 +74,16 @@ class Model(BaseModel):
             self.background_nerf = None
         if not cfg_model.object.s_var.scheduled:
             self.s_var = torch.nn.Parameter(torch.tensor(cfg_model.object.s_var.init_val, dtype=torch.float32))
+        if cfg_model.render.occupancy.enabled:
+            self.occupancy_grid = OccupancyGrid(cfg_model.render.occupancy)
+        else:
+            self.occupancy_grid = None
+
+    @torch.no_grad()
+    def update_occupancy_grid(self):
+        # Also keep the cells within the width of the NeuS density (~1/inv_s) around the surface occupied.
+        band = self.cfg_render.occupancy.band / self.s_var.exp().item()
+        self.occupancy_grid.update(self.neural_sdf.sdf, band=band)
 
     def set_svar(self):
         self.s_var = torch.tensor(12 + 5/(1-(2.7183**(2.5*self.progress + 0.4))), dtype=torch.float32)
@@ -87,6 +98,8 @@ class Model(BaseModel):
     @torch.no_grad()
     def inference(self, data):
         self.eval()
+        if self.occupancy_grid is not None and not self.occupancy_grid.initialized:
+            self.update_occupancy_grid()
         # Render the full images.
         output = self.render_image(data["pose"], data["intr"], image_size=self.image_size_val,
                                    stratified=False, sample_idx=data["idx"])  # [B,N,C]
@@ -165,6 +178,13 @@ class Model(BaseModel):
         output = defaultdict(list)
         for center, ray, ray_idxs in self.ray_generator(pose, intr, image_size, full_image=True):
             ray_unit = torch_F.normalize(ray, dim=-1)  # [B,R,3]
+            if not self.training and self.cfg_render.marching.enabled:
+                output_batch = self.render_image_marching(center, ray, ray_unit, ray_idxs, pose, intr, image_size,
+                                                          sample_idx=sample_idx)
+                for key, value in output_batch.items():
+                    if value is not None:
+                        output[key].append(value.detach())
+                continue
             output_batch = self.render_rays(center, ray_unit, sample_idx=sample_idx, stratified=stratified, ray_idx=ray_idxs, 
                                             pose=pose, intr=intr, image_size=image_size, supersample=self.cfg_render.supersampling)
             if not self.training:
@@ -251,21 +271,40 @@ class Model(BaseModel):
             output[key] = torch.cat(value, dim=1)
         return output
 
+    @torch.no_grad()
+    def render_image_marching(self, center, ray, ray_unit, ray_idx, pose, intr, image_size, sample_idx=None):
+        # Same outputs as the inference branch of render_image(), rendered with render_rays_marching().
+        output_batch = self.render_rays_marching(center, ray_unit, sample_idx=sample_idx)
+        supersample_activated = self.neural_sdf.active_levels >= self.cfg_render.supersample_activate_level
+        if self.cfg_render.supersampling and supersample_activated:
+            ss_idxs, ss_centers, ss_ray_unit = self.get_supersample_rays(output_batch["mask"], ray_idx, pose, intr,
+                                                                         image_size)
+            ss_rgb = self.render_rays_marching(ss_centers, ss_ray_unit, sample_idx=sample_idx)["rgb"]  # [B,S,3]
+            output_batch["rgb"] = self.average_supersamples(output_batch["rgb"], ss_rgb, ss_idxs)  # [B,R,3]
+        depth = output_batch.pop("dist") / ray.norm(dim=-1, keepdim=True)  # [B,R,1]
+        mask = output_batch.pop("mask")
+        output_batch.update(depth=depth)
+        if self.cfg_render.render_mask:
+            output_batch.update(mask_image=mask)
+        return output_batch
+
     def render_pixels(self, pose, intr, image_size, stratified=False, sample_idx=None, ray_idx=None):
-        center, ray = camera.get_center_and_ray(pose, intr, image_size)  # [B,HW,3]
-        center = nerf_util.slice_by_ray_idx(center, ray_idx)  # [B,R,3]
-        ray = nerf_util.slice_by_ray_idx(ray, ray_idx)  # [B,R,3]
-        ray_unit = torch_F.normalize(ray, dim=-1)  # [B,R,3]
-        output = self.render_rays(center, ray_unit, sample_idx=sample_idx, stratified=stratified, 
-                                  ray_idx=ray_idx, supersample=self.cfg_render.supersampling,
-                                  pose=pose, intr=intr, image_size=image_size)
+        with profiler.region("ray_generation", samples=ray_idx.numel()):
+            center, ray = camera.get_center_and_ray_by_idx(pose, intr, image_size, ray_idx)  # [B,R,3]
+            ray_unit = torch_F.normalize(ray, dim=-1)  # [B,R,3]
+        with profiler.region("render_rays", samples=ray_unit):
+            output = self.render_rays(center, ray_unit, sample_idx=sample_idx, stratified=stratified,
+                                      ray_idx=ray_idx, supersample=self.cfg_render.supersampling,
+                                      pose=pose, intr=intr, image_size=image_size)
         return output
 
     def render_rays(self, center, ray_unit, sample_idx=None, stratified=False, ray_idx=None, supersample=False, pose=None, intr=None, image_size=None):
-        with torch.no_grad():
+        with profiler.region("get_dist_bounds", samples=ray_unit), torch.no_grad():
             near, far, outside = self.get_dist_bounds(center, ray_unit)
+            near_object, far_object, outside_object = self.get_object_dist_bounds(center, ray_unit, near, far, outside)
         app, app_outside = self.get_appearance_embedding(sample_idx, ray_unit.shape[1])
-        output_object = self.render_rays_object(center, ray_unit, near, far, outside, app, stratified=stratified)
+        output_object = self.render_rays_object(center, ray_unit, near_object, far_object, outside_object, app,
+                                                stratified=stratified)
         if self.with_background:
             output_background = self.render_rays_background(center, ray_unit, far, app_outside, stratified=stratified)
             # Concatenate object and background samples.
@@ -276,12 +315,13 @@ class Model(BaseModel):
             rgbs = output_object["rgbs"]  # [B,R,No,3]
             dists = output_object["dists"]  # [B,R,No,1]
             alphas = output_object["alphas"]  # [B,R,No]
-        weights = render.alpha_compositing_weights(alphas)  # [B,R,No+Nb,1]
-        # Compute weights and composite samples.
-        rgb = render.composite(rgbs, weights)  # [B,R,3]
-        if self.white_background:
-            opacity_all = render.composite(1., weights)  # [B,R,1]
-            rgb = rgb + (1 - opacity_all)
+        with profiler.region("compositing", samples=rgbs):
+            weights = render.alpha_compositing_weights(alphas)  # [B,R,No+Nb,1]
+            # Compute weights and composite samples.
+            rgb = render.composite(rgbs, weights)  # [B,R,3]
+            if self.white_background:
+                opacity_all = render.composite(1., weights)  # [B,R,1]
+                rgb = rgb + (1 - opacity_all)
         # Collect output.
 
 
@@ -289,63 +329,13 @@ class Model(BaseModel):
              #print(output_object['mask'].shape) 
             # mask, _ = torch.max(output_object['mask'], dim=-2)
              
-             mask = render.composite(output_object['mask'], weights[:,:,:128,:])
-             #currently using max hf masks, score based?
-             hf_mask, idxs = torch.max(mask[..., 14:16], dim=-1)
-            # print(hf_mask.max())
-            
-             #mask_probability = torch.softmax(hf_mask, dim=1)
-             
-             mask_probability = (hf_mask + 1e-6)/(hf_mask.sum(dim=1) + 1e-6) 
-             print(mask_probability.mean(), mask_probability.std(), mask_probability.max())
-
-             ss_idxs = torch.multinomial(mask_probability, self.cfg_render.supersamples, replacement=True).squeeze()
-             # index list of indexes for the ss function to work on image
-             uniq, count = torch.unique(ss_idxs, return_counts=True)
-            # print(count.max())
+             with profiler.region("supersampling"):
+                 mask = render.composite(output_object['mask'], weights[:, :, :output_object['mask'].shape[2]])
+                 ss_idxs, ss_centers, ss_ray_unit = self.get_supersample_rays(mask, ray_idx, pose, intr, image_size)
+                 ss_rgb = self.render_supersamples(ss_centers, ss_ray_unit, sample_idx=sample_idx,
+                                                   stratified=stratified)  # [B,S,3]
+                 rgb = self.average_supersamples(rgb, ss_rgb, ss_idxs)  # [B,R,3]
 
-             ss_ray_image_idxs = ray_idx[:, ss_idxs]
-            
-             ss_centers, ss_rays = camera.get_center_and_ray_supersampled(pose, intr, image_size, ss_ray_image_idxs, num_samples=1)    
-             ss_ray_unit = torch_F.normalize(ss_rays, dim=-1)    
-                
-             #SPEED UP Can we avoid this by simply indexing?
-             with torch.no_grad():
-                ss_near, ss_far, ss_outside = self.get_dist_bounds(ss_centers, ss_ray_unit)
-             
-             ss_app, ss_app_outside = self.get_appearance_embedding(sample_idx, ss_ray_unit.shape[1])
-
-             ss_output_object = self.render_rays_object(ss_centers, ss_ray_unit, ss_near, ss_far, ss_outside, ss_app, stratified=stratified)
-             
-             if self.with_background:
-                ss_output_background = self.render_rays_background(ss_centers, ss_ray_unit, ss_far, ss_app_outside, stratified=stratified)
-                # Concatenate object and background samples.
-                ss_rgbs = torch.cat([ss_output_object["rgbs"], ss_output_background["rgbs"]], dim=2)  # [B,R,No+Nb,3]
-                ss_dists = torch.cat([ss_output_object["dists"], ss_output_background["dists"]], dim=2)  # [B,R,No+Nb,1]
-                ss_alphas = torch.cat([ss_output_object["alphas"], ss_output_background["alphas"]], dim=2)  # [B,R,No+Nb]
-             else:
-                ss_rgbs = output_object_ss["rgbs"]  # [B,R,No,3]
-                ss_dists = output_object_ss["dists"]  # [B,R,No,1]
-                ss_alphas = output_object_ss["alphas"]  # [B,R,No]
-           
-             ss_weights = render.alpha_compositing_weights(ss_alphas)  # [B,R,No+Nb,1]
-             # Compute weights and composite samples.
-             ss_rgb = render.composite(ss_rgbs, ss_weights)  # [B,R,3]
-             
-            
-             uniq_idxs, count = torch.unique(ss_idxs, return_counts=True)
-             #FIX ME: make efficient. Average over super samples
-             for uniq_idx, count in zip(uniq_idxs, count):
-                idxmask = torch.where(ss_idxs.squeeze()==uniq_idx, 1, 0)
-                ss_for_av = torch.index_select(ss_rgb,1, idxmask.nonzero().squeeze(-1))
-               # print(ss_for_av, 'RGB',  rgb[:, uniq_idx, :])
-                rgb[:, uniq_idx, :] = (rgb[:, uniq_idx, :] + torch.sum(ss_for_av, dim=1))/(1+count)
-                
-
-
-             if self.white_background:
-                ss_opacity_all = render.composite(1., ss_weights)  # [B,R,1]
-                         
              opacity = output_object["opacity"] #torch.cat([output_object["opacity"], ss_output_object["opacity"]], dim=1) if output_object["opacity"] != None else None  # [B,R,1]/None
              
              gradient = output_object["gradient"] #torch.cat([output_object["gradient"], ss_output_object["gradient"]], dim=1) if output_object["gradient"] != None else None  # [B,R,1]/None
@@ -381,18 +371,184 @@ class Model(BaseModel):
 
         return output
 
+    def get_supersample_rays(self, mask, ray_idx, pose, intr, image_size):
+        """Sample the pixels to supersample from the composited (high-frequency) spatial mask.
+        Args:
+            mask (tensor [B,R,L]): Composited spatial mask of the rays.
+            ray_idx (tensor [B,R]): Image indices of the rays.
+        Returns:
+            ss_idxs (tensor [B,S]): Indices of the supersampled rays (among the R rays).
+            ss_centers (tensor [B,S,3]): Centers of the supersamples.
+            ss_ray_unit (tensor [B,S,3]): Unit ray directions of the supersamples.
+        """
+        #currently using max hf masks, score based?
+        hf_mask, _ = torch.max(mask[..., 14:16], dim=-1)
+        mask_probability = (hf_mask + 1e-6) / (hf_mask.sum(dim=1, keepdim=True) + 1e-6)  # [B,R]
+        ss_idxs = torch.multinomial(mask_probability, self.cfg_render.supersamples, replacement=True)  # [B,S]
+        # index list of indexes for the ss function to work on image
+        ss_ray_image_idxs = torch.gather(ray_idx, 1, ss_idxs)  # [B,S]
+        ss_centers, ss_rays = camera.get_center_and_ray_supersampled(pose, intr, image_size, ss_ray_image_idxs,
+                                                                     num_samples=1)
+        ss_ray_unit = torch_F.normalize(ss_rays, dim=-1)  # [B,S,3]
+        return ss_idxs, ss_centers, ss_ray_unit
+
+    def render_supersamples(self, ss_centers, ss_ray_unit, sample_idx=None, stratified=False):
+        """Render the supersampled rays (in the same way as the rays in render_rays()).
+        Args:
+            ss_centers (tensor [B,S,3]): Centers of the supersamples.
+            ss_ray_unit (tensor [B,S,3]): Unit ray directions of the supersamples.
+            sample_idx (tensor [B]): Data sample index.
+            stratified (bool): Whether to stratify the depth sampling.
+        Returns:
+            ss_rgb (tensor [B,S,3]): Rendered colors of the supersamples.
+        """
+        with profiler.region("get_dist_bounds", samples=ss_ray_unit), torch.no_grad():
+            ss_near, ss_far, ss_outside = self.get_dist_bounds(ss_centers, ss_ray_unit)
+            ss_near_object, ss_far_object, ss_outside_object = \
+                self.get_object_dist_bounds(ss_centers, ss_ray_unit, ss_near, ss_far, ss_outside)
+        ss_app, ss_app_outside = self.get_appearance_embedding(sample_idx, ss_ray_unit.shape[1])
+        ss_output_object = self.render_rays_object(ss_centers, ss_ray_unit, ss_near_object, ss_far_object,
+                                                   ss_outside_object, ss_app, stratified=stratified)
+        if self.with_background:
+            ss_output_background = self.render_rays_background(ss_centers, ss_ray_unit, ss_far, ss_app_outside,
+                                                               stratified=stratified)
+            # Concatenate object and background samples.
+            ss_rgbs = torch.cat([ss_output_object["rgbs"], ss_output_background["rgbs"]], dim=2)  # [B,S,No+Nb,3]
+            ss_alphas = torch.cat([ss_output_object["alphas"], ss_output_background["alphas"]], dim=2)  # [B,S,No+Nb]
+        else:
+            ss_rgbs = ss_output_object["rgbs"]  # [B,S,No,3]
+            ss_alphas = ss_output_object["alphas"]  # [B,S,No]
+        with profiler.region("compositing", samples=ss_rgbs):
+            ss_weights = render.alpha_compositing_weights(ss_alphas)  # [B,S,No+Nb,1]
+            ss_rgb = render.composite(ss_rgbs, ss_weights)  # [B,S,3]
+            if self.white_background:
+                ss_opacity_all = render.composite(1., ss_weights)  # [B,S,1]
+                ss_rgb = ss_rgb + (1 - ss_opacity_all)
+        return ss_rgb
+
+    def average_supersamples(self, rgb, ss_rgb, ss_idxs):
+        # Average the super samples into their pixels (duplicate indices are accumulated by the scatter).
+        ss_rgb_sum = torch.zeros_like(rgb).scatter_add(1, ss_idxs[..., None].expand_as(ss_rgb), ss_rgb)  # [B,R,3]
+        ss_count = torch.zeros_like(rgb[..., :1]).scatter_add(1, ss_idxs[..., None],
+                                                              torch.ones_like(ss_rgb[..., :1]))  # [B,R,1]
+        rgb = (rgb + ss_rgb_sum) / (1 + ss_count)  # [B,R,3]
+        return rgb
+
+    @torch.no_grad()
+    def render_rays_marching(self, center, ray_unit, sample_idx=None):
+        """Render the rays by marching through the samples in chunks (inference only).
+        The samples are the same as in render_rays(), but after each chunk, the rays whose transmittance falls below
+        render.marching.min_transmittance are terminated and the remaining rays are compacted. Only the composited
+        quantities are returned (no per-sample outputs).
+        Args:
+            center (tensor [B,R,3]): Ray origins.
+            ray_unit (tensor [B,R,3]): Unit ray directions.
+            sample_idx (tensor [B]): Data sample index.
+        Returns:
+            output: A dictionary containing the composited outputs.
+        """
+        cfg_marching = self.cfg_render.marching
+        near, far, outside = self.get_dist_bounds(center, ray_unit)
+        near_object, far_object, outside_object = self.get_object_dist_bounds(center, ray_unit, near, far, outside)
+        # The SDF values and spatial masks from the sampler are reused; only the features are evaluated below.
+        dists, sdfs, masks = self.sample_dists_all(center, ray_unit, near_object, far_object, stratified=False,
+                                                   outside=outside_object, with_sdfs=True)  # [B,R,N,1],[B,R,N,L]
+        dists_next = torch.cat([dists[..., 1:, :], far_object[..., None]], dim=2)  # [B,R,N,1]
+        batch_size, num_rays, num_samples = dists.shape[:3]
+        app, app_outside = self.get_appearance_embedding(sample_idx, num_rays)  # [B,R,N,C],[B,R,Nb,C]
+        # Flatten the rays of all batch elements.
+        center, ray_unit = center.flatten(0, 1), ray_unit.flatten(0, 1)  # [BR,3]
+        far, dists, dists_next = far.flatten(0, 1), dists.flatten(0, 1), dists_next.flatten(0, 1)
+        sdfs, masks = sdfs.flatten(0, 1), masks.flatten(0, 1)  # [BR,N,1],[BR,N,L]
+        app = app.flatten(0, 1) if app is not None else None  # [BR,N,C]
+        app_outside = app_outside.flatten(0, 1) if app_outside is not None else None  # [BR,Nb,C]
+        transmittance = torch.ones_like(far)  # [BR,1]
+        rgb = torch.zeros_like(center)  # [BR,3]
+        dist = torch.zeros_like(far)  # [BR,1]
+        opacity = torch.zeros_like(far)  # [BR,1]
+        gradient = torch.zeros_like(center)  # [BR,3]
+        mask = center.new_zeros(len(center), self.neural_sdf.cfg_sdf.encoding.levels)  # [BR,L]
+        # Rays outside the sphere (or in empty space) do not hit the object.
+        ray_ids = (~outside_object.flatten(0, 1)[:, 0]).nonzero()[:, 0]  # [M]
+        for c in range(0, num_samples, cfg_marching.chunk):
+            if len(ray_ids) == 0:
+                break
+            # Evaluate the chunk of samples for the remaining rays (as a single batch).
+            center_c, ray_unit_c = center[ray_ids][None], ray_unit[ray_ids][None]  # [1,M,3]
+            dists_c = dists[ray_ids, c:c + cfg_marching.chunk][None]  # [1,M,K,1]
+            dist_far_c = dists_next[ray_ids, c + dists_c.shape[2] - 1:c + dists_c.shape[2]][None]  # [1,M,1,1]
+            app_c = app[ray_ids, c:c + cfg_marching.chunk][None] if app is not None else None  # [1,M,K,C]
+            points = camera.get_3D_points_from_dist(center_c, ray_unit_c, dists_c)  # [1,M,K,3]
+            sdfs_c = sdfs[ray_ids, c:c + cfg_marching.chunk][None]  # [1,M,K,1]
+            mask_c = masks[ray_ids, c:c + cfg_marching.chunk][None]  # [1,M,K,L]
+            feats = self.neural_sdf.feat(points, spatial_mask=mask_c)  # [1,M,K,F]
+            gradients, _ = self.neural_sdf.compute_gradients(points, training=False, sdf=sdfs_c)  # [1,M,K,3]
+            normals = torch_F.normalize(gradients, dim=-1)  # [1,M,K,3]
+            rays_unit = ray_unit_c[..., None, :].expand_as(points).contiguous()  # [1,M,K,3]
+            rgbs = self.neural_rgb.forward(points, normals, rays_unit, feats, app=app_c)  # [1,M,K,3]
+            alphas = self.compute_neus_alphas(ray_unit_c, sdfs_c, gradients, dists_c, dist_far=dist_far_c,
+                                              progress=self.progress)  # [1,M,K]
+            weights = render.alpha_compositing_weights(alphas) * transmittance[ray_ids, None]  # [1,M,K,1]
+            transmittance[ray_ids] *= (1 - alphas[0]).prod(dim=-1, keepdim=True)
+            # Accumulate the composited quantities.
+            rgb.index_add_(0, ray_ids, render.composite(rgbs, weights)[0])
+            dist.index_add_(0, ray_ids, render.composite(dists_c, weights)[0])
+            opacity.index_add_(0, ray_ids, render.composite(1., weights)[0])
+            gradient.index_add_(0, ray_ids, render.composite(gradients, weights)[0])
+            mask.index_add_(0, ray_ids, render.composite(mask_c, weights)[0])
+            # Terminate the rays that are (almost) fully occluded.
+            ray_ids = ray_ids[transmittance[ray_ids, 0] > cfg_marching.min_transmittance]
+        opacity_all = opacity.clone()  # [BR,1]
+        if self.with_background:
+            ray_ids = (transmittance[:, 0] > cfg_marching.min_transmittance).nonzero()[:, 0]  # [M]
+            if len(ray_ids) > 0:
+                app_outside_c = app_outside[ray_ids][None] if app_outside is not None else None  # [1,M,Nb,C]
+                output_background = self.render_rays_background(center[ray_ids][None], ray_unit[ray_ids][None],
+                                                                far[ray_ids][None], app_outside_c)
+                weights = render.alpha_compositing_weights(output_background["alphas"]) * \
+                    transmittance[ray_ids, None]  # [1,M,Nb,1]
+                rgb.index_add_(0, ray_ids, render.composite(output_background["rgbs"], weights)[0])
+                dist.index_add_(0, ray_ids, render.composite(output_background["dists"], weights)[0])
+                opacity_all.index_add_(0, ray_ids, render.composite(1., weights)[0])
+        if self.white_background:
+            rgb = rgb + (1 - opacity_all)
+        # Collect output.
+        output = dict(
+            rgb=rgb,  # [BR,3]
+            dist=dist,  # [BR,1]
+            opacity=opacity,  # [BR,1]
+            gradient=gradient,  # [BR,3]
+            mask=mask,  # [BR,L]
+            outside=outside.flatten(0, 1),  # [BR,1]
+        )
+        output = {key: value.view(batch_size, num_rays, *value.shape[1:]) for key, value in output.items()}
+        return output
+
     def render_rays_object(self, center, ray_unit, near, far, outside, app, stratified=False):
-        with torch.no_grad():
-            dists = self.sample_dists_all(center, ray_unit, near, far, stratified=stratified)  # [B,R,N,3]
+        # Without gradients (inference), the SDF values and spatial masks computed by the sampler are reused.
+        reuse_sdfs = not torch.is_grad_enabled()
+        with profiler.region("sample_dists_all", samples=ray_unit), torch.no_grad():
+            if reuse_sdfs:
+                dists, sdfs, mask = self.sample_dists_all(center, ray_unit, near, far, stratified=stratified,
+                                                          outside=outside, with_sdfs=True)  # [B,R,N,1],[B,R,N,L]
+            else:
+                dists = self.sample_dists_all(center, ray_unit, near, far, stratified=stratified,
+                                              outside=outside)  # [B,R,N,1]
         points = camera.get_3D_points_from_dist(center, ray_unit, dists)  # [B,R,N,3]
-        sdfs, feats, mask = self.neural_sdf.forward(points)  # [B,R,N,1],[B,R,N,K]
+        with profiler.region("neural_sdf", samples=points):
+            if reuse_sdfs:
+                feats = self.neural_sdf.feat(points, spatial_mask=mask)  # [B,R,N,K]
+            else:
+                sdfs, feats, mask = self.neural_sdf.forward(points)  # [B,R,N,1],[B,R,N,K],[B,R,N,L]
         #print(sdfs.shape, mask.shape)
         sdfs[outside[..., None].expand_as(sdfs)] = self.outside_val
         # Compute 1st- and 2nd-order gradients.
         rays_unit = ray_unit[..., None, :].expand_as(points).contiguous()  # [B,R,N,3]
-        gradients, hessians = self.neural_sdf.compute_gradients(points, training=self.training, sdf=sdfs)
+        with profiler.region("compute_gradients", samples=points):
+            gradients, hessians = self.neural_sdf.compute_gradients(points, training=self.training, sdf=sdfs)
         normals = torch_F.normalize(gradients, dim=-1)  # [B,R,N,3]
-        rgbs = self.neural_rgb.forward(points, normals, rays_unit, feats, app=app)  # [B,R,N,3]
+        with profiler.region("neural_rgb", samples=points):
+            rgbs = self.neural_rgb.forward(points, normals, rays_unit, feats, app=app)  # [B,R,N,3]
         # SDF volume rendering.
         alphas = self.compute_neus_alphas(ray_unit, sdfs, gradients, dists, dist_far=far[..., None],
                                           progress=self.progress)  # [B,R,N]
@@ -422,7 +578,8 @@ class Model(BaseModel):
             dists = self.sample_dists_background(ray_unit, far, stratified=stratified)
         points = camera.get_3D_points_from_dist(center, ray_unit, dists)  # [B,R,N,3]
         rays_unit = ray_unit[..., None, :].expand_as(points)  # [B,R,N,3]
-        rgbs, densities = self.background_nerf.forward(points, rays_unit, app_outside)  # [B,R,N,3]
+        with profiler.region("background_nerf", samples=points):
+            rgbs, densities = self.background_nerf.forward(points, rays_unit, app_outside)  # [B,R,N,3]
         alphas = render.volume_rendering_alphas_dist(densities, dists)  # [B,R,N]
         # Collect output.
         output = dict(
@@ -440,6 +597,15 @@ class Model(BaseModel):
         dist_near[outside], dist_far[outside] = 1, 1.2  # Dummy distances. Density will be set to 0.
         return dist_near, dist_far, outside
 
+    @torch.no_grad()
+    def get_object_dist_bounds(self, center, ray_unit, near, far, outside):
+        # Skip the empty space along the rays with the occupancy grid (if available). Rays that do not pass through
+        # any occupied cell are treated the same way as the rays outside the sphere.
+        if self.occupancy_grid is None or not self.occupancy_grid.initialized:
+            return near, far, outside
+        near, far, empty = self.occupancy_grid.get_ray_bounds(center, ray_unit, near, far)
+        return near, far, outside | empty
+
     def get_appearance_embedding(self, sample_idx, num_rays):
         if self.with_appear_embed:
             # Object appearance embedding.
@@ -458,23 +624,73 @@ class Model(BaseModel):
         return app, app_outside
 
     @torch.no_grad()
-    def sample_dists_all(self, center, ray_unit, near, far, stratified=False):
-        dists = nerf_util.sample_dists(ray_unit.shape[:2], dist_range=(near[..., None], far[..., None]),
-                                       intvs=self.cfg_render.num_samples.coarse, stratified=stratified)
-        if self.cfg_render.num_sample_hierarchy > 0:
-            points = camera.get_3D_points_from_dist(center, ray_unit, dists)  # [B,R,N,3]
-            sdfs = self.neural_sdf.sdf(points)  # [B,R,N]
+    def sample_dists_all(self, center, ray_unit, near, far, stratified=False, outside=None, with_sdfs=False):
+        """Sample the distances along the rays (coarse samples + hierarchical fine samples).
+        Args:
+            center (tensor [B,R,3]): Ray origins.
+            ray_unit (tensor [B,R,3]): Unit ray directions.
+            near (tensor [B,R,1]): Near bounds of the rays.
+            far (tensor [B,R,1]): Far bounds of the rays.
+            stratified (bool): Whether to stratify the coarse samples.
+            outside (tensor [B,R,1]): Rays to skip (only used with the occupancy grid).
+            with_sdfs (bool): Also evaluate the last fine level and return the SDF values and spatial masks of all
+                              the samples (sorted alongside the distances), so they can be reused without gradients.
+        Returns:
+            dists (tensor [B,R,N,1]): Sorted sample distances.
+            sdfs (tensor [B,R,N,1]): SDF values of the samples (only if with_sdfs).
+            masks (tensor [B,R,N,L]): Spatial masks of the samples (only if with_sdfs).
+        """
+        # With the occupancy grid, the SDF is only evaluated on the rays that are not masked out.
+        skip = outside if self.occupancy_grid is not None else None
+        with profiler.region("coarse", samples=ray_unit):
+            dists = nerf_util.sample_dists(ray_unit.shape[:2], dist_range=(near[..., None], far[..., None]),
+                                           intvs=self.cfg_render.num_samples.coarse, stratified=stratified,
+                                           device=ray_unit.device)
+            if self.cfg_render.num_sample_hierarchy > 0 or with_sdfs:
+                points = camera.get_3D_points_from_dist(center, ray_unit, dists)  # [B,R,N,3]
+                sdfs, masks = self.get_sdf_samples(points, skip=skip, with_mask=with_sdfs)  # [B,R,N,1],[B,R,N,L]/None
         for h in range(self.cfg_render.num_sample_hierarchy):
-            dists_fine = self.sample_dists_hierarchical(dists, sdfs, inv_s=(64 * 2 ** h))  # [B,R,Nf,1]
-            dists = torch.cat([dists, dists_fine], dim=2)  # [B,R,N+Nf,1]
-            dists, sort_idx = dists.sort(dim=2)
-            if h != self.cfg_render.num_sample_hierarchy - 1:
-                points_fine = camera.get_3D_points_from_dist(center, ray_unit, dists_fine)  # [B,R,Nf,3]
-                sdfs_fine = self.neural_sdf.sdf(points_fine)  # [B,R,Nf]
-                sdfs = torch.cat([sdfs, sdfs_fine], dim=2)  # [B,R,N+Nf]
-                sdfs = sdfs.gather(dim=2, index=sort_idx.expand_as(sdfs))  # [B,R,N+Nf,1]
+            with profiler.region(f"fine_{h}", samples=ray_unit):
+                dists_fine = self.sample_dists_hierarchical(dists, sdfs, inv_s=(64 * 2 ** h))  # [B,R,Nf,1]
+                dists = torch.cat([dists, dists_fine], dim=2)  # [B,R,N+Nf,1]
+                dists, sort_idx = dists.sort(dim=2)
+                if h != self.cfg_render.num_sample_hierarchy - 1 or with_sdfs:
+                    points_fine = camera.get_3D_points_from_dist(center, ray_unit, dists_fine)  # [B,R,Nf,3]
+                    sdfs_fine, masks_fine = self.get_sdf_samples(points_fine, skip=skip, with_mask=with_sdfs)
+                    sdfs = torch.cat([sdfs, sdfs_fine], dim=2)  # [B,R,N+Nf]
+                    sdfs = sdfs.gather(dim=2, index=sort_idx.expand_as(sdfs))  # [B,R,N+Nf,1]
+                    if with_sdfs:
+                        masks = torch.cat([masks, masks_fine], dim=2)  # [B,R,N+Nf,L]
+                        masks = masks.gather(dim=2, index=sort_idx.expand_as(masks))  # [B,R,N+Nf,L]
+        if with_sdfs:
+            return dists, sdfs, masks
         return dists
 
+    @torch.no_grad()
+    def get_sdf_samples(self, points, skip=None, with_mask=False):
+        """Evaluate the SDF (and optionally the spatial mask) of the sampled points.
+        Args:
+            points (tensor [B,R,N,3]): Sampled points.
+            skip (tensor [B,R,1]): Rays to skip; they get the SDF value of empty space (and a zero mask).
+            with_mask (bool): Also return the spatial mask.
+        Returns:
+            sdfs (tensor [B,R,N,1]): SDF values.
+            masks (tensor [B,R,N,L]): Spatial masks (None if not with_mask).
+        """
+        if skip is None:
+            if with_mask:
+                return self.neural_sdf.sdf_with_mask(points)
+            return self.neural_sdf.sdf(points), None
+        # Only evaluate the rays that are not skipped.
+        active = ~skip[..., 0]  # [B,R]
+        sdfs = torch.full_like(points[..., :1], self.outside_val)  # [B,R,N,1]
+        if with_mask:
+            masks = points.new_zeros(*points.shape[:-1], self.neural_sdf.cfg_sdf.encoding.levels)  # [B,R,N,L]
+            sdfs[active], masks[active] = self.neural_sdf.sdf_with_mask(points[active])  # [M,N,1],[M,N,L]
+            return sdfs, masks
+        sdfs[active] = self.neural_sdf.sdf(points[active])  # [M,N,1]
+        return sdfs, None
+
     def sample_dists_hierarchical(self, dists, sdfs, inv_s, robust=True, eps=1e-5):
         sdfs = sdfs[..., 0]  # [B,R,N]
         prev_sdfs, next_sdfs = sdfs[..., :-1], sdfs[..., 1:]  # [B,R,N-1]
@@ -496,7 +712,8 @@ class Model(BaseModel):
 
     def sample_dists_background(self, ray_unit, far, stratified=False, eps=1e-5):
         inv_dists = nerf_util.sample_dists(ray_unit.shape[:2], dist_range=(1, 0),
-                                           intvs=self.cfg_render.num_samples.background, stratified=stratified)
+                                           intvs=self.cfg_render.num_samples.background, stratified=stratified,
+                                           device=ray_unit.device)
         dists = far[..., None] / (inv_dists + eps)  # [B,R,N,1]
         return dists
 
@@ -619,9 +836,7 @@ class OldModel(BaseModel):
         return output
 
     def render_pixels(self, pose, intr, image_size, stratified=False, sample_idx=None, ray_idx=None):
-        center, ray = camera.get_center_and_ray(pose, intr, image_size)  # [B,HW,3]
-        center = nerf_util.slice_by_ray_idx(center, ray_idx)  # [B,R,3]
-        ray = nerf_util.slice_by_ray_idx(ray, ray_idx)  # [B,R,3]
+        center, ray = camera.get_center_and_ray_by_idx(pose, intr, image_size, ray_idx)  # [B,R,3]
         ray_unit = torch_F.normalize(ray, dim=-1)  # [B,R,3]
         output = self.render_rays(center, ray_unit, sample_idx=sample_idx, stratified=stratified)
         return output
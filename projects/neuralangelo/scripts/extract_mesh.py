@@ -11,6 +11,7 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 '''
 
 import argparse
+import hashlib
 import json
 import os
 import sys
@@ -22,7 +23,9 @@ from imaginaire.config import Config, recursive_update_strict, parse_cmdline_arg
 from imaginaire.utils.distributed import init_dist, get_world_size, is_master, master_only_print as print  # noqa: E402
 from imaginaire.utils.gpu_affinity import set_affinity  # noqa: E402
 from imaginaire.trainers.utils.get_trainer import get_trainer  # noqa: E402
-from projects.neuralangelo.utils.mesh import extract_mesh, extract_texture  # noqa: E402
+from projects.neuralangelo.utils.decimation import export_mesh_lods  # noqa: E402
+from projects.neuralangelo.utils.mesh import SDFVolume, extract_mesh, extract_normals, extract_texture, \
+    get_sdf_gradients, refine_vertices  # noqa: E402
 
 
 def parse_args():
@@ -33,10 +36,44 @@ def parse_args():
     parser.add_argument('--single_gpu', action='store_true')
     parser.add_argument("--resolution", default=512, type=int, help="Marching cubes resolution")
     parser.add_argument("--block_res", default=64, type=int, help="Block-wise resolution for marching cubes")
+    parser.add_argument("--method", default="marching_cubes", choices=["marching_cubes", "surface_nets"],
+                        help="Mesh extraction method. Surface nets place a vertex per lattice cell, which is refined "
+                             "onto the surface, so a 2-4x lower resolution gives a similar accuracy")
+    parser.add_argument("--refine_steps", default=None, type=int,
+                        help="Newton steps refining the vertices onto the surface with the SDF gradients "
+                             "(default: 4 for surface nets, 0 for marching cubes)")
+    parser.add_argument("--sharp_features", action="store_true",
+                        help="Place the refined vertices on the sharp features (as in dual contouring)")
+    parser.add_argument("--sparse", action="store_true",
+                        help="Evaluate the SDF coarse-to-fine, only refining the blocks near the surface")
+    parser.add_argument("--coarse_stride", default=16, type=int, help="Coarsest stride of the sparse evaluation")
+    parser.add_argument("--lipschitz", default=2., type=float,
+                        help="Lipschitz bound of the SDF for the narrow band of the sparse evaluation")
+    parser.add_argument("--num_workers", default=8, type=int, help="Number of marching cubes processes")
+    parser.add_argument("--out_of_core", action="store_true",
+                        help="Stream the mesh blocks to disk instead of holding the whole mesh in memory")
     parser.add_argument("--output_file", default="mesh.ply", type=str, help="Output file name")
+    parser.add_argument("--job_dir", default=None, type=str,
+                        help="Save the completed blocks to this directory so that an interrupted run can be resumed")
+    parser.add_argument("--shard", default="0/1", type=str,
+                        help="Only process the blocks of shard i/n (with --job_dir); the run without sharding "
+                             "assembles the output file")
+    parser.add_argument("--sdf_cache_dir", default=None, type=str,
+                        help="Save the evaluated SDF volume under this directory (keyed by the checkpoint and the "
+                             "lattice), or reuse it if it already exists (see scripts/remesh.py)")
     parser.add_argument("--textured", action="store_true", help="Export mesh with texture")
+    parser.add_argument("--appearance", default="zero", type=str,
+                        help="Appearance embedding for the texture: zero, mean or an image index")
+    parser.add_argument("--texture_batch_size", default=2 ** 18, type=int,
+                        help="Number of vertices per batch of the texture network")
     parser.add_argument("--keep_lcc", action="store_true",
                         help="Keep only largest connected component. May remove thin structures.")
+    parser.add_argument("--lods", default=None, type=float, nargs="+",
+                        help="Decimate the mesh into LOD levels (ratios of the faces to keep, or face counts), "
+                             "e.g. 1 0.25 0.05; the levels after the first are saved as {output}_lod{level}.ply")
+    parser.add_argument("--feature_normals", action="store_true",
+                        help="Preserve the sharp features when decimating with the SDF gradients")
+    parser.add_argument("--feature_weight", default=1., type=float, help="Weight of the feature preservation")
     parser.add_argument("--bounds_x", nargs="*", type=float, default = None)
     parser.add_argument("--bounds_y", nargs="*", type=float, default = None)  
     parser.add_argument("--bounds_z", nargs="*", type=float, default = None)
@@ -45,10 +82,27 @@ def parse_args():
     return args, cfg_cmd
 
 
+def get_sdf_cache_path(args, bounds):
+    # The SDF volume only depends on the checkpoint and the lattice grid.
+    sha1 = hashlib.sha1()
+    if args.checkpoint:
+        with open(args.checkpoint, "rb") as file:
+            for chunk in iter(lambda: file.read(2 ** 24), b""):
+                sha1.update(chunk)
+    lattice = json.dumps(dict(bounds=np.asarray(bounds, dtype=float).tolist(), resolution=args.resolution,
+                              block_res=args.block_res, sparse=args.sparse))
+    lattice_hash = hashlib.sha1(lattice.encode()).hexdigest()[:8]
+    return os.path.join(args.sdf_cache_dir, f"{sha1.hexdigest()[:16]}_res{args.resolution}_{lattice_hash}")
+
+
 def main():
     args, cfg_cmd = parse_args()
     set_affinity(args.local_rank)
     cfg = Config(args.config)
+    if args.lods is not None and (args.out_of_core or args.job_dir is not None):
+        raise ValueError("Decimation (--lods) is not supported for out-of-core extraction.")
+    if args.method == "surface_nets" and args.sdf_cache_dir is not None:
+        raise ValueError("The SDF cache (--sdf_cache_dir) is not supported for surface nets.")
 
     cfg_cmd = parse_cmdline_arguments(cfg_cmd)
     recursive_update_strict(cfg, cfg_cmd)
@@ -103,31 +157,67 @@ def main():
     sdf_func = lambda x: -trainer.model_module.neural_sdf.sdf(x)  # noqa: E731
     texture_func = partial(extract_texture, neural_sdf=trainer.model_module.neural_sdf,
                            neural_rgb=trainer.model_module.neural_rgb,
-                           appear_embed=trainer.model_module.appear_embed) if args.textured else None
-    mesh = extract_mesh(sdf_func=sdf_func, bounds=bounds, intv=(2.0 / args.resolution),
-                        block_res=args.block_res, texture_func=texture_func, filter_lcc=args.keep_lcc)
+                           appear_embed=trainer.model_module.appear_embed,
+                           appearance=args.appearance) if args.textured else None
+    # Center and scale the extracted vertices.
+    vertex_transform = np.eye(4)
+    vertex_transform[:3, :3] *= meta["sphere_radius"]
+    vertex_transform[:3, 3] = meta["sphere_center"]
+    if args.normalize:
+        scale_mat = np.load(f"{cfg.data.root}/cameras_sphere.npz")['scale_mat_0']
+        vertex_transform = scale_mat @ vertex_transform
+    save_sdf, sdf_volume = None, None
+    if args.sdf_cache_dir is not None:
+        sdf_cache_path = get_sdf_cache_path(args, bounds)
+        if SDFVolume.exists(sdf_cache_path):
+            print(f"Reading the SDF from {sdf_cache_path}")
+            sdf_volume = SDFVolume(sdf_cache_path)
+        else:
+            print(f"Saving the SDF to {sdf_cache_path}")
+            save_sdf = sdf_cache_path
+    device = next(trainer.model_module.parameters()).device
+    refine_steps = args.refine_steps if args.refine_steps is not None else 4 if args.method == "surface_nets" else 0
+    refine_func = None
+    if refine_steps > 0:
+        # The Newton steps are the same for the negated SDF.
+        sdf_grad_func = partial(get_sdf_gradients, neural_sdf=trainer.model_module.neural_sdf)
+        refine_func = partial(refine_vertices, sdf_grad_func=sdf_grad_func, max_dist=2.0 / args.resolution,
+                              num_steps=refine_steps, sharp_features=args.sharp_features,
+                              batch_size=args.texture_batch_size, device=device)
+    kwargs = dict(texture_func=texture_func, filter_lcc=args.keep_lcc, sparse=args.sparse,
+                  coarse_stride=args.coarse_stride, lipschitz=args.lipschitz, num_workers=args.num_workers,
+                  texture_batch_size=args.texture_batch_size, vertex_transform=vertex_transform, save_sdf=save_sdf,
+                  sdf_volume=sdf_volume, method=args.method, refine_func=refine_func, device=device)
+    # The settings of the texture and refinement functions have to match when resuming a job.
+    job_extra_args = dict(appearance=args.appearance if args.textured else None, refine_steps=refine_steps,
+                          sharp_features=args.sharp_features and refine_steps > 0)
+    if args.out_of_core or args.job_dir is not None:
+        shard = tuple(int(value) for value in args.shard.split("/"))
+        extract_mesh(sdf_func=sdf_func, bounds=bounds, intv=(2.0 / args.resolution), block_res=args.block_res,
+                     output_file=args.output_file, job_dir=args.job_dir, shard=shard, job_extra_args=job_extra_args,
+                     **kwargs)
+        return
+    mesh = extract_mesh(sdf_func=sdf_func, bounds=bounds, intv=(2.0 / args.resolution), block_res=args.block_res,
+                        **kwargs)
 
     if is_master():
         print(f"vertices: {len(mesh.vertices)}")
         print(f"faces: {len(mesh.faces)}")
         if args.textured:
             print(f"colors: {len(mesh.visual.vertex_colors)}")
-        # center and scale
-        mesh.vertices = mesh.vertices * meta["sphere_radius"] + np.array(meta["sphere_center"])
         mesh.update_faces(mesh.nondegenerate_faces())
-        #os.makedirs(os.path.dirname(args.output_file), exist_ok=True)
-        #print("world coord")
-        #print(mesh.vertices)
-        #print("{cfg.data.root}")
-        if args.normalize:
-            scale_mat = np.load(f"{cfg.data.root}/cameras_sphere.npz")['scale_mat_0']
-
-        
-        #print("still normalized")
-            mesh.apply_transform(scale_mat)
-        
-        #print(mesh.vertices)
-        mesh.export(args.output_file)
+        if args.lods is None:
+            mesh.export(args.output_file)
+            return
+        vertex_normals = None
+        if args.feature_normals:
+            # Query the SDF gradients in the normalized coordinates.
+            vertices = (mesh.vertices - vertex_transform[:3, 3]) @ np.linalg.inv(vertex_transform[:3, :3]).T
+            neural_sdf, batch_size = trainer.model_module.neural_sdf, args.texture_batch_size
+            vertex_normals = np.concatenate([extract_normals(vertices[i:i + batch_size], neural_sdf)
+                                             for i in range(0, len(vertices), batch_size)])
+        export_mesh_lods(mesh, args.output_file, args.lods, vertex_normals=vertex_normals,
+                         feature_weight=args.feature_weight)
 
 
 if __name__ == "__main__":
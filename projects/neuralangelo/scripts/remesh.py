@@ -0,0 +1,69 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import argparse
+import os
+import sys
+
+sys.path.append(os.getcwd())
+from projects.neuralangelo.utils.decimation import export_mesh_lods  # noqa: E402
+from projects.neuralangelo.utils.mesh import SDFVolume, extract_mesh  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Mesh extraction from a saved SDF volume (no model or GPU needed)")
+    parser.add_argument("--sdf_volume", required=True, type=str,
+                        help="SDF volume directory (saved by extract_mesh.py with --sdf_cache_dir)")
+    parser.add_argument("--output_file", default="mesh.ply", type=str, help="Output file name")
+    parser.add_argument("--level", default=0., type=float,
+                        help="Level of the SDF to extract (>0 dilates the surface). The SDF of a sparse volume is "
+                             "only exact within a narrow band around the zero level set")
+    parser.add_argument("--bounds_x", nargs=2, type=float, default=[-1., 1.], help="Crop bounds (normalized)")
+    parser.add_argument("--bounds_y", nargs=2, type=float, default=[-1., 1.], help="Crop bounds (normalized)")
+    parser.add_argument("--bounds_z", nargs=2, type=float, default=[-1., 1.], help="Crop bounds (normalized)")
+    parser.add_argument("--keep_lcc", action="store_true",
+                        help="Keep only largest connected component. May remove thin structures.")
+    parser.add_argument("--lods", default=None, type=float, nargs="+",
+                        help="Decimate the mesh into LOD levels (ratios of the faces to keep, or face counts), "
+                             "e.g. 1 0.25 0.05; the levels after the first are saved as {output}_lod{level}.ply")
+    parser.add_argument("--num_workers", default=8, type=int, help="Number of marching cubes processes")
+    parser.add_argument("--out_of_core", action="store_true",
+                        help="Stream the mesh blocks to disk instead of holding the whole mesh in memory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    sdf_volume = SDFVolume(args.sdf_volume)
+    lattice_args = sdf_volume.lattice_args
+    print(f"Read the index of {len(sdf_volume)} SDF blocks from {args.sdf_volume}")
+    # The saved SDF is negated (positive inside) for marching cubes.
+    kwargs = dict(block_res=lattice_args["block_res"], filter_lcc=args.keep_lcc, num_workers=args.num_workers,
+                  device="cpu", level=-args.level, crop_bounds=[args.bounds_x, args.bounds_y, args.bounds_z],
+                  vertex_transform=sdf_volume.vertex_transform, sdf_volume=sdf_volume)
+    if args.out_of_core:
+        if args.lods is not None:
+            raise ValueError("Decimation (--lods) is not supported for out-of-core extraction.")
+        extract_mesh(None, lattice_args["bounds"], lattice_args["intv"], output_file=args.output_file, **kwargs)
+        return
+    mesh = extract_mesh(None, lattice_args["bounds"], lattice_args["intv"], **kwargs)
+    print(f"vertices: {len(mesh.vertices)}")
+    print(f"faces: {len(mesh.faces)}")
+    mesh.update_faces(mesh.nondegenerate_faces())
+    if args.lods is None:
+        mesh.export(args.output_file)
+    else:
+        export_mesh_lods(mesh, args.output_file, args.lods)
+
+
+if __name__ == "__main__":
+    main()
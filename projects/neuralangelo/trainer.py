@@ -14,9 +14,11 @@ import torch
 import torch.nn.functional as torch_F
 import wandb
 
+from imaginaire.datasets.utils.get_dataloader import _get_train_dataset_objects
 from imaginaire.utils.distributed import master_only
 from imaginaire.utils.visualization import wandb_image
 from projects.nerf.trainers.base import BaseTrainer
+from projects.neuralangelo.data import RayBatchLoader
 from projects.neuralangelo.utils.misc import get_scheduler, eikonal_loss, curvature_loss, mask_loss
 import matplotlib.cm as cm
 
@@ -32,6 +34,15 @@ class Trainer(BaseTrainer):
             self.c2f_step = cfg.model.object.sdf.encoding.coarse2fine.step
             self.model.module.neural_sdf.warm_up_end = self.warm_up_end
 
+    def set_data_loader(self, cfg, split, shuffle=True, drop_last=True, seed=0):
+        if split == "train" and cfg.data.ray_batch.enabled:
+            # Sample the rays of each step across many images directly on the GPU (no data loader workers).
+            dataset = _get_train_dataset_objects(cfg)
+            self.train_data_loader = RayBatchLoader(dataset, cfg.data.ray_batch, device="cuda",
+                                                    sync_free=cfg.trainer.sync_free)
+        else:
+            super().set_data_loader(cfg, split, shuffle=shuffle, drop_last=drop_last, seed=seed)
+
     def _init_loss(self, cfg):
         self.criteria["render"] = torch.nn.L1Loss()
 
@@ -44,8 +55,18 @@ class Trainer(BaseTrainer):
     def _compute_loss(self, data, mode=None):
         if mode == "train":
             # Compute loss only on randomly sampled rays.
-            self.losses["render"] = self.criteria["render"](data["rgb"], data["image_sampled"]) * 3  # FIXME:sumRGB?!
-            self.metrics["psnr"] = -10 * torch_F.mse_loss(data["rgb"], data["image_sampled"]).log10()
+            if "ray_weight" in data:
+                # Importance-sampled rays: reweight to keep the loss (and PSNR) unbiased w.r.t. uniform sampling.
+                residual = (data["rgb"] - data["image_sampled"]).abs()  # [B,R,3]
+                ray_weight = data["ray_weight"][..., None]  # [B,R,1]
+                self.losses["render"] = (residual * ray_weight).mean() * 3
+                self.metrics["psnr"] = -10 * (residual ** 2 * ray_weight).mean().log10()
+                self.train_data_loader.dataset.pixel_sampler.update(data["idx"], data["ray_idx"],
+                                                                    residual.detach().mean(dim=-1))
+            else:
+                rgb, image_sampled = data["rgb"], data["image_sampled"]
+                self.losses["render"] = self.criteria["render"](rgb, image_sampled) * 3  # FIXME:sumRGB?!
+                self.metrics["psnr"] = -10 * torch_F.mse_loss(rgb, image_sampled).log10()
             if "eikonal" in self.weights.keys():
                 self.losses["eikonal"] = eikonal_loss(data["gradients"], outside=data["outside"])
             if "curvature" in self.weights:
@@ -95,6 +116,12 @@ class Trainer(BaseTrainer):
         if self.cfg.model.object.s_var.scheduled:
             model.set_svar()
 
+        if model.occupancy_grid is not None:
+            cfg_occupancy = self.cfg.model.render.occupancy
+            if current_iteration >= cfg_occupancy.warm_up_iter and \
+                    (current_iteration % cfg_occupancy.update_iter == 0 or not model.occupancy_grid.initialized):
+                model.update_occupancy_grid()
+
         return super()._start_of_iteration(data, current_iteration)
 
     @master_only
@@ -0,0 +1,378 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import os
+
+import numpy as np
+import trimesh
+
+from projects.neuralangelo.utils.mesh import filter_vertices
+
+# Coefficients of the (symmetric) 4x4 quadric matrices, stored as their upper triangle [10,...].
+_QUADRIC_INDICES = [(0, 0), (0, 1), (0, 2), (0, 3), (1, 1), (1, 2), (1, 3), (2, 2), (2, 3), (3, 3)]
+
+
+def decimate_mesh(vertices, faces, targets, vertex_attrs=(), vertex_normals=None, feature_weight=1.,
+                  boundary_weight=10., length_weight=1e-6, max_candidate_ratio=0.25, min_normal_dot=0.2):
+    """Quadric error decimation by batched edge collapses. Each round, the cheapest edges (by quadric error) are
+    collapsed in parallel: an edge is only collapsed if it is the cheapest candidate within the 1-ring of its
+    vertices, so that the collapses of a round never share a face. The collapses that would make the mesh non-manifold
+    (link condition) or flip a face are skipped until the next round. The mesh is yielded for each target face count,
+    so that a LOD pyramid is decimated in a single pass.
+    Args:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        targets (list of int): Target face counts (in decreasing order).
+        vertex_attrs (list of np.ndarray [V,...]): Per-vertex attributes (e.g. colors), kept from the surviving vertex.
+        vertex_normals (np.ndarray [V,3]): Surface normals (e.g. SDF gradients) preserving the sharp features: the
+                                           vertices are also kept close to their tangent planes.
+        feature_weight (float): Weight of the tangent planes of the vertex normals (relative to the face planes).
+        boundary_weight (float): Weight of the planes preserving the mesh boundaries.
+        length_weight (float): Weight of the (fourth power of the) edge lengths added to the collapse errors, which
+                               collapses the shorter edges first where the quadric errors are (nearly) equal.
+        max_candidate_ratio (float): Maximum ratio of the edges considered for collapsing in each round.
+        min_normal_dot (float): Minimum cosine between the normals of a face before and after a collapse.
+    Returns:
+        lods (generator): The decimated vertices [V',3], faces [F',3] and vertex attributes for each target.
+    """
+    vertices = vertices.astype(np.float64)
+    faces = faces.astype(np.int64)
+    num_vertices = len(vertices)
+    quadrics = get_vertex_quadrics(vertices, faces, vertex_normals=vertex_normals, feature_weight=feature_weight,
+                                   boundary_weight=boundary_weight)
+    vertex_attrs = [attr.copy() for attr in vertex_attrs]
+    targets = list(targets)
+    candidate_scale = 1
+    while targets:
+        if len(faces) <= targets[0]:
+            targets.pop(0)
+            yield compact_mesh(vertices, faces, *vertex_attrs)
+            continue
+        edges, num_edge_faces = get_edges(faces, num_vertices)  # [E,2],[E]
+        boundary = np.zeros(num_vertices, dtype=bool)
+        boundary[edges[num_edge_faces == 1]] = True
+        # Non-manifold edges and interior edges between boundary vertices cannot be collapsed.
+        collapsible = (num_edge_faces <= 2) & ~((num_edge_faces == 2) & boundary[edges].all(axis=-1))
+        candidates = np.flatnonzero(collapsible)
+        num_collapsible = len(candidates)
+        errors = get_collapse_errors(quadrics, vertices, edges[candidates])
+        lengths = np.linalg.norm(vertices[edges[candidates, 0]] - vertices[edges[candidates, 1]], axis=-1)
+        errors += length_weight * lengths ** 4
+        num_candidates = min(num_collapsible, candidate_scale * max((len(faces) - targets[0]) // 2, 1),
+                             candidate_scale * max(int(len(edges) * max_candidate_ratio), 1))
+        cheapest = np.argpartition(errors, num_candidates - 1)[:num_candidates] if num_candidates > 0 else []
+        candidates, errors = candidates[cheapest], errors[cheapest]
+        selected = select_independent_edges(edges, edges[candidates], errors, num_vertices)
+        max_error = errors.max(initial=0.)
+        candidates = candidates[selected]
+        valid = check_link_condition(edges, edges[candidates], num_edge_faces[candidates], num_vertices)
+        # Fall back to the next best positions (within the error bound of this round) when a collapse flips a face.
+        options, option_errors = get_collapse_options(quadrics, vertices, edges[candidates])
+        lengths = np.linalg.norm(vertices[edges[candidates, 0]] - vertices[edges[candidates, 1]], axis=-1)
+        option_errors[option_errors + length_weight * lengths ** 4 > max_error] = np.inf
+        option_order = np.argsort(option_errors, axis=0, kind="stable")  # [4,C]
+        positions = np.empty((len(candidates), 3))
+        flipped = np.ones(len(candidates), dtype=bool)
+        for option in option_order:
+            index = np.flatnonzero(flipped & valid & np.isfinite(option_errors[option, np.arange(len(candidates))]))
+            positions[index] = options[option[index], :, index]
+            flipped[index] = check_face_flips(vertices, faces, edges[candidates[index]], positions[index],
+                                              min_normal_dot=min_normal_dot)
+        valid &= ~flipped
+        if not valid.any():
+            if num_candidates < num_collapsible:
+                # Consider more expensive collapses.
+                candidate_scale *= 2
+                continue
+            # The mesh cannot be decimated any further.
+            for _ in targets:
+                yield compact_mesh(vertices, faces, *vertex_attrs)
+            return
+        candidate_scale = 1
+        (keep_idx, remove_idx), positions = edges[candidates[valid]].T, positions[valid]
+        vertices[keep_idx] = positions
+        quadrics[:, keep_idx] += quadrics[:, remove_idx]
+        remap = np.arange(num_vertices)
+        remap[remove_idx] = keep_idx
+        faces = remap[faces]
+        faces = faces[(faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 2] != faces[:, 0])]
+
+
+def get_edges(faces, num_vertices):
+    """Get the unique (undirected) edges of a mesh.
+    Args:
+        faces (np.ndarray [F,3]): Mesh faces.
+        num_vertices (int): Number of vertices.
+    Returns:
+        edges (np.ndarray [E,2]): The edges (sorted vertex indices).
+        num_edge_faces (np.ndarray [E]): Number of faces adjacent to each edge (1 on the boundaries).
+    """
+    half_edges = np.sort(np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]]), axis=-1)  # [3F,2]
+    keys, num_edge_faces = np.unique(half_edges[:, 0] * num_vertices + half_edges[:, 1], return_counts=True)
+    edges = np.stack([keys // num_vertices, keys % num_vertices], axis=-1)
+    return edges, num_edge_faces
+
+
+def get_plane_quadrics(normals, points, weights):
+    """Weighted quadrics (squared distance) of the planes through the points with the given (unit) normals.
+    Args:
+        normals (np.ndarray [N,3]): Plane normals.
+        points (np.ndarray [N,3]): Points on the planes.
+        weights (np.ndarray [N]): Weights of the quadrics.
+    Returns:
+        quadrics (np.ndarray [10,N]): The quadrics.
+    """
+    planes = np.concatenate([normals, -(normals * points).sum(axis=-1, keepdims=True)], axis=-1).T  # [4,N]
+    return np.stack([planes[i] * planes[j] * weights for i, j in _QUADRIC_INDICES])
+
+
+def get_vertex_quadrics(vertices, faces, vertex_normals=None, feature_weight=1., boundary_weight=10.):
+    """Accumulate the (area-weighted) quadrics of the face planes around each vertex, of the planes orthogonal to the
+    boundary edges and (optionally) of the tangent planes of the vertex normals.
+    Args:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        vertex_normals (np.ndarray [V,3]): Surface normals (None to only use the face planes).
+        feature_weight (float): Weight of the tangent planes of the vertex normals.
+        boundary_weight (float): Weight of the boundary planes.
+    Returns:
+        quadrics (np.ndarray [10,V]): The vertex quadrics.
+    """
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    face_normals = np.cross(v1 - v0, v2 - v0)
+    areas = np.linalg.norm(face_normals, axis=-1) / 2
+    face_normals /= np.maximum(areas * 2, 1e-20)[:, None]
+    face_quadrics = get_plane_quadrics(face_normals, v0, areas)  # [10,F]
+    quadrics = accumulate_quadrics(len(vertices), faces, face_quadrics)
+    # Boundary edges (with a single face) are constrained by the plane through the edge orthogonal to the face.
+    half_edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]], faces[:, [2, 0]]])  # [3F,2]
+    keys = half_edges.min(axis=-1) * len(vertices) + half_edges.max(axis=-1)
+    _, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    boundary = np.flatnonzero(counts[inverse] == 1)
+    if len(boundary) > 0:
+        edge_vectors = vertices[half_edges[boundary, 1]] - vertices[half_edges[boundary, 0]]
+        normals = np.cross(edge_vectors, face_normals[boundary % len(faces)])
+        normals /= np.maximum(np.linalg.norm(normals, axis=-1, keepdims=True), 1e-20)
+        weights = boundary_weight * (edge_vectors ** 2).sum(axis=-1)
+        boundary_quadrics = get_plane_quadrics(normals, vertices[half_edges[boundary, 0]], weights)
+        quadrics += accumulate_quadrics(len(vertices), half_edges[boundary], boundary_quadrics)
+    if vertex_normals is not None:
+        vertex_areas = np.bincount(faces.reshape(-1), weights=np.repeat(areas / 3, 3), minlength=len(vertices))
+        normals = vertex_normals / np.maximum(np.linalg.norm(vertex_normals, axis=-1, keepdims=True), 1e-20)
+        quadrics += get_plane_quadrics(normals, vertices, feature_weight * vertex_areas)
+    return quadrics
+
+
+def accumulate_quadrics(num_vertices, indices, quadrics):
+    # Sum the quadrics [10,N] of the elements (faces or edges [N,K]) at each of their vertices.
+    repeats = indices.shape[1]
+    indices = indices.reshape(-1)
+    return np.stack([np.bincount(indices, weights=np.repeat(quadric, repeats), minlength=num_vertices)
+                     for quadric in quadrics])
+
+
+def get_quadric_errors(quadrics, points):
+    """Evaluate the quadrics at the points.
+    Args:
+        quadrics (np.ndarray [10,N]): The quadrics.
+        points (np.ndarray [3,N]): The points.
+    Returns:
+        errors (np.ndarray [N]): The quadric errors.
+    """
+    q = quadrics
+    x, y, z = points
+    return (q[0] * x * x + q[4] * y * y + q[7] * z * z + q[9] +
+            2 * (q[1] * x * y + q[2] * x * z + q[5] * y * z + q[3] * x + q[6] * y + q[8] * z))
+
+
+def get_collapse_options(quadrics, vertices, edges):
+    """Get the candidate positions of the edge collapses and their quadric errors: the minimizer of the summed
+    quadric (when it is well-defined and close to the edge), the edge midpoint and the edge vertices (in this order of
+    preference on ties, e.g. on flat regions).
+    Args:
+        quadrics (np.ndarray [10,V]): The vertex quadrics.
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        edges (np.ndarray [E,2]): The edges to collapse.
+    Returns:
+        options (np.ndarray [4,3,E]): Candidate positions of the collapsed vertices.
+        option_errors (np.ndarray [4,E]): Quadric errors of the candidate positions (inf if not valid).
+    """
+    q = quadrics[:, edges[:, 0]] + quadrics[:, edges[:, 1]]  # [10,E]
+    v0, v1 = vertices[edges[:, 0]].T, vertices[edges[:, 1]].T  # [3,E]
+    # Solve the (symmetric) 3x3 systems in closed form with the cofactors.
+    a, b, c, d, e, f = q[0], q[1], q[2], q[4], q[5], q[7]
+    c00, c01, c02 = d * f - e * e, c * e - b * f, b * e - c * d
+    c11, c12, c22 = a * f - c * c, b * c - a * e, a * d - b * b
+    det = a * c00 + b * c01 + c * c02
+    solvable = np.abs(det) > 1e-10 * np.maximum(np.maximum(np.maximum(a, d), f), 1e-30) ** 3
+    inv_det = -1 / np.where(solvable, det, 1.)
+    optimum = np.stack([(c00 * q[3] + c01 * q[6] + c02 * q[8]) * inv_det,
+                        (c01 * q[3] + c11 * q[6] + c12 * q[8]) * inv_det,
+                        (c02 * q[3] + c12 * q[6] + c22 * q[8]) * inv_det])  # [3,E]
+    midpoint = (v0 + v1) / 2
+    solvable &= ((optimum - midpoint) ** 2).sum(axis=0) <= ((v1 - v0) ** 2).sum(axis=0)
+    options = np.stack([optimum, midpoint, v0, v1])  # [4,3,E]
+    option_errors = np.stack([get_quadric_errors(q, option) for option in options])  # [4,E]
+    option_errors[0, ~solvable] = np.inf
+    return options, option_errors
+
+
+def get_collapse_errors(quadrics, vertices, edges, chunk=2 ** 20):
+    """Get the minimum quadric errors of the edge collapses (see get_collapse_options).
+    Args:
+        quadrics (np.ndarray [10,V]): The vertex quadrics.
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        edges (np.ndarray [E,2]): The edges to collapse.
+        chunk (int): Number of edges processed at once (bounding the memory).
+    Returns:
+        errors (np.ndarray [E]): Quadric errors of the collapses.
+    """
+    errors = np.empty(len(edges))
+    for i in range(0, len(edges), chunk):
+        errors[i:i + chunk] = get_collapse_options(quadrics, vertices, edges[i:i + chunk])[1].min(axis=0)
+    return errors
+
+
+def select_independent_edges(edges, candidate_edges, errors, num_vertices, max_iters=16):
+    """Greedily select candidate edges (cheapest first) such that no two selected edges have adjacent (or shared)
+    vertices, so that their collapses are independent. Each iteration selects the remaining candidates that are the
+    cheapest within the 1-ring of both of their vertices, and discards the candidates next to them.
+    Args:
+        edges (np.ndarray [E,2]): All the mesh edges (the vertex adjacency).
+        candidate_edges (np.ndarray [C,2]): The candidate edges.
+        errors (np.ndarray [C]): Collapse errors of the candidate edges.
+        num_vertices (int): Number of vertices.
+        max_iters (int): Maximum number of selection iterations.
+    Returns:
+        selected (np.ndarray [C]): Selection mask of the candidate edges.
+    """
+    ranks = np.empty(len(candidate_edges), dtype=np.int64)
+    ranks[np.argsort(errors, kind="stable")] = np.arange(len(candidate_edges))
+    selected = np.zeros(len(candidate_edges), dtype=bool)
+    remaining = np.ones(len(candidate_edges), dtype=bool)
+    for _ in range(max_iters):
+        if not remaining.any():
+            break
+        vertex_ranks = np.full(num_vertices, len(candidate_edges), dtype=np.int64)
+        np.minimum.at(vertex_ranks, candidate_edges[remaining].reshape(-1), np.repeat(ranks[remaining], 2))
+        ring_ranks = vertex_ranks.copy()
+        np.minimum.at(ring_ranks, edges[:, 0], vertex_ranks[edges[:, 1]])
+        np.minimum.at(ring_ranks, edges[:, 1], vertex_ranks[edges[:, 0]])
+        selected |= remaining & (ring_ranks[candidate_edges] == ranks[:, None]).all(axis=-1)
+        # Block the vertices of the selected edges and their neighbors.
+        blocked = np.zeros(num_vertices, dtype=bool)
+        blocked[candidate_edges[selected].reshape(-1)] = True
+        blocked[edges[blocked[edges[:, 1]], 0]] = True
+        blocked[edges[blocked[edges[:, 0]], 1]] = True
+        remaining &= ~blocked[candidate_edges].any(axis=-1)
+    return selected
+
+
+def check_link_condition(edges, candidate_edges, num_edge_faces, num_vertices):
+    """Check that collapsing the candidate edges keeps the mesh manifold: the vertices of an edge should only share
+    the neighbors opposite to the edge in its adjacent faces.
+    Args:
+        edges (np.ndarray [E,2]): All the mesh edges (the vertex adjacency).
+        candidate_edges (np.ndarray [C,2]): The candidate edges.
+        num_edge_faces (np.ndarray [C]): Number of faces adjacent to the candidate edges.
+        num_vertices (int): Number of vertices.
+    Returns:
+        valid (np.ndarray [C]): Whether the candidate edges can be collapsed.
+    """
+    # Adjacency lists (CSR) of the vertices.
+    sources = np.concatenate([edges[:, 0], edges[:, 1]])
+    neighbors = np.concatenate([edges[:, 1], edges[:, 0]])[np.argsort(sources, kind="stable")]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(sources, minlength=num_vertices))])
+    keys = []
+    for side in range(2):
+        starts = offsets[candidate_edges[:, side]]
+        lengths = offsets[candidate_edges[:, side] + 1] - starts
+        owners = np.repeat(np.arange(len(candidate_edges)), lengths)
+        indices = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths - starts, lengths)
+        keys.append(owners * num_vertices + neighbors[indices])
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    num_common = np.bincount(keys[counts == 2] // num_vertices, minlength=len(candidate_edges))
+    return num_common == num_edge_faces
+
+
+def check_face_flips(vertices, faces, candidate_edges, positions, min_normal_dot=0.2):
+    """Check whether collapsing the (independent) candidate edges would flip (or degenerate) one of their faces.
+    Args:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        candidate_edges (np.ndarray [C,2]): The candidate edges.
+        positions (np.ndarray [C,3]): Positions of the collapsed vertices.
+        min_normal_dot (float): Minimum cosine between the face normals before and after the collapse.
+    Returns:
+        flipped (np.ndarray [C]): Whether the collapse of the candidate edges flips a face.
+    """
+    owners = np.full(len(vertices), -1, dtype=np.int64)
+    owners[candidate_edges.reshape(-1)] = np.repeat(np.arange(len(candidate_edges)), 2)
+    face_owners = owners[faces].max(axis=-1)  # The collapses are independent: a face has at most one owner.
+    affected = np.flatnonzero(face_owners >= 0)
+    face_owners, face_vertices = face_owners[affected], faces[affected]
+    collapsed = (face_vertices == candidate_edges[face_owners, :1]).any(axis=-1) & \
+        (face_vertices == candidate_edges[face_owners, 1:]).any(axis=-1)
+    points = vertices[face_vertices]  # [K,3,3]
+    moved = np.where((owners[face_vertices] >= 0)[..., None], positions[face_owners][:, None], points)
+    normals = np.cross(points[:, 1] - points[:, 0], points[:, 2] - points[:, 0])
+    moved_normals = np.cross(moved[:, 1] - moved[:, 0], moved[:, 2] - moved[:, 0])
+    norms, moved_norms = np.linalg.norm(normals, axis=-1), np.linalg.norm(moved_normals, axis=-1)
+    dots = (normals * moved_normals).sum(axis=-1)
+    # Faces that are already degenerate (e.g. from marching cubes) are not checked.
+    bad = ~collapsed & (norms > 0) & (dots <= min_normal_dot * norms * moved_norms)
+    flipped = np.zeros(len(candidate_edges), dtype=bool)
+    flipped[face_owners[bad]] = True
+    return flipped
+
+
+def compact_mesh(vertices, faces, *vertex_attrs):
+    # Remove the vertices that are not referenced by the faces.
+    used = np.zeros(len(vertices), dtype=bool)
+    used[faces.reshape(-1)] = True
+    return filter_vertices(vertices, faces, used, *vertex_attrs)
+
+
+def get_lod_targets(num_faces, lods):
+    """Convert the LOD levels to target face counts.
+    Args:
+        num_faces (int): Number of faces of the full mesh.
+        lods (list of float): Ratios of the faces to keep (<=1) or target face counts (>1).
+    Returns:
+        targets (list of int): Target face counts (in the order of the LOD levels).
+    """
+    return [int(round(lod * num_faces)) if lod <= 1 else int(lod) for lod in lods]
+
+
+def export_mesh_lods(mesh, fname, lods, vertex_normals=None, feature_weight=1.):
+    """Decimate a (textured) mesh into a LOD pyramid and export each level. The first level is written to fname and
+    the next ones to "{name}_lod{level}{ext}".
+    Args:
+        mesh (trimesh.Trimesh): The full mesh.
+        fname (str): Output file name of the first level.
+        lods (list of float): Ratios of the faces to keep (<=1) or target face counts (>1), in decreasing order.
+        vertex_normals (np.ndarray [V,3]): Surface normals preserving the sharp features (see decimate_mesh).
+        feature_weight (float): Weight of the tangent planes of the vertex normals.
+    """
+    targets = get_lod_targets(len(mesh.faces), lods)
+    if targets != sorted(targets, reverse=True):
+        raise ValueError(f"The LOD levels should be in decreasing order (got {lods}).")
+    has_colors = mesh.visual.kind == "vertex"
+    vertex_attrs = [np.asarray(mesh.visual.vertex_colors)] if has_colors else []
+    lod_meshes = decimate_mesh(mesh.vertices, mesh.faces, targets, vertex_attrs=vertex_attrs,
+                               vertex_normals=vertex_normals, feature_weight=feature_weight)
+    name, ext = os.path.splitext(fname)
+    for level, (vertices, faces, *attrs) in enumerate(lod_meshes):
+        lod_fname = fname if level == 0 else f"{name}_lod{level}{ext}"
+        lod_mesh = trimesh.Trimesh(vertices, faces, vertex_colors=attrs[0] if has_colors else None, process=False)
+        lod_mesh.export(lod_fname)
+        print(f"LOD {level}: {len(vertices)} vertices, {len(faces)} faces ({lod_fname})")
@@ -0,0 +1,123 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import numpy as np
+import torch
+
+# Primes of the spatial hash in tiny-cuda-nn (coherent_prime_hash).
+HASH_PRIMES = (1, 2654435761, 805459861)
+UINT32_MASK = 0xFFFFFFFF
+
+
+class HashGridEncoding(torch.nn.Module):
+
+    def __init__(self, n_input_dims, encoding_config, seed=1337):
+        """Multi-resolution hash grid encoding in pure PyTorch, as a drop-in replacement of tcnn.Encoding.
+        The grid layout (level resolutions, per-level table sizes, dense/hashed indexing and the flat parameter
+        vector) follows the HashGrid encoding in tiny-cuda-nn, so the `params` of a tcnn encoding can be loaded
+        directly through load_state_dict().
+        Args:
+            n_input_dims (int): Number of input dimensions (only 3 is supported).
+            encoding_config (dict): The tcnn HashGrid config (n_levels, n_features_per_level, log2_hashmap_size,
+                                    base_resolution, per_level_scale).
+            seed (int): Random seed for the parameter initialization.
+        """
+        super().__init__()
+        assert n_input_dims == 3, "Only 3D inputs are supported."
+        assert encoding_config.get("otype", "HashGrid") == "HashGrid", "Only the HashGrid encoding is supported."
+        self.n_input_dims = n_input_dims
+        self.n_levels = encoding_config["n_levels"]
+        self.n_features_per_level = encoding_config.get("n_features_per_level", 2)
+        self.log2_hashmap_size = encoding_config.get("log2_hashmap_size", 19)
+        self.base_resolution = encoding_config.get("base_resolution", 16)
+        self.per_level_scale = encoding_config.get("per_level_scale", 2.)
+        self.n_output_dims = self.n_levels * self.n_features_per_level
+        # Compute the grid layout of each level (same arithmetic as tcnn, in fp32).
+        log2_per_level_scale = np.float32(np.log2(self.per_level_scale))
+        max_params = np.iinfo(np.uint32).max // 2
+        scales, resolutions, sizes, offsets = [], [], [], []
+        offset = 0
+        for lv in range(self.n_levels):
+            scale = np.exp2(np.float32(lv) * log2_per_level_scale) * np.float32(self.base_resolution) - np.float32(1)
+            resolution = int(np.ceil(scale)) + 1
+            params_in_level = min(resolution ** 3, max_params)
+            params_in_level = (params_in_level + 7) // 8 * 8  # aligned to multiples of 8
+            params_in_level = min(params_in_level, 2 ** self.log2_hashmap_size)
+            scales.append(scale)
+            resolutions.append(resolution)
+            sizes.append(params_in_level)
+            offsets.append(offset)
+            offset += params_in_level
+        self.register_buffer("scales", torch.tensor(np.array(scales, dtype=np.float32)), persistent=False)  # [L]
+        self.register_buffer("resolutions", torch.tensor(resolutions, dtype=torch.int64), persistent=False)  # [L]
+        self.register_buffer("sizes", torch.tensor(sizes, dtype=torch.int64), persistent=False)  # [L]
+        self.register_buffer("offsets", torch.tensor(offsets, dtype=torch.int64), persistent=False)  # [L]
+        self.register_buffer("use_hash", torch.tensor([r ** 3 > s for r, s in zip(resolutions, sizes)]),
+                             persistent=False)  # [L]
+        corners = torch.tensor([[(c >> d) & 1 for d in range(3)] for c in range(8)], dtype=torch.int64)  # [8,3]
+        self.register_buffer("corners", corners, persistent=False)
+        self.register_buffer("primes", torch.tensor(HASH_PRIMES, dtype=torch.int64), persistent=False)  # [3]
+        # Flat parameter vector, initialized as in tcnn.
+        generator = torch.Generator().manual_seed(seed)
+        params = torch.rand(offset * self.n_features_per_level, generator=generator) * 2e-4 - 1e-4
+        self.params = torch.nn.Parameter(params)
+
+    def forward(self, x, active_levels=None):
+        """Encode the input points with the multi-resolution hash grid.
+        Args:
+            x (tensor [N,3]): Input points, normalized to [0,1].
+            active_levels (int): Only evaluate the first (coarsest) levels; the features of the other levels are
+                                 zero-padded. All levels are evaluated if None.
+        Returns:
+            feat (tensor [N,LF]): Concatenated features of all levels.
+        """
+        levels = self.n_levels if active_levels is None else min(max(active_levels, 0), self.n_levels)
+        x = x.float()
+        pos = x[:, None, :] * self.scales[:levels, None] + 0.5  # [N,L',3]
+        pos_floor = pos.floor()
+        frac = pos - pos_floor  # [N,L',3]
+        pos_grid = pos_floor.long()[:, :, None, :] + self.corners  # [N,L',8,3]
+        index = self._grid_index(pos_grid, levels)  # [N,L',8]
+        grid = self.params.view(-1, self.n_features_per_level)  # [P,F]
+        feats = grid[index]  # [N,L',8,F]
+        # Tri-linear interpolation weights of the 8 corners.
+        frac = frac[:, :, None, :]  # [N,L',1,3]
+        weights = torch.where(self.corners.bool(), frac, 1 - frac).prod(dim=-1)  # [N,L',8]
+        feat = (feats * weights[..., None]).sum(dim=2).flatten(1)  # [N,L'F]
+        if levels < self.n_levels:
+            feat = torch.nn.functional.pad(feat, (0, (self.n_levels - levels) * self.n_features_per_level))
+        return feat  # [N,LF]
+
+    def _grid_index(self, pos_grid, levels):
+        # Indices are computed in uint32 arithmetic (emulated with int64 and masking) to match tcnn.
+        pos_grid = pos_grid & UINT32_MASK  # [N,L',8,3]
+        x, y, z = pos_grid.unbind(dim=-1)  # [N,L',8]
+        resolutions, sizes = self.resolutions[:levels, None], self.sizes[:levels, None]  # [L',1]
+        index_dense = (x + y * resolutions + z * resolutions * resolutions) & UINT32_MASK  # [N,L',8]
+        hashed = (pos_grid * self.primes) & UINT32_MASK  # [N,L',8,3]
+        index_hash = hashed[..., 0] ^ hashed[..., 1] ^ hashed[..., 2]  # [N,L',8]
+        index = torch.where(self.use_hash[:levels, None], index_hash, index_dense) % sizes  # [N,L',8]
+        return index + self.offsets[:levels, None]  # [N,L',8]
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                              error_msgs):
+        # tcnn checkpoints store the same flat parameter vector (possibly in half precision).
+        key = prefix + "params"
+        if key in state_dict:
+            params = state_dict[key]
+            if params.numel() != self.params.numel():
+                error_msgs.append(f"Hash grid size mismatch for {key}: expected {self.params.numel()} parameters, "
+                                  f"got {params.numel()}. Please check the hash grid config.")
+                return
+            state_dict[key] = params.view(-1).to(self.params.dtype)
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys,
+                                      error_msgs)
@@ -10,149 +10,1119 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 -----------------------------------------------------------------------------
 '''
 
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import zlib
+from functools import lru_cache, partial, reduce
+
 import numpy as np
 import trimesh
 import mcubes
 import torch
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import torch.distributed as dist
 import torch.nn.functional as torch_F
 from tqdm import tqdm
 
-from imaginaire.utils.distributed import get_world_size, is_master
+from imaginaire.utils.distributed import get_rank, get_world_size, is_master
 
 
 @torch.no_grad()
-def extract_mesh(sdf_func, bounds, intv, block_res=64, texture_func=None, filter_lcc=False):
-    lattice_grid = LatticeGrid(bounds, intv=intv, block_res=block_res)
-    data_loader = get_lattice_grid_loader(lattice_grid)
-    mesh_blocks = []
+def extract_mesh(sdf_func, bounds, intv, block_res=64, texture_func=None, filter_lcc=False, device="cuda",
+                 sparse=False, coarse_stride=16, lipschitz=2., num_workers=8, max_pending=None, output_file=None,
+                 vertex_transform=None, texture_batch_size=2 ** 18, level=0., crop_bounds=None, save_sdf=None,
+                 sdf_volume=None, job_dir=None, shard=(0, 1), method="marching_cubes", refine_func=None,
+                 job_extra_args=None):
+    """Extract the zero level set of an SDF with block-wise marching cubes (or surface nets). The blocks are processed
+    as a pipeline: while the SDF of a block is evaluated on the device, marching cubes runs on the previous blocks in a
+    process pool. The block meshes are then welded along the block seams into a single mesh, whose vertices are
+    refined (optionally) and textured last (so that only the welded and filtered vertices are queried) in batches of
+    texture_batch_size vertices. With an output file, the mesh is extracted out-of-core instead: each rank streams its
+    blocks to a spill file, which are then assembled into a binary PLY file (see write_ply_from_spills), so that no
+    rank holds more than a few blocks in memory.
+    The evaluated SDF blocks can be saved to an SDF volume (see SDFVolumeWriter), from which the mesh can be extracted
+    again (e.g. at another level or with other bounds) without evaluating the SDF function.
+    With a job directory, the extraction is resumable: the block meshes are saved to shard files as they are completed
+    (see MeshShardJob), and the completed blocks are skipped when the job is restarted. The blocks can also be split
+    into interleaved shards processed by independent processes; the run without sharding assembles the output file.
+    Args:
+        sdf_func (function): The SDF function (points [...,3] -> SDF values [...,1]). Unused with an SDF volume.
+        bounds (float [3,2]): Bounds of the lattice grid.
+        intv (float): Lattice interval (the resolution is 2/intv for the [-1,1] cube).
+        block_res (int): Block resolution (number of lattice cells per block and per axis).
+        texture_func (function): Function returning the vertex colors (None for an untextured mesh).
+        filter_lcc (bool): Keep only the largest connected component (of the whole mesh).
+        device (str/torch.device): The device to evaluate the SDF on.
+        sparse (bool): Evaluate the SDF coarse-to-fine (see get_sdf_sparse) and skip the blocks outside the unit
+                       bounding sphere, instead of densely evaluating every lattice point.
+        coarse_stride (int): Stride (in lattice cells, a power of 2) of the coarsest level of the sparse evaluation.
+        lipschitz (float): Lipschitz bound of the SDF, which sets the narrow-band margin of the sparse evaluation.
+        num_workers (int): Number of marching cubes processes (0 to run marching cubes in the main process).
+        max_pending (int): Maximum number of SDF blocks waiting for marching cubes (default: 2 * num_workers).
+        output_file (str): Stream the mesh to this PLY file (out-of-core extraction; filter_lcc is not supported).
+        vertex_transform (np.ndarray [4,4]): Transformation applied to the extracted vertices (after texturing).
+        texture_batch_size (int): Number of vertices per batch of texture_func.
+        level (float): Level of the extracted level set of the SDF function.
+        crop_bounds (float [3,2]): Only keep the vertices inside these bounds.
+        save_sdf (str): Save the evaluated SDF blocks to an SDF volume in this directory.
+        sdf_volume (SDFVolume): Read the SDF blocks from this SDF volume instead of evaluating sdf_func (the lattice
+                                grid should match the one the volume was saved with, see SDFVolume.lattice_args).
+        job_dir (str): Save the block meshes to (and resume from) this job directory (requires an output file).
+        shard (int [2]): Index and number of shards; only the blocks of this shard are processed (with a job
+                         directory), and the output file is only assembled without sharding.
+        method (str): Extraction method: "marching_cubes" or "surface_nets" (see surface_nets, which is typically
+                      combined with a refine_func to get an accurate mesh from a coarser lattice).
+        refine_func (function): Function refining the vertices, e.g. onto the level set (see refine_vertices).
+        job_extra_args (dict): Settings of texture_func and refine_func (e.g. the appearance embedding or the number
+                               of refinement steps), saved with the job so that resuming it with other settings fails.
+    Returns:
+        mesh (trimesh.Trimesh): The extracted mesh (None on the non-master ranks and with an output file).
+    """
+    if output_file is not None and filter_lcc:
+        raise ValueError("Filtering the largest connected component is not supported for out-of-core extraction.")
+    if job_dir is not None and (output_file is None or save_sdf is not None):
+        raise ValueError("Resumable extraction requires an output file and does not support saving the SDF.")
+    if method not in ["marching_cubes", "surface_nets"]:
+        raise ValueError(f"Unknown mesh extraction method: {method}")
+    if method == "surface_nets" and (save_sdf is not None or sdf_volume is not None):
+        raise ValueError("Surface nets (on padded blocks) are not supported with SDF volumes.")
+    # Surface nets need the cells before the block boundaries.
+    pad = 1 if method == "surface_nets" else 0
+    lattice_grid = LatticeGrid(bounds, intv=intv, block_res=block_res, skip_outside_sphere=sparse, pad=pad,
+                               device=device)
+    if sdf_volume is not None:
+        # Only the blocks that were evaluated are saved in the volume.
+        lattice_grid.block_indices = [idx for idx in lattice_grid.block_indices if idx in sdf_volume]
+        sparse = False
+    job = None
+    if job_dir is not None:
+        # The ranks split the shard further.
+        shard_idx, num_shards = shard[0] * get_world_size() + get_rank(), shard[1] * get_world_size()
+        job_args = dict(bounds=np.asarray(bounds, dtype=float).tolist(), intv=float(intv), block_res=block_res,
+                        sparse=sparse, level=float(level), textured=texture_func is not None,
+                        crop_bounds=None if crop_bounds is None else np.asarray(crop_bounds, dtype=float).tolist(),
+                        method=method, refined=refine_func is not None,
+                        # Blocks saved before marching_cubes kept the vertices off the lattice points do not weld
+                        # with the new ones (see marching_cubes), so such jobs cannot be resumed.
+                        version=2)
+        if sparse:
+            job_args.update(coarse_stride=coarse_stride, lipschitz=float(lipschitz))
+        job_args.update(job_extra_args or {})
+        job = MeshShardJob(job_dir, lattice_grid, job_args, shard=(shard_idx, num_shards), texture_func=texture_func,
+                           texture_batch_size=texture_batch_size, refine_func=refine_func)
+        block_indices = [idx for idx in range(shard_idx, len(lattice_grid), num_shards)
+                         if lattice_grid.block_indices[idx] not in job.completed]
+        print(f"Job in {job_dir}: {len(job.completed)} / {len(lattice_grid)} blocks already completed")
+    else:
+        # Each rank processes an interleaved subset of the blocks.
+        block_indices = range(get_rank(), len(lattice_grid), get_world_size())
     if is_master():
-        data_loader = tqdm(data_loader, leave=False)
-    for it, data in enumerate(data_loader):
-        xyz = data["xyz"][0]
-        xyz_cuda = xyz.cuda()
-        sdf_cuda = sdf_func(xyz_cuda)[..., 0]
-        sdf = sdf_cuda.cpu()
-        mesh = marching_cubes(sdf.numpy(), xyz.numpy(), intv, texture_func, filter_lcc)
-        mesh_blocks.append(mesh)
+        block_indices = tqdm(block_indices, leave=False)
+    mesh_blocks = []
+    num_evaluated = 0
+    spill = None
+    sdf_writer = None
+    if save_sdf is not None:
+        os.makedirs(save_sdf, exist_ok=True)
+        sdf_writer = SDFVolumeWriter(os.path.join(save_sdf, f"rank{get_rank()}.sdf"))
+    if output_file is not None and job is None:
+        spill = MeshSpillWriter(f"{output_file}.rank{get_rank()}.spill", lattice_grid, texture_func=texture_func,
+                                texture_batch_size=texture_batch_size, refine_func=refine_func)
+    with BlockPipeline(num_workers=num_workers, max_pending=max_pending) as pipeline:
+        for idx in block_indices:
+            sample = lattice_grid[idx]
+            xyz = sample["xyz"]  # [X,Y,Z,3]
+            if sdf_volume is not None:
+                sdf = torch.from_numpy(sdf_volume.read_block(lattice_grid.block_indices[idx]))
+            elif sparse:
+                sdf, num_evaluated_block = get_sdf_sparse(sdf_func, xyz, intv, coarse_stride=coarse_stride,
+                                                          lipschitz=lipschitz)
+                num_evaluated += num_evaluated_block
+            else:
+                sdf = sdf_func(xyz)[..., 0]
+            if sdf_writer is not None:
+                sdf_writer.write_block(lattice_grid.block_indices[idx], sdf.cpu().numpy())
+            if job is not None:
+                callback = partial(job.write_block, lattice_grid.block_indices[idx])
+            elif spill is not None:
+                callback = partial(spill.write_block, lattice_grid.block_indices[idx])
+            else:
+                callback = mesh_blocks.append
+            if method == "surface_nets":
+                mesh_func = partial(surface_nets, pad=sample["pad"], block_res=block_res)
+            else:
+                mesh_func = marching_cubes
+            pipeline.submit(callback, mesh_func, sdf.cpu().numpy(), xyz[0, 0, 0].cpu().numpy(), intv,
+                            block_offset=sample["offset"], lattice_shape=lattice_grid.shape, level=level,
+                            crop_bounds=crop_bounds)
+    if sdf_writer is not None:
+        sdf_writer.close()
+        sdf_records_gather = [None] * get_world_size()
+        if dist.is_initialized():
+            dist.all_gather_object(sdf_records_gather, sdf_writer.records)
+        else:
+            sdf_records_gather = [sdf_writer.records]
+        if is_master():
+            lattice_args = dict(bounds=np.asarray(bounds, dtype=float).tolist(), intv=float(intv), block_res=block_res,
+                                sparse=sparse)
+            vertex_transform_list = None if vertex_transform is None else np.asarray(vertex_transform).tolist()
+            save_sdf_volume_index(save_sdf, [record for records in sdf_records_gather for record in records],
+                                  lattice_args=lattice_args, vertex_transform=vertex_transform_list)
+    if sparse:
+        num_evaluated = torch.tensor(num_evaluated, device=device)
+        if dist.is_initialized():
+            dist.all_reduce(num_evaluated)
+        if is_master():
+            num_total = len(lattice_grid.x_grid) * len(lattice_grid.y_grid) * len(lattice_grid.z_grid)
+            print(f"Evaluated the SDF at {num_evaluated.item()} / {num_total} lattice points "
+                  f"({num_evaluated.item() / num_total:.2%})")
+    if job is not None:
+        job.close()
+        if dist.is_initialized():
+            dist.barrier()
+        if shard[1] == 1 and is_master():
+            job.write_ply(output_file, vertex_transform=vertex_transform)
+        return None
+    if spill is not None:
+        spill.close()
+        spills_gather = [None] * get_world_size()
+        if dist.is_initialized():
+            dist.all_gather_object(spills_gather, (spill.fname, spill.records))
+        else:
+            spills_gather = [(spill.fname, spill.records)]
+        if is_master():
+            write_ply_from_spills(output_file, spills_gather, lattice_grid, with_colors=texture_func is not None,
+                                  vertex_transform=vertex_transform)
+            for spill_fname, _ in spills_gather:
+                os.remove(spill_fname)
+        return None
     mesh_blocks_gather = [None] * get_world_size()
     if dist.is_initialized():
         dist.all_gather_object(mesh_blocks_gather, mesh_blocks)
     else:
         mesh_blocks_gather = [mesh_blocks]
     if is_master():
-        mesh_blocks_all = [mesh for mesh_blocks in mesh_blocks_gather for mesh in mesh_blocks
-                           if mesh.vertices.shape[0] > 0]
-        mesh = trimesh.util.concatenate(mesh_blocks_all)
+        vertices, faces = merge_mesh_blocks([block for mesh_blocks in mesh_blocks_gather for block in mesh_blocks])
+        if filter_lcc:
+            vertices, faces = filter_largest_cc(vertices, faces)
+        if len(faces) == 0:
+            return trimesh.Trimesh()
+        if refine_func is not None:
+            vertices = refine_func(vertices)
+        colors = None
+        if texture_func is not None:
+            # The texture network runs on the device, so the vertex colors are queried from the main process.
+            colors = get_vertex_colors(texture_func, vertices, batch_size=texture_batch_size)
+        if vertex_transform is not None:
+            vertices = vertices @ vertex_transform[:3, :3].T + vertex_transform[:3, 3]
+        # The vertices are already welded, so trimesh should not merge them again (with a tolerance).
+        mesh = trimesh.Trimesh(vertices, faces, vertex_colors=colors, process=False)
         return mesh
     else:
         return None
 
 
+class BlockPipeline(object):
+
+    def __init__(self, num_workers=8, max_pending=None):
+        """Run the (CPU) jobs of the mesh blocks in a process pool, handing the results over to their callbacks (in
+        the main process) in submission order. Submitting blocks when the pipeline is full waits for the oldest job,
+        which bounds the memory taken by the pending blocks and lets the producer run ahead by at most max_pending
+        blocks.
+        Args:
+            num_workers (int): Number of worker processes (0 to run the jobs synchronously in the main process).
+            max_pending (int): Maximum number of pending jobs (default: 2 * num_workers).
+        """
+        self.num_workers = num_workers
+        self.max_pending = max_pending or 2 * num_workers
+        self.pending = collections.deque()
+        self.pool = None
+
+    def __enter__(self):
+        if self.num_workers > 0:
+            # The workers are forked (like data loader workers) and only run NumPy code, never touching CUDA.
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.num_workers,
+                                                               mp_context=multiprocessing.get_context("fork"))
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            while self.pending:
+                self._collect()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=exc_type is not None)
+
+    def submit(self, callback, func, *args, **kwargs):
+        if self.pool is None:
+            callback(func(*args, **kwargs))
+            return
+        self.pending.append((callback, self.pool.submit(func, *args, **kwargs)))
+        while len(self.pending) >= self.max_pending:
+            self._collect()
+
+    def _collect(self):
+        callback, future = self.pending.popleft()
+        callback(future.result())
+
+
 @torch.no_grad()
-def extract_texture(xyz, neural_rgb, neural_sdf, appear_embed):
+def extract_texture(xyz, neural_rgb, neural_sdf, appear_embed, appearance="zero"):
+    """Query the vertex colors from the radiance network, viewing each vertex head-on (along its normal).
+    Args:
+        xyz (np.ndarray [N,3]): The vertices.
+        neural_rgb (NeuralRGB): The radiance network.
+        neural_sdf (NeuralSDF): The SDF network.
+        appear_embed (torch.nn.Embedding): The per-image appearance embeddings (None if not used).
+        appearance (str/int): Appearance embedding policy: "zero" (all zeros), "mean" (mean of the per-image
+                              embeddings) or the index of the image whose embedding is used.
+    Returns:
+        colors (np.ndarray [N,3]): The vertex colors (uint8).
+    """
     num_samples, _ = xyz.shape
-    xyz_cuda = torch.from_numpy(xyz).float().cuda()[None, None]  # [N,3] -> [1,1,N,3]
-    sdfs, feats = neural_sdf(xyz_cuda)
-    gradients, _ = neural_sdf.compute_gradients(xyz_cuda, training=False, sdf=sdfs)
+    device = next(neural_rgb.parameters()).device
+    xyz_device = torch.from_numpy(xyz).float().to(device)[None, None]  # [N,3] -> [1,1,N,3]
+    sdfs, feats = neural_sdf(xyz_device)[:2]
+    gradients, _ = neural_sdf.compute_gradients(xyz_device, training=False, sdf=sdfs)
     normals = torch_F.normalize(gradients, dim=-1)
+    app = None
     if appear_embed is not None:
-        feat_dim = appear_embed.embedding_dim  # [1,1,N,C]
-        app = torch.zeros([1, 1, num_samples, feat_dim], device=sdfs.device)  # TODO: hard-coded to zero. better way?
-    else:
-        app = None
-    rgbs = neural_rgb.forward(xyz_cuda, normals, -normals, feats, app=app)  # [1,1,N,3]
-    return (rgbs.squeeze().cpu().numpy() * 255).astype(np.uint8)
+        app = get_appearance_embedding(appear_embed, appearance).expand(1, 1, num_samples, -1)  # [1,1,N,C]
+    rgbs = neural_rgb.forward(xyz_device, normals, -normals, feats, app=app)  # [1,1,N,3]
+    return (rgbs[0, 0].cpu().numpy() * 255).astype(np.uint8)
+
+
+@torch.no_grad()
+def extract_normals(xyz, neural_sdf):
+    """Query the surface normals (normalized SDF gradients) at the vertices.
+    Args:
+        xyz (np.ndarray [N,3]): The vertices.
+        neural_sdf (NeuralSDF): The SDF network.
+    Returns:
+        normals (np.ndarray [N,3]): The vertex normals.
+    """
+    device = next(neural_sdf.parameters()).device
+    xyz_device = torch.from_numpy(xyz).float().to(device)[None, None]  # [N,3] -> [1,1,N,3]
+    sdfs = neural_sdf.sdf(xyz_device)
+    gradients, _ = neural_sdf.compute_gradients(xyz_device, training=False, sdf=sdfs)
+    return torch_F.normalize(gradients, dim=-1)[0, 0].cpu().numpy()
+
+
+def get_appearance_embedding(appear_embed, appearance="zero"):
+    """Select the appearance embedding to texture the mesh with.
+    Args:
+        appear_embed (torch.nn.Embedding): The per-image appearance embeddings.
+        appearance (str/int): "zero", "mean" or the index of an image (see extract_texture).
+    Returns:
+        app (tensor [C]): The appearance embedding.
+    """
+    if appearance == "zero":
+        return torch.zeros(appear_embed.embedding_dim, device=appear_embed.weight.device)
+    if appearance == "mean":
+        return appear_embed.weight.mean(dim=0)
+    index = int(appearance)
+    if not 0 <= index < appear_embed.num_embeddings:
+        raise ValueError(f"Appearance embedding index {index} out of range [0,{appear_embed.num_embeddings}).")
+    return appear_embed.weight[index]
+
+
+def get_vertex_colors(texture_func, vertices, batch_size=2 ** 18):
+    """Query the vertex colors in fixed-size batches (bounding the memory taken by the texture network).
+    Args:
+        texture_func (function): Function returning the vertex colors.
+        vertices (np.ndarray [N,3]): The vertices.
+        batch_size (int): Number of vertices per batch.
+    Returns:
+        colors (np.ndarray [N,3]): The vertex colors (uint8).
+    """
+    colors = [texture_func(vertices[i:i + batch_size]) for i in range(0, len(vertices), batch_size)]
+    return np.concatenate(colors) if colors else np.zeros((0, 3), dtype=np.uint8)
+
+
+@torch.no_grad()
+def refine_vertices(xyz, sdf_grad_func, max_dist, num_steps=4, sharp_features=False, feature_threshold=0.05,
+                    batch_size=2 ** 18, device="cpu"):
+    """Move the vertices onto the zero level set of the SDF with Newton steps along the SDF gradient,
+    x <- x - f(x) * grad f(x) / |grad f(x)|^2, in fixed-size batches. Each vertex is kept within max_dist (along each
+    axis) of its initial position, so that it cannot jump across thin structures where the SDF is inaccurate.
+    With sharp_features, the points around the vertices are projected as well, and the vertices near sharp features
+    are placed on them as in dual contouring (see get_feature_points).
+    Args:
+        xyz (np.ndarray [N,3]): The vertices.
+        sdf_grad_func (function): Function returning the SDF values [...,1] and gradients [...,3] at the points
+                                  [...,3] (see get_sdf_gradients).
+        max_dist (float): Maximum displacement of the vertices along each axis (e.g. the lattice interval).
+        num_steps (int): Number of Newton steps.
+        sharp_features (bool): Place the vertices on the sharp features (7x more SDF evaluations).
+        feature_threshold (float): Relative eigenvalue of the normal covariance above which a feature is detected.
+        batch_size (int): Number of vertices per batch.
+        device (str/torch.device): The device to evaluate the SDF on.
+    Returns:
+        xyz (np.ndarray [N,3]): The refined vertices.
+    """
+    # The vertex itself and the points the maximum displacement away along each axis.
+    offsets = torch.zeros(1, 3) if not sharp_features else \
+        torch.cat([torch.zeros(1, 3), torch.eye(3), -torch.eye(3)]) * max_dist  # [P,3]
+    offsets = offsets.to(device)
+    xyz_refined = np.empty_like(xyz)
+    for i in range(0, len(xyz), batch_size):
+        xyz_init = torch.from_numpy(xyz[i:i + batch_size]).float().to(device)[:, None]  # [B,1,3]
+        points = xyz_init + offsets  # [B,P,3]
+        for _ in range(num_steps):
+            sdfs, gradients = sdf_grad_func(points)  # [B,P,1],[B,P,3]
+            step = sdfs * gradients / gradients.pow(2).sum(dim=-1, keepdim=True).clamp(min=1e-12)  # [B,P,3]
+            points = torch.minimum(torch.maximum(points - step, xyz_init - max_dist), xyz_init + max_dist)
+        xyz_batch = points[:, 0]  # [B,3]
+        if sharp_features:
+            xyz_batch = get_feature_points(points, sdf_grad_func, feature_threshold=feature_threshold)
+            xyz_batch = torch.minimum(torch.maximum(xyz_batch, xyz_init[:, 0] - max_dist), xyz_init[:, 0] + max_dist)
+        xyz_refined[i:i + batch_size] = xyz_batch.cpu().numpy()
+    return xyz_refined
+
+
+def get_feature_points(points, sdf_grad_func, feature_threshold=0.05):
+    """Place the vertices on the sharp features from surface points around them, by minimizing the quadratic error
+    to their tangent planes (the QEF of dual contouring). The normal covariance has a single large eigenvalue on smooth
+    surfaces, where the vertices are kept on the surface; otherwise, the QEF is minimized in the subspace of the
+    large eigenvalues (a line along an edge, or a corner), closest to the vertex.
+    Args:
+        points (tensor [B,P,3]): Surface points around each vertex (the first one is the vertex).
+        sdf_grad_func (function): Function returning the SDF values and gradients at the points.
+        feature_threshold (float): Relative eigenvalue of the normal covariance above which a feature is detected.
+    Returns:
+        xyz (tensor [B,3]): The vertices.
+    """
+    _, gradients = sdf_grad_func(points)
+    normals = torch_F.normalize(gradients, dim=-1)  # [B,P,3]
+    covariance = normals.transpose(1, 2) @ normals  # [B,3,3]
+    eigenvalues, eigenvectors = torch.linalg.eigh(covariance)  # [B,3],[B,3,3]
+    large = eigenvalues > feature_threshold * eigenvalues[:, -1:]  # [B,3]
+    # Distances of the vertices to the tangent planes.
+    dists = (normals * (points - points[:, :1])).sum(dim=-1, keepdim=True)  # [B,P,1]
+    rhs = (normals * dists).sum(dim=1)  # [B,3]
+    inv_eigenvalues = torch.where(large, 1 / eigenvalues.clamp(min=1e-12), torch.zeros_like(eigenvalues))  # [B,3]
+    delta = eigenvectors @ (inv_eigenvalues * (eigenvectors.transpose(1, 2) @ rhs[..., None])[..., 0])[..., None]
+    feature = large.sum(dim=-1, keepdim=True) >= 2  # [B,1]
+    return torch.where(feature, points[:, 0] + delta[..., 0], points[:, 0])
+
+
+def get_sdf_gradients(xyz, neural_sdf):
+    """Query the SDF values and gradients (analytical or numerical, as in training) at the points.
+    Args:
+        xyz (tensor [...,3]): The points.
+        neural_sdf (NeuralSDF): The SDF network.
+    Returns:
+        sdfs (tensor [...,1]): The SDF values.
+        gradients (tensor [...,3]): The SDF gradients.
+    """
+    sdfs = neural_sdf.sdf(xyz)
+    gradients, _ = neural_sdf.compute_gradients(xyz, training=False, sdf=sdfs)
+    return sdfs, gradients
+
+
+@torch.no_grad()
+def get_sdf_sparse(sdf_func, xyz, intv, coarse_stride=16, lipschitz=2.):
+    """Evaluate the SDF on a lattice block coarse-to-fine (octree). The block is split into nodes of coarse_stride
+    lattice cells, and the SDF is evaluated at the node corners. With an L-Lipschitz SDF, a node can only contain the
+    surface if one of its corners is within L times the half node diagonal from it (or if the corner signs differ).
+    Only such nodes are subdivided (halving the stride) until the lattice cells are reached; the lattice points of the
+    discarded nodes are filled with the mean of the node corners, which has the right sign for marching cubes.
+    Args:
+        sdf_func (function): The SDF function (points [...,3] -> SDF values [...,1]).
+        xyz (tensor [X,Y,Z,3]): Lattice points of the block.
+        intv (float): Lattice interval.
+        coarse_stride (int): Stride (in lattice cells, a power of 2) of the coarsest level.
+        lipschitz (float): Lipschitz bound of the SDF, which sets the narrow-band margin.
+    Returns:
+        sdf (tensor [X,Y,Z]): SDF values (exact within the narrow band around the surface).
+        num_evaluated (int): Number of lattice points the SDF was evaluated at.
+    """
+    size = xyz.shape[:3]
+    if min(size) < 2:
+        return sdf_func(xyz)[..., 0], xyz[..., 0].numel()
+    sdf = torch.full(size, float("nan"), device=xyz.device)  # [X,Y,Z]
+    fill = torch.full(size, float("nan"), device=xyz.device)  # [X,Y,Z]
+    evaluated = torch.zeros(size, dtype=torch.bool, device=xyz.device)  # [X,Y,Z]
+    active = None
+    stride = coarse_stride
+    while stride >= 1:
+        # Node i spans the lattice points from corner_idx[i] to corner_idx[i+1] along each axis.
+        corner_idx = [torch.cat([torch.arange(0, n - 1, stride), torch.tensor([n - 1])]).to(xyz.device)
+                      for n in size]  # 3x[M+1]
+        mx, my, mz = [len(idx) - 1 for idx in corner_idx]
+        # Number of lattice points assigned to each node (the last lattice point goes to the last node).
+        node_sizes = [torch.full((m,), stride, device=xyz.device) for m in [mx, my, mz]]  # 3x[M]
+        for node_size, n in zip(node_sizes, size):
+            node_size[-1] = n - stride * (len(node_size) - 1)
+        if active is None:
+            candidates = torch.ones(mx, my, mz, dtype=torch.bool, device=xyz.device)  # [Mx,My,Mz]
+        else:
+            # Children of the active nodes of the previous level (node i has the children 2i and 2i+1).
+            candidates = active.repeat_interleave(2, dim=0).repeat_interleave(2, dim=1).repeat_interleave(2, dim=2)
+            candidates = candidates[:mx, :my, :mz]  # [Mx,My,Mz]
+        # Evaluate the SDF at the (not yet evaluated) corners of the candidate nodes.
+        corner_mask = torch.zeros(mx + 1, my + 1, mz + 1, dtype=torch.bool, device=xyz.device)  # [Mx+1,My+1,Mz+1]
+        for dx, dy, dz in np.ndindex(2, 2, 2):
+            corner_mask[dx:dx + mx, dy:dy + my, dz:dz + mz] |= candidates
+        eval_mask = corner_mask & ~gather_lattice(evaluated, corner_idx)  # [Mx+1,My+1,Mz+1]
+        if eval_mask.any():
+            ix_eval, iy_eval, iz_eval = [idx[i] for idx, i in zip(corner_idx, eval_mask.nonzero(as_tuple=True))]
+            sdf[ix_eval, iy_eval, iz_eval] = sdf_func(xyz[ix_eval, iy_eval, iz_eval])[..., 0]
+            evaluated[ix_eval, iy_eval, iz_eval] = True
+        # Keep the nodes that may contain the surface.
+        sdf_grid = gather_lattice(sdf, corner_idx)  # [Mx+1,My+1,Mz+1]
+        sdf_corners = [sdf_grid[dx:dx + mx, dy:dy + my, dz:dz + mz] for dx, dy, dz in np.ndindex(2, 2, 2)]  # 8x[M^3]
+        margin = lipschitz * stride * intv * 3 ** 0.5 / 2
+        crossing = (reduce(torch.minimum, sdf_corners) <= 0) & (reduce(torch.maximum, sdf_corners) >= 0)  # [M^3]
+        near_surface = reduce(torch.minimum, [sdf_corner.abs() for sdf_corner in sdf_corners]) <= margin  # [M^3]
+        active = candidates & (crossing | near_surface)  # [Mx,My,Mz]
+        # Fill the lattice points of the discarded nodes.
+        discarded = candidates & ~active  # [Mx,My,Mz]
+        if discarded.any():
+            fill_mask = expand_nodes(discarded, node_sizes) & fill.isnan()  # [X,Y,Z]
+            sdf_mean = sum(sdf_corners) / 8  # [Mx,My,Mz]
+            fill = torch.where(fill_mask, expand_nodes(sdf_mean, node_sizes), fill)  # [X,Y,Z]
+        stride //= 2
+    sdf = torch.where(evaluated, sdf, fill)  # [X,Y,Z]
+    # Lattice points left out by the node boundaries (if any) are evaluated directly.
+    missing = sdf.isnan()
+    if missing.any():
+        sdf[missing] = sdf_func(xyz[missing])[..., 0]
+        evaluated |= missing
+    return sdf, int(evaluated.sum())
+
+
+def gather_lattice(values, indices):
+    # Gather values [X,Y,Z] at the lattice indices along each axis (3x[I]) -> [Ix,Iy,Iz].
+    for dim, idx in enumerate(indices):
+        if len(idx) < values.shape[dim]:
+            values = values.index_select(dim, idx)
+    return values
+
+
+def expand_nodes(values, node_sizes):
+    # Expand per-node values [Mx,My,Mz] to their lattice points (node sizes 3x[M]) -> [X,Y,Z].
+    for dim, sizes in enumerate(node_sizes):
+        values = values.repeat_interleave(sizes, dim=dim)
+    return values
 
 
 class LatticeGrid(torch.utils.data.Dataset):
 
-    def __init__(self, bounds, intv, block_res=64):
+    def __init__(self, bounds, intv, block_res=64, skip_outside_sphere=False, pad=0, device="cpu"):
         super().__init__()
         self.block_res = block_res
+        self.pad = pad
+        self.device = device
         ((x_min, x_max), (y_min, y_max), (z_min, z_max)) = bounds
         self.x_grid = torch.arange(x_min, x_max, intv)
         self.y_grid = torch.arange(y_min, y_max, intv)
         self.z_grid = torch.arange(z_min, z_max, intv)
         res_x, res_y, res_z = len(self.x_grid), len(self.y_grid), len(self.z_grid)
+        self.shape = (res_x, res_y, res_z)
         print("Extracting surface at resolution", res_x, res_y, res_z)
         self.num_blocks_x = int(np.ceil(res_x / block_res))
         self.num_blocks_y = int(np.ceil(res_y / block_res))
         self.num_blocks_z = int(np.ceil(res_z / block_res))
+        self.block_indices = list(range(self.num_blocks_x * self.num_blocks_y * self.num_blocks_z))
+        if skip_outside_sphere:
+            # The vertices outside the unit bounding sphere are filtered out anyway.
+            self.block_indices = [idx for idx in self.block_indices if self.get_block_dist_to_origin(idx) < 1.]
 
-    def __getitem__(self, idx):
-        # Keep track of sample index for convenience.
-        sample = dict(idx=idx)
+    def get_block_indices(self, idx):
         block_idx_x = idx // (self.num_blocks_y * self.num_blocks_z)
         block_idx_y = (idx // self.num_blocks_z) % self.num_blocks_y
         block_idx_z = idx % self.num_blocks_z
+        return block_idx_x, block_idx_y, block_idx_z
+
+    def get_block_dist_to_origin(self, idx):
+        # Distance from the origin to the closest point of the block.
+        dist_sq = 0.
+        for block_idx, grid in zip(self.get_block_indices(idx), [self.x_grid, self.y_grid, self.z_grid]):
+            grid_block = grid[block_idx * self.block_res:(block_idx + 1) * self.block_res + 1]
+            dist_sq += float(grid_block[0].clamp(min=0) + grid_block[-1].clamp(max=0).abs()) ** 2
+        return dist_sq ** 0.5
+
+    def __getitem__(self, idx):
+        # Keep track of sample index for convenience.
+        sample = dict(idx=idx)
+        block_idx_x, block_idx_y, block_idx_z = self.get_block_indices(self.block_indices[idx])
         xi = block_idx_x * self.block_res
         yi = block_idx_y * self.block_res
         zi = block_idx_z * self.block_res
-        x, y, z = torch.meshgrid(self.x_grid[xi:xi+self.block_res+1],
-                                 self.y_grid[yi:yi+self.block_res+1],
-                                 self.z_grid[zi:zi+self.block_res+1], indexing="ij")
+        # The blocks are padded with the previous lattice points (except on the lower lattice boundary).
+        xs, ys, zs = max(xi - self.pad, 0), max(yi - self.pad, 0), max(zi - self.pad, 0)
+        # Only the grid coordinates are copied, the lattice points are generated on the device.
+        x, y, z = torch.meshgrid(self.x_grid[xs:xi+self.block_res+1].to(self.device),
+                                 self.y_grid[ys:yi+self.block_res+1].to(self.device),
+                                 self.z_grid[zs:zi+self.block_res+1].to(self.device), indexing="ij")
         xyz = torch.stack([x, y, z], dim=-1)
-        sample.update(xyz=xyz)
+        sample.update(xyz=xyz, offset=(xs, ys, zs), pad=(xi - xs, yi - ys, zi - zs))
         return sample
 
     def __len__(self):
-        return self.num_blocks_x * self.num_blocks_y * self.num_blocks_z
+        return len(self.block_indices)
 
 
-def get_lattice_grid_loader(dataset, num_workers=8):
-    if dist.is_initialized():
-        sampler = torch.utils.data.distributed.DistributedSampler(dataset, shuffle=False)
-    else:
-        sampler = None
-    return torch.utils.data.DataLoader(
-        dataset,
-        batch_size=1,
-        shuffle=False,
-        sampler=sampler,
-        pin_memory=True,
-        num_workers=num_workers,
-        drop_last=False
-    )
-
-
-def marching_cubes(sdf, xyz, intv, texture_func, filter_lcc):
-    # marching cubes
-    V, F = mcubes.marching_cubes(sdf, 0.)
-    if V.shape[0] > 0:
-        V = V * intv + xyz[0, 0, 0]
-        if texture_func is not None:
-            C = texture_func(V)
-            mesh = trimesh.Trimesh(V, F, vertex_colors=C)
+def marching_cubes(sdf, origin, intv, block_offset, lattice_shape, level=0., crop_bounds=None):
+    """Run marching cubes on a lattice block, keeping the vertices inside the unit bounding sphere.
+    Args:
+        sdf (np.ndarray [X,Y,Z]): SDF values of the block.
+        origin (np.ndarray [3]): Coordinates of the first lattice point of the block.
+        intv (float): Lattice interval.
+        block_offset (int [3]): Lattice index of the first lattice point of the block.
+        lattice_shape (int [3]): Number of lattice points along each axis.
+        level (float): Level of the extracted level set.
+        crop_bounds (float [3,2]): Only keep the vertices inside these bounds.
+    Returns:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        edge_ids (np.ndarray [V]): Global IDs of the lattice edges the vertices lie on (see get_lattice_edge_ids).
+    """
+    # Keep the vertices off the lattice points: a vertex on a lattice point is only emitted by the cells on one side of
+    # it, which may not include the block owning it (see get_edge_owner_blocks). The SDF values (almost) at the level
+    # are moved slightly above it, the same way in every block.
+    eps = 1e-6 * intv
+    sdf = sdf.astype(np.float64)
+    sdf[np.abs(sdf - level) < eps] = level + eps
+    V, F = mcubes.marching_cubes(sdf, level)
+    edge_ids = get_lattice_edge_ids(V, block_offset, lattice_shape)
+    V = V * intv + origin
+    mask = np.linalg.norm(V, axis=-1) < 1.0
+    if crop_bounds is not None:
+        crop_bounds = np.asarray(crop_bounds)  # [3,2]
+        mask &= ((V >= crop_bounds[:, 0]) & (V <= crop_bounds[:, 1])).all(axis=-1)
+    return filter_vertices(V, F.astype(np.int64), mask, edge_ids)
+
+
+def surface_nets(sdf, origin, intv, block_offset, lattice_shape, pad, block_res, level=0., crop_bounds=None):
+    """Run surface nets on a lattice block, keeping the vertices inside the unit bounding sphere. A vertex is placed
+    in each cell with a sign change (at the mean of the crossings along the cell edges), and each lattice edge with a
+    sign change is meshed by the quad connecting the 4 cells around it (split into 2 triangles along its shorter
+    diagonal). The vertices are only approximately on the level set; they can be refined with the SDF gradients (see
+    refine_vertices). A block meshes the lattice edges starting in its unpadded part, so the blocks are padded with
+    the previous lattice points (see LatticeGrid) to get the cells around the edges on their lower boundaries.
+    Args:
+        sdf (np.ndarray [X,Y,Z]): SDF values of the (padded) block.
+        origin (np.ndarray [3]): Coordinates of the first lattice point of the block.
+        intv (float): Lattice interval.
+        block_offset (int [3]): Lattice index of the first lattice point of the block.
+        lattice_shape (int [3]): Number of lattice points along each axis.
+        pad (int [3]): Number of padding lattice points of the block along each axis.
+        block_res (int): Block resolution (number of lattice cells per block and per axis).
+        level (float): Level of the extracted level set.
+        crop_bounds (float [3,2]): Only keep the vertices inside these bounds.
+    Returns:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        cell_ids (np.ndarray [V]): Global IDs of the lattice cells the vertices lie in (see get_lattice_cell_ids).
+    """
+    sdf = sdf - level
+    inside = sdf > 0  # [X,Y,Z]
+    cell_shape = tuple(size - 1 for size in sdf.shape)
+    # Crossings of each cell, relative to its first lattice point.
+    num_crossings = np.zeros(cell_shape, dtype=np.int64)  # [X-1,Y-1,Z-1]
+    crossing_sum = np.zeros((3, *cell_shape))  # [3,X-1,Y-1,Z-1]
+    edge_crossings = []
+    for axis in range(3):
+        axis_u, axis_v = (axis + 1) % 3, (axis + 2) % 3
+        first = tuple(slice(0, -1) if dim == axis else slice(None) for dim in range(3))
+        last = tuple(slice(1, None) if dim == axis else slice(None) for dim in range(3))
+        crossing = inside[first] != inside[last]  # [E_x,E_y,E_z]
+        sdf_first = sdf[first]
+        t = np.where(crossing, sdf_first / np.where(crossing, sdf_first - sdf[last], 1.), 0.)  # [E_x,E_y,E_z]
+        # The edges along the axis are shared by the 4 cells around them.
+        for du, dv in np.ndindex(2, 2):
+            index = [slice(None)] * 3
+            index[axis_u] = slice(du, du + cell_shape[axis_u])
+            index[axis_v] = slice(dv, dv + cell_shape[axis_v])
+            crossing_cell = crossing[tuple(index)]  # [X-1,Y-1,Z-1]
+            num_crossings += crossing_cell
+            crossing_sum[axis] += t[tuple(index)]
+            crossing_sum[axis_u] += du * crossing_cell
+            crossing_sum[axis_v] += dv * crossing_cell
+        edge_crossings.append((crossing, inside[first]))
+    cells = num_crossings > 0  # [X-1,Y-1,Z-1]
+    cell_index = np.stack(np.nonzero(cells), axis=-1)  # [V,3]
+    V = cell_index + crossing_sum[:, cells].T / num_crossings[cells][:, None]  # [V,3]
+    cell_vertices = np.full(cell_shape, -1, dtype=np.int64)  # [X-1,Y-1,Z-1]
+    cell_vertices[cells] = np.arange(len(cell_index))
+    # Mesh the edges starting in the unpadded part of the block (and surrounded by 4 cells).
+    pad = np.asarray(pad)
+    quads = []
+    for axis, (crossing, inside_first) in enumerate(edge_crossings):
+        axis_u, axis_v = (axis + 1) % 3, (axis + 2) % 3
+        edges = np.stack(np.nonzero(crossing), axis=-1)  # [E,3]
+        outward = inside_first[crossing]  # [E]
+        mask = ((edges >= pad) & (edges < pad + block_res)).all(axis=-1)
+        for dim in [axis_u, axis_v]:
+            mask &= (edges[:, dim] >= 1) & (edges[:, dim] < cell_shape[dim])
+        edges, outward = edges[mask], outward[mask]
+        offset_u, offset_v = np.eye(3, dtype=np.int64)[axis_u], np.eye(3, dtype=np.int64)[axis_v]
+        # The cells around the edge, counterclockwise around the axis.
+        corners = [edges - offset_u - offset_v, edges - offset_v, edges, edges - offset_u]
+        quad = np.stack([cell_vertices[tuple(corner.T)] for corner in corners], axis=-1)  # [E,4]
+        # Orient the quads towards the outside (where the SDF values are lower).
+        quads.append(np.where(outward[:, None], quad, quad[:, ::-1]))
+    quads = np.concatenate(quads)  # [Q,4]
+    diag_02 = np.linalg.norm(V[quads[:, 0]] - V[quads[:, 2]], axis=-1)  # [Q]
+    diag_13 = np.linalg.norm(V[quads[:, 1]] - V[quads[:, 3]], axis=-1)  # [Q]
+    split_02 = (diag_02 <= diag_13)[:, None]  # [Q,1]
+    F = np.concatenate([np.where(split_02, quads[:, [0, 1, 2]], quads[:, [0, 1, 3]]),
+                        np.where(split_02, quads[:, [0, 2, 3]], quads[:, [1, 2, 3]])])  # [2Q,3]
+    cell_ids = get_lattice_cell_ids(cell_index, block_offset, lattice_shape)
+    V = V * intv + origin
+    mask = np.linalg.norm(V, axis=-1) < 1.0
+    if crop_bounds is not None:
+        crop_bounds = np.asarray(crop_bounds)  # [3,2]
+        mask &= ((V >= crop_bounds[:, 0]) & (V <= crop_bounds[:, 1])).all(axis=-1)
+    return filter_vertices(V, F, mask, cell_ids)
+
+
+def get_lattice_cell_ids(cells, block_offset, lattice_shape):
+    """Identify the surface nets vertices by the lattice cell they lie in, so that the vertices computed by different
+    blocks (in their padding) can be welded exactly. The cells are identified by their last lattice point, so that
+    get_edge_owner_blocks gives the block the cell belongs to.
+    Args:
+        cells (np.ndarray [V,3]): Cells (lattice index of their first lattice point) in the block.
+        block_offset (int [3]): Lattice index of the first lattice point of the block.
+        lattice_shape (int [3]): Number of lattice points along each axis.
+    Returns:
+        cell_ids (np.ndarray [V]): Global cell IDs (lattice point index * 4 + 3, see get_lattice_edge_ids).
+    """
+    index = cells.astype(np.int64) + np.asarray(block_offset, dtype=np.int64) + 1  # [V,3]
+    _, res_y, res_z = lattice_shape
+    return ((index[:, 0] * res_y + index[:, 1]) * res_z + index[:, 2]) * 4 + 3
+
+
+def get_lattice_edge_ids(vertices, block_offset, lattice_shape):
+    """Identify the marching cubes vertices by the lattice edge they lie on, so that the vertices computed by
+    different blocks (or different cells of a block) along the same edge can be welded exactly. In lattice index
+    coordinates, the vertices have integer coordinates except along the axis of their edge; vertices falling exactly on
+    a lattice point are identified by the lattice point.
+    Args:
+        vertices (np.ndarray [V,3]): Vertices in lattice index coordinates of the block.
+        block_offset (int [3]): Lattice index of the first lattice point of the block.
+        lattice_shape (int [3]): Number of lattice points along each axis.
+    Returns:
+        edge_ids (np.ndarray [V]): Global edge IDs (lattice point index * 4 + edge axis, or 3 for a lattice point).
+    """
+    base = np.floor(vertices)  # [V,3]
+    on_edge = vertices > base  # [V,3]
+    axis = np.where(on_edge.any(axis=-1), on_edge.argmax(axis=-1), 3)  # [V]
+    index = base.astype(np.int64) + np.asarray(block_offset, dtype=np.int64)  # [V,3]
+    _, res_y, res_z = lattice_shape
+    return ((index[:, 0] * res_y + index[:, 1]) * res_z + index[:, 2]) * 4 + axis
+
+
+def get_edge_owner_blocks(edge_ids, lattice_grid):
+    """Get the block owning each lattice edge. The blocks share their boundary lattice points, so the edges on a
+    block boundary are meshed by several blocks; they are owned by the first of them.
+    Args:
+        edge_ids (np.ndarray [N]): Global edge IDs (see get_lattice_edge_ids).
+        lattice_grid (LatticeGrid): The lattice grid.
+    Returns:
+        block_indices (np.ndarray [N]): Indices of the owner blocks.
+    """
+    axis = edge_ids % 4  # [N]
+    index = edge_ids // 4  # [N]
+    _, res_y, res_z = lattice_grid.shape
+    coords = np.stack([index // (res_y * res_z), (index // res_z) % res_y, index % res_z], axis=-1)  # [N,3]
+    block_coords = coords // lattice_grid.block_res  # [N,3]
+    # Along the non-edge axes, a lattice point on a block boundary belongs to the previous block as well.
+    shared = (coords % lattice_grid.block_res == 0) & (coords > 0) & (axis[:, None] != np.arange(3))  # [N,3]
+    block_coords -= shared
+    return (block_coords[:, 0] * lattice_grid.num_blocks_y + block_coords[:, 1]) * lattice_grid.num_blocks_z + \
+        block_coords[:, 2]
+
+
+def merge_mesh_blocks(mesh_blocks):
+    """Merge the meshes of the lattice blocks, welding the vertices on the same lattice edge (including the duplicated
+    vertices along the block seams).
+    Args:
+        mesh_blocks (list of tuples): Vertices [V,3], faces [F,3] and edge IDs [V] of each block.
+    Returns:
+        vertices (np.ndarray [V,3]): Welded mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces (without the faces collapsed by the welding).
+    """
+    vertices_all, faces_all, edge_ids_all = [], [], []
+    num_vertices = 0
+    for vertices, faces, edge_ids in mesh_blocks:
+        vertices_all.append(vertices)
+        faces_all.append(faces + num_vertices)
+        edge_ids_all.append(edge_ids)
+        num_vertices += len(vertices)
+    if num_vertices == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    _, first_idx, inverse_idx = np.unique(np.concatenate(edge_ids_all), return_index=True, return_inverse=True)
+    vertices = np.concatenate(vertices_all)[first_idx]
+    faces = inverse_idx.reshape(-1)[np.concatenate(faces_all)]
+    collapsed = (faces[:, 0] == faces[:, 1]) | (faces[:, 1] == faces[:, 2]) | (faces[:, 2] == faces[:, 0])
+    return vertices, faces[~collapsed]
+
+
+def filter_vertices(vertices, faces, mask, *vertex_attrs):
+    """Keep the masked vertices (and their attributes) and the faces whose vertices are all kept.
+    Args:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+        mask (np.ndarray [V]): Vertices to keep.
+        vertex_attrs (np.ndarray [V,...]): Per-vertex attributes.
+    Returns:
+        The kept vertices, the reindexed faces and the kept vertex attributes.
+    """
+    indices = np.full(len(vertices), -1, dtype=np.int64)
+    indices[mask] = np.arange(mask.sum())
+    faces_mask = mask[faces].all(axis=-1)
+    return (vertices[mask], indices[faces[faces_mask]], *[attr[mask] for attr in vertex_attrs])
+
+
+def filter_largest_cc(vertices, faces):
+    """Keep the connected component with the largest area, found with a single connected-component pass over the
+    vertex graph of the (welded) mesh.
+    Args:
+        vertices (np.ndarray [V,3]): Mesh vertices.
+        faces (np.ndarray [F,3]): Mesh faces.
+    Returns:
+        vertices (np.ndarray [V',3]): Vertices of the largest component.
+        faces (np.ndarray [F',3]): Faces of the largest component.
+    """
+    if len(faces) == 0:
+        return np.zeros((0, 3)), np.zeros((0, 3), dtype=np.int64)
+    edges = np.concatenate([faces[:, [0, 1]], faces[:, [1, 2]]])  # [2F,2]
+    graph = coo_matrix((np.ones(len(edges), dtype=bool), (edges[:, 0], edges[:, 1])),
+                       shape=(len(vertices), len(vertices)))
+    num_components, labels = connected_components(graph, directed=False)
+    v0, v1, v2 = vertices[faces[:, 0]], vertices[faces[:, 1]], vertices[faces[:, 2]]
+    areas = np.linalg.norm(np.cross(v1 - v0, v2 - v0), axis=-1) / 2
+    component_areas = np.bincount(labels[faces[:, 0]], weights=areas, minlength=num_components)
+    return filter_vertices(vertices, faces, labels == component_areas.argmax())
+
+
+class MeshSpillWriter(object):
+
+    def __init__(self, fname, lattice_grid, texture_func=None, texture_batch_size=2 ** 18, refine_func=None):
+        """Stream the meshes of the lattice blocks to a binary spill file for out-of-core extraction. Each block
+        stores the (welded) vertices it owns (see get_edge_owner_blocks), their colors and edge IDs, and its faces as
+        edge IDs, which are resolved into vertex indices when assembling the PLY file (see write_ply_from_spills).
+        Args:
+            fname (str): Path of the spill file.
+            lattice_grid (LatticeGrid): The lattice grid.
+            texture_func (function): Function returning the vertex colors (None for an untextured mesh).
+            texture_batch_size (int): Number of vertices per batch of texture_func.
+            refine_func (function): Function refining the vertices (applied before texturing).
+        """
+        self.fname = fname
+        self.lattice_grid = lattice_grid
+        self.texture_func = texture_func
+        self.texture_batch_size = texture_batch_size
+        self.refine_func = refine_func
+        self.records = []
+        self.file = open(fname, "wb")
+
+    def write_block(self, block_idx, mesh_block):
+        vertices, faces, edge_ids = mesh_block
+        if len(vertices) == 0:
+            return
+        face_ids = edge_ids[faces]  # [F,3]
+        collapsed = (face_ids[:, 0] == face_ids[:, 1]) | (face_ids[:, 1] == face_ids[:, 2]) | \
+            (face_ids[:, 2] == face_ids[:, 0])
+        face_ids = face_ids[~collapsed]
+        # Weld the vertices of the block and keep the ones it owns.
+        edge_ids, first_idx = np.unique(edge_ids, return_index=True)
+        owned = get_edge_owner_blocks(edge_ids, self.lattice_grid) == block_idx
+        vertices, edge_ids = vertices[first_idx[owned]], edge_ids[owned]
+        if self.refine_func is not None:
+            vertices = self.refine_func(vertices)
+        record = dict(block_idx=block_idx, offset=self.file.tell(), num_vertices=len(vertices),
+                      num_faces=len(face_ids))
+        self.file.write(vertices.astype(np.float64).tobytes())
+        if self.texture_func is not None:
+            colors = np.zeros((len(vertices), 4), dtype=np.uint8)
+            colors[:, 3] = 255
+            colors[:, :3] = get_vertex_colors(self.texture_func, vertices, batch_size=self.texture_batch_size)[:, :3]
+            self.file.write(colors.tobytes())
+        self.file.write(edge_ids.astype(np.int64).tobytes())
+        self.file.write(face_ids.astype(np.int64).tobytes())
+        self.records.append(record)
+
+    def close(self):
+        self.file.close()
+
+
+class MeshShardJob(object):
+
+    def __init__(self, path, lattice_grid, job_args, shard=(0, 1), texture_func=None, texture_batch_size=2 ** 18,
+                 refine_func=None):
+        """Resumable mesh extraction job. Each completed block is saved to its own spill file (see MeshSpillWriter),
+        which is then recorded in the manifest of the shard (one JSON line per block). The blocks recorded in the
+        manifests of all the shards are completed, so that they are skipped when the job is restarted.
+        Args:
+            path (str): Job directory.
+            lattice_grid (LatticeGrid): The lattice grid.
+            job_args (dict): Arguments of the extraction, which have to match the ones of the existing job.
+            shard (int [2]): Index and number of shards (only used to name the manifest).
+            texture_func (function): Function returning the vertex colors (None for an untextured mesh).
+            texture_batch_size (int): Number of vertices per batch of texture_func.
+            refine_func (function): Function refining the vertices (applied before texturing).
+        """
+        self.path = path
+        self.lattice_grid = lattice_grid
+        self.texture_func = texture_func
+        self.texture_batch_size = texture_batch_size
+        self.refine_func = refine_func
+        os.makedirs(os.path.join(path, "blocks"), exist_ok=True)
+        job_fname = os.path.join(path, "job.json")
+        if os.path.isfile(job_fname):
+            with open(job_fname) as file:
+                existing_job_args = json.load(file)
+            if existing_job_args != job_args:
+                raise ValueError(f"The extraction arguments do not match the ones of the job in {path}: "
+                                 f"{job_args} vs {existing_job_args}")
         else:
-            mesh = trimesh.Trimesh(V, F)
-        mesh = filter_points_outside_bounding_sphere(mesh)
-        mesh = filter_largest_cc(mesh) if filter_lcc else mesh
-    else:
-        mesh = trimesh.Trimesh()
-    return mesh
-
-
-def filter_points_outside_bounding_sphere(old_mesh):
-    mask = np.linalg.norm(old_mesh.vertices, axis=-1) < 1.0
-    if np.any(mask):
-        indices = np.ones(len(old_mesh.vertices), dtype=int) * -1
-        indices[mask] = np.arange(mask.sum())
-        faces_mask = mask[old_mesh.faces[:, 0]] & mask[old_mesh.faces[:, 1]] & mask[old_mesh.faces[:, 2]]
-        new_faces = indices[old_mesh.faces[faces_mask]]
-        new_vertices = old_mesh.vertices[mask]
-        new_colors = old_mesh.visual.vertex_colors[mask]
-        new_mesh = trimesh.Trimesh(new_vertices, new_faces, vertex_colors=new_colors)
-    else:
-        new_mesh = trimesh.Trimesh()
-    return new_mesh
+            # Independent processes may start the job at the same time.
+            with open(f"{job_fname}.{os.getpid()}.tmp", "w") as file:
+                json.dump(job_args, file)
+            os.replace(f"{job_fname}.{os.getpid()}.tmp", job_fname)
+        manifest_fname = os.path.join(path, f"manifest.{shard[0]}of{shard[1]}.jsonl")
+        if os.path.isfile(manifest_fname):
+            # Drop a record truncated by an interruption, so that the next ones are appended on a new line.
+            with open(manifest_fname, "rb+") as file:
+                file.truncate(file.read().rfind(b"\n") + 1)
+        self.completed = self.read_manifests()
+        self.manifest = open(manifest_fname, "a")
 
+    def read_manifests(self):
+        completed = dict()
+        for fname in sorted(os.listdir(self.path)):
+            if not (fname.startswith("manifest.") and fname.endswith(".jsonl")):
+                continue
+            with open(os.path.join(self.path, fname)) as file:
+                for line in file:
+                    # Skip a line truncated by an interruption (of another shard, which may still be running).
+                    if not line.endswith("\n"):
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    completed[record["block_idx"]] = record
+        return completed
 
-def filter_largest_cc(mesh):
-    components = mesh.split(only_watertight=False)
-    areas = np.array([c.area for c in components], dtype=float)
-    if len(areas) > 0 and mesh.vertices.shape[0] > 0:
-        new_mesh = components[areas.argmax()]
-    else:
-        new_mesh = trimesh.Trimesh()
-    return new_mesh
+    def write_block(self, block_idx, mesh_block):
+        fname = os.path.join(self.path, "blocks", f"block{block_idx:07d}.spill")
+        spill = MeshSpillWriter(f"{fname}.tmp", self.lattice_grid, texture_func=self.texture_func,
+                                texture_batch_size=self.texture_batch_size, refine_func=self.refine_func)
+        spill.write_block(block_idx, mesh_block)
+        spill.close()
+        os.replace(f"{fname}.tmp", fname)
+        # Blocks without vertices are recorded as well (as completed).
+        record = spill.records[0] if spill.records else dict(block_idx=block_idx, offset=0, num_vertices=0,
+                                                             num_faces=0)
+        record.update(file=os.path.basename(fname))
+        self.manifest.write(json.dumps(record) + "\n")
+        self.manifest.flush()
+        os.fsync(self.manifest.fileno())
+
+    def write_ply(self, fname, vertex_transform=None):
+        """Assemble the completed blocks into a binary PLY file (see write_ply_from_spills).
+        Args:
+            fname (str): Path of the PLY file.
+            vertex_transform (np.ndarray [4,4]): Transformation applied to the vertices.
+        """
+        completed = self.read_manifests()
+        missing = [idx for idx in self.lattice_grid.block_indices if idx not in completed]
+        if missing:
+            raise RuntimeError(f"{len(missing)} blocks of the job in {self.path} are not completed.")
+        spills = [(os.path.join(self.path, "blocks", record["file"]), [record]) for record in completed.values()
+                  if record["num_vertices"] > 0 or record["num_faces"] > 0]
+        write_ply_from_spills(fname, spills, self.lattice_grid, with_colors=self.texture_func is not None,
+                              vertex_transform=vertex_transform)
+
+    def close(self):
+        self.manifest.close()
+
+
+def read_spill_block(fname, record, with_colors, keys=("vertices", "colors", "edge_ids", "faces")):
+    """Read (parts of) a block from a spill file written by MeshSpillWriter.
+    Args:
+        fname (str): Path of the spill file.
+        record (dict): Record of the block (offset and sizes).
+        with_colors (bool): Whether the spill file contains the vertex colors.
+        keys (list of str): The arrays to read.
+    Returns:
+        block (dict): The vertices [V,3], colors [V,4], edge IDs [V] and faces (as edge IDs) [F,3] of the block.
+    """
+    num_vertices, num_faces = record["num_vertices"], record["num_faces"]
+    layout = [("vertices", np.float64, (num_vertices, 3)), ("colors", np.uint8, (num_vertices, 4)),
+              ("edge_ids", np.int64, (num_vertices,)), ("faces", np.int64, (num_faces, 3))]
+    block = dict()
+    offset = record["offset"]
+    for key, dtype, shape in layout:
+        if key == "colors" and not with_colors:
+            continue
+        count = int(np.prod(shape))
+        if key in keys:
+            block[key] = np.fromfile(fname, dtype=dtype, count=count, offset=offset).reshape(shape)
+        offset += count * np.dtype(dtype).itemsize
+    return block
+
+
+def write_ply_from_spills(fname, spills, lattice_grid, with_colors=False, vertex_transform=None,
+                          buffer_size=2 ** 24):
+    """Assemble the spill files of all the ranks into a binary PLY file. The blocks are written one at a time (in
+    block order), offsetting the vertex indices of the faces by the number of vertices of the previous blocks. The
+    faces are resolved twice (first to count them for the header), and only the edge IDs of the few owner blocks
+    around the current block are cached.
+    Args:
+        fname (str): Path of the PLY file.
+        spills (list of tuples): Path and block records of the spill file of each rank.
+        lattice_grid (LatticeGrid): The lattice grid.
+        with_colors (bool): Whether the spill files contain the vertex colors.
+        vertex_transform (np.ndarray [4,4]): Transformation applied to the vertices.
+        buffer_size (int): Size of the write buffer (in bytes).
+    """
+    blocks = dict()
+    for spill_fname, records in spills:
+        for record in records:
+            blocks[record["block_idx"]] = (spill_fname, record)
+    vertex_offsets = dict()
+    num_vertices = 0
+    for block_idx in sorted(blocks):
+        vertex_offsets[block_idx] = num_vertices
+        num_vertices += blocks[block_idx][1]["num_vertices"]
+
+    @lru_cache(maxsize=64)
+    def get_edge_ids(block_idx):
+        return read_spill_block(*blocks[block_idx], with_colors, keys=["edge_ids"])["edge_ids"]
+
+    def resolve_faces(face_ids):
+        # Map the edge IDs to the indices of the vertices (in the owner blocks), dropping the faces with a vertex
+        # that its owner block did not keep (e.g. right on the bounding sphere).
+        face_ids = face_ids.reshape(-1)
+        faces = np.full(len(face_ids), -1, dtype=np.int64)
+        owners = get_edge_owner_blocks(face_ids, lattice_grid)
+        for owner in np.unique(owners):
+            if owner not in blocks:
+                continue
+            mask = owners == owner
+            edge_ids = get_edge_ids(owner)
+            if len(edge_ids) == 0:
+                continue
+            idx = np.searchsorted(edge_ids, face_ids[mask]).clip(max=len(edge_ids) - 1)
+            found = edge_ids[idx] == face_ids[mask]
+            faces[mask] = np.where(found, vertex_offsets[owner] + idx, -1)
+        faces = faces.reshape(-1, 3)
+        return faces[(faces >= 0).all(axis=-1)]
+
+    num_faces = sum(len(resolve_faces(read_spill_block(*blocks[block_idx], with_colors, keys=["faces"])["faces"]))
+                    for block_idx in sorted(blocks))
+    vertex_dtype = [("xyz", "<f4", 3)] + ([("rgba", "u1", 4)] if with_colors else [])
+    face_dtype = [("count", "u1"), ("indices", "<i4", 3)]
+    header = ["ply", "format binary_little_endian 1.0", f"element vertex {num_vertices}",
+              "property float x", "property float y", "property float z"]
+    if with_colors:
+        header += ["property uchar red", "property uchar green", "property uchar blue", "property uchar alpha"]
+    header += [f"element face {num_faces}", "property list uchar int vertex_indices", "end_header"]
+    with open(fname, "wb", buffering=buffer_size) as file:
+        file.write(("\n".join(header) + "\n").encode("ascii"))
+        for block_idx in sorted(blocks):
+            block = read_spill_block(*blocks[block_idx], with_colors, keys=["vertices", "colors"])
+            vertices = block["vertices"]
+            if vertex_transform is not None:
+                vertices = vertices @ vertex_transform[:3, :3].T + vertex_transform[:3, 3]
+            vertex_data = np.empty(len(vertices), dtype=vertex_dtype)
+            vertex_data["xyz"] = vertices
+            if with_colors:
+                vertex_data["rgba"] = block["colors"]
+            file.write(vertex_data.tobytes())
+        for block_idx in sorted(blocks):
+            faces = resolve_faces(read_spill_block(*blocks[block_idx], with_colors, keys=["faces"])["faces"])
+            face_data = np.empty(len(faces), dtype=face_dtype)
+            face_data["count"] = 3
+            face_data["indices"] = faces
+            file.write(face_data.tobytes())
+    print(f"Saved the mesh ({num_vertices} vertices, {num_faces} faces) to {fname}")
+
+
+class SDFVolumeWriter(object):
+
+    def __init__(self, fname):
+        """Stream the SDF blocks of a lattice grid to a data file of an SDF volume. The blocks are stored in float16
+        and compressed independently (zlib), so that they can be read back one at a time; the block records are
+        gathered into the index of the volume (see save_sdf_volume_index).
+        Args:
+            fname (str): Path of the data file.
+        """
+        self.fname = fname
+        self.records = []
+        self.file = open(fname, "wb")
+
+    def write_block(self, block_idx, sdf):
+        data = zlib.compress(sdf.astype(np.float16).tobytes(), level=1)
+        self.records.append(dict(block_idx=int(block_idx), file=os.path.basename(self.fname), offset=self.file.tell(),
+                                 num_bytes=len(data), shape=list(sdf.shape)))
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+
+def save_sdf_volume_index(path, records, lattice_args, vertex_transform=None):
+    """Save the index of an SDF volume, which marks the volume as complete.
+    Args:
+        path (str): Directory of the SDF volume.
+        records (list of dict): Records of the saved blocks (see SDFVolumeWriter).
+        lattice_args (dict): Bounds, lattice interval, block resolution and sparsity of the lattice grid.
+        vertex_transform (list [4,4]): Transformation applied to the extracted vertices (None if not used).
+    """
+    index = dict(lattice_args=lattice_args, vertex_transform=vertex_transform, dtype="float16", compression="zlib",
+                 blocks=sorted(records, key=lambda record: record["block_idx"]))
+    fname = os.path.join(path, "index.json")
+    with open(f"{fname}.tmp", "w") as file:
+        json.dump(index, file)
+    os.replace(f"{fname}.tmp", fname)
+
+
+class SDFVolume(object):
+
+    def __init__(self, path):
+        """Read the SDF blocks of an SDF volume saved by extract_mesh (see SDFVolumeWriter). Only the blocks that
+        were evaluated are stored, so that a sparse extraction gives a sparse volume.
+        Args:
+            path (str): Directory of the SDF volume.
+        """
+        self.path = path
+        with open(os.path.join(path, "index.json")) as file:
+            index = json.load(file)
+        self.lattice_args = index["lattice_args"]
+        self.vertex_transform = None
+        if index["vertex_transform"] is not None:
+            self.vertex_transform = np.array(index["vertex_transform"])
+        self.records = {record["block_idx"]: record for record in index["blocks"]}
+
+    @staticmethod
+    def exists(path):
+        return os.path.isfile(os.path.join(path, "index.json"))
+
+    def __contains__(self, block_idx):
+        return block_idx in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def read_block(self, block_idx):
+        """Read an SDF block.
+        Args:
+            block_idx (int): Index of the block in the lattice grid.
+        Returns:
+            sdf (np.ndarray [X,Y,Z]): SDF values of the block (float32).
+        """
+        record = self.records[block_idx]
+        with open(os.path.join(self.path, record["file"]), "rb") as file:
+            file.seek(record["offset"])
+            data = zlib.decompress(file.read(record["num_bytes"]))
+        return np.frombuffer(data, dtype=np.float16).reshape(record["shape"]).astype(np.float32)
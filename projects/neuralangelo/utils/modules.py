@@ -11,16 +11,94 @@ license agreement from NVIDIA CORPORATION is strictly prohibited.
 '''
 
 import torch
+import warnings
 from functools import partial
 import numpy as np
-import tinycudann as tcnn
+
+try:
+    import tinycudann as tcnn
+except ImportError:
+    tcnn = None
 
 from projects.neuralangelo.utils.spherical_harmonics import get_spherical_harmonics
 from projects.neuralangelo.utils.mlp import MLPforNeuralSDF
+from projects.neuralangelo.utils.hashgrid import HashGridEncoding
 from projects.neuralangelo.utils.misc import get_activation
 from projects.nerf.utils import nerf_util
 
 
+def get_hashgrid_encoding(cfg_hashgrid, config):
+    """Build the multi-resolution hash grid with the backend selected by `hashgrid.backend`.
+    Args:
+        cfg_hashgrid (obj): The hash grid config (the backend is either "tcnn" or "torch").
+        config (dict): The tcnn HashGrid encoding config.
+    Returns:
+        encoding (torch.nn.Module): Maps [N,3] points in [0,1] to [N,LD] features.
+    """
+    backend = getattr(cfg_hashgrid, "backend", "tcnn")
+    if backend == "tcnn" and tcnn is None:
+        warnings.warn("tinycudann is not available, falling back to the PyTorch hash grid backend.")
+        backend = "torch"
+    if backend == "tcnn":
+        encoding = tcnn.Encoding(3, config)
+    elif backend == "torch":
+        # Same parameter layout as tcnn, so checkpoints can be loaded with either backend.
+        encoding = HashGridEncoding(3, config)
+    else:
+        raise NotImplementedError("Unknown hash grid backend")
+    return encoding
+
+
+def hashgrid_encode(encoding, x, active_levels=None):
+    """Encode the points with the hash grid, skipping the inactive (coarse-to-fine) levels if supported.
+    Args:
+        encoding (torch.nn.Module): The hash grid encoding (from get_hashgrid_encoding).
+        x (tensor [N,3]): Input points, normalized to [0,1].
+        active_levels (int): Number of active levels, or None to evaluate all levels.
+    Returns:
+        feat (tensor [N,LF]): The encoded features.
+        skipped (bool): Whether the inactive levels were skipped (and zero-padded) by the encoding itself.
+    """
+    # Only the PyTorch backend can skip levels; tcnn always evaluates all levels.
+    if active_levels is not None and isinstance(encoding, HashGridEncoding):
+        return encoding(x, active_levels=active_levels), True
+    return encoding(x), False
+
+
+def get_coarse2fine_mask(cache, active_levels, points_enc, feat_dim):
+    """Get the coarse-to-fine mask of the encoding, which only depends on the number of active levels.
+    The mask is cached per active level and broadcast over the points instead of being allocated at every call.
+    Args:
+        cache (dict): The mask cache of the module.
+        active_levels (int): Number of active levels.
+        points_enc (tensor [...,LD]): The encoded points.
+        feat_dim (int): Feature dimension per level.
+    Returns:
+        mask (tensor [LD]): The coarse-to-fine mask.
+    """
+    key = (active_levels, feat_dim, points_enc.shape[-1], points_enc.dtype, points_enc.device)
+    if key not in cache:
+        mask = torch.zeros(points_enc.shape[-1], dtype=points_enc.dtype, device=points_enc.device)
+        mask[:(active_levels * feat_dim)] = 1
+        cache[key] = mask
+    return cache[key]
+
+
+def get_sdf_taps(sdf_func, x, taps, eps):
+    """Evaluate the SDF at the numerical gradient taps (x+k*eps) in a single batched pass.
+    Args:
+        sdf_func (callable): The SDF function.
+        x (tensor [...,3]): The points where the gradients are computed.
+        taps (tensor [T,3]): The tap directions k.
+        eps (float or tensor [...,1]): The step size (global or per point).
+    Returns:
+        sdfs (tuple of T tensors [...,1]): The SDF values at the taps.
+    """
+    taps = taps.view(len(taps), *[1] * (x.dim() - 1), 3)  # [T,1,...,1,3]
+    x_taps = x + taps * eps  # [T,...,3]
+    return sdf_func(x_taps).unbind(dim=0)
+
+
 class SpatialMaskNeuralSDF(torch.nn.Module):
 
     def __init__(self, cfg_sdf):
@@ -39,8 +117,10 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
 
         self.mask_mlp = self.build_mlp(cfg_sdf.spatialmask.mlp, input_dim=mask_input_dim)
 
-        self.class_weights = torch.arange(cfg_sdf.encoding.levels, device='cuda' ).reshape(1, 1, 1, cfg_sdf.encoding.levels)**2
-        self.class_weights_sum = torch.sum(torch.arange(cfg_sdf.encoding.levels, device='cuda')**2)
+        class_weights = torch.arange(cfg_sdf.encoding.levels).reshape(1, 1, 1, cfg_sdf.encoding.levels) ** 2
+        self.register_buffer("class_weights", class_weights, persistent=False)
+        self.register_buffer("class_weights_sum", class_weights.sum(), persistent=False)
+        self._coarse2fine_masks = dict()
         
 
     def build_sdf_encoding(self, cfg_encoding):
@@ -60,7 +140,7 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
                 base_resolution=2 ** cfg_encoding.hashgrid.min_logres,
                 per_level_scale=self.growth_rate,
             )
-            self.tcnn_encoding = tcnn.Encoding(3, config)
+            self.tcnn_encoding = get_hashgrid_encoding(cfg_encoding.hashgrid, config)
             self.resolutions = []
             for lv in range(0, num_levels):
                 
@@ -92,7 +172,7 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
                 base_resolution=2 ** cfg_encoding.hashgrid.min_logres,
                 per_level_scale=self.mask_growth_rate,
             )
-            self.mask_tcnn_encoding = tcnn.Encoding(3, config)
+            self.mask_tcnn_encoding = get_hashgrid_encoding(cfg_encoding.hashgrid, config)
             self.mask_resolutions = []
             
             for lv in range(0, num_levels):
@@ -120,71 +200,75 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
         return mlp
 
     def forward(self, points_3D, with_sdf=True, with_feat=True, with_mask=True):
-        
-        ##change spatial mask mlp so we dont have to extract from tuple
-        ## WIP 
-        #points_enc = self.encode(points_3D) 
-
-        spatial_mask = self.mask_mlp(self.mask_encode(points_3D))[1] 
- 
-        ## Don't apply mask to first 4 levels?
-        #maskmask = torch.ones_like(spatial_mask, requires_grad=False)
-        #spatial_mask = torch.cat([maskmask[...,:4], spatial_mask[...,4:]], dim=-1) 
-    
-        #if self.active_levels > self.cfg_sdf.encoding.coarse2fine.init_active_level:
+        spatial_mask = self.get_spatial_mask(points_3D)  # [...,L]
+        points_enc = self.encode(points_3D)  # [...,LD]
+        masked_points_enc = self.apply_spatial_mask(points_3D, points_enc, spatial_mask)  # [...,3+LD]
+        # With split_feat, the features come from feat_mlp and the feature layer of the SDF MLP is not needed.
+        split_feat = self.cfg_sdf.mlp.split_feat
+        sdf, feat = self.mlp(masked_points_enc, with_sdf=with_sdf, with_feat=with_feat and not split_feat)
+        if split_feat and with_feat:
+            points_enc = torch.cat([points_3D, points_enc], dim=-1)  # [...,3+LD]
+            _, feat = self.feat_mlp(points_enc, with_sdf=False, with_feat=True)
+        return sdf, feat, spatial_mask  # [...,1],[...,K],[...,L]
 
-            #spatial_mask = self.mask_mlp(self.mask_encode(points_3D))[1]      
+    def sdf(self, points_3D):
+        return self.sdf_with_mask(points_3D)[0]
 
+    def sdf_with_mask(self, points_3D):
+        # SDF-only path: skips the feature layer of the SDF MLP and the feature MLP.
+        spatial_mask = self.get_spatial_mask(points_3D)  # [...,L]
+        points_enc = self.encode(points_3D)  # [...,LD]
+        masked_points_enc = self.apply_spatial_mask(points_3D, points_enc, spatial_mask)  # [...,3+LD]
+        sdf, _ = self.mlp(masked_points_enc, with_sdf=True, with_feat=False)
+        return sdf, spatial_mask  # [...,1],[...,L]
+
+    def feat(self, points_3D, spatial_mask=None):
+        # Feature-only path for points whose SDF (and spatial mask) have already been evaluated.
+        points_enc = self.encode(points_3D)  # [...,LD]
+        if self.cfg_sdf.mlp.split_feat:
+            points_enc = torch.cat([points_3D, points_enc], dim=-1)  # [...,3+LD]
+            _, feat = self.feat_mlp(points_enc, with_sdf=False, with_feat=True)
+        else:
+            if spatial_mask is None:
+                spatial_mask = self.get_spatial_mask(points_3D)  # [...,L]
+            masked_points_enc = self.apply_spatial_mask(points_3D, points_enc, spatial_mask)  # [...,3+LD]
+            _, feat = self.mlp(masked_points_enc, with_sdf=False, with_feat=True)
+        return feat  # [...,K]
+
+    def get_spatial_mask(self, points_3D):
+        # Only the (per-level) mask features of the mask MLP are used.
+        _, spatial_mask = self.mask_mlp(self.mask_encode(points_3D), with_sdf=False, with_feat=True)  # [...,L]
         if self.cfg_sdf.encoding.coarse2fine.enabled:
             prog_mask = self._get_coarse2fine_mask(spatial_mask, feat_dim=1)
             spatial_mask = spatial_mask * prog_mask
-            
-        #print(spatial_mask)
-
-        points_enc = self.encode(points_3D) 
-
-        points_enc_reshaped = points_enc.view(points_enc.shape[0], points_enc.shape[1], points_enc.shape[2], 
-                                                self.cfg_sdf.encoding.levels, self.cfg_sdf.encoding.hashgrid.dim)
-        masked = spatial_mask.unsqueeze(-1)*points_enc_reshaped
-        masked = masked.view(points_enc.shape[0], points_enc.shape[1], points_enc.shape[2], -1)
-       
-        masked_points_enc = torch.cat([points_3D, masked], dim=-1)
-
-        # else:
+        return spatial_mask
 
-            #points_enc = torch.cat([points_3D, self.encode(points_3D)], dim=-1)
-            
-        sdf, feat = self.mlp(masked_points_enc, with_sdf=with_sdf, with_feat=with_feat)
-
-        if self.cfg_sdf.mlp.split_feat:
-            points_enc = torch.cat([points_3D, points_enc], dim=-1)
-            _, feat = self.feat_mlp(points_enc, with_sdf=False, with_feat=True)
-            
-        return sdf, feat, spatial_mask  # [...,1],[...,K]
-
-    def sdf(self, points_3D):
-        return self.forward(points_3D, with_sdf=True, with_feat=False, with_mask=False)[0]
-    
-    def sdf_with_mask(self, points_3D):
-        out = self.forward(points_3D, with_sdf=True, with_feat=False, with_mask=True)
-        return out[0], out[2] 
+    def apply_spatial_mask(self, points_3D, points_enc, spatial_mask):
+        # Scale the features of each level by the corresponding mask value.
+        points_enc = points_enc.unflatten(-1, (self.cfg_sdf.encoding.levels, -1))  # [...,L,D]
+        masked = (spatial_mask[..., None] * points_enc).flatten(-2)  # [...,LD]
+        masked_points_enc = torch.cat([points_3D, masked], dim=-1)  # [...,3+LD]
+        return masked_points_enc
 
     def mask_encode(self, points_3D):
         if self.cfg_sdf.encoding.type == "fourier":
             points_enc = nerf_util.positional_encoding(points_3D, num_freq_bases=self.cfg_sdf.encoding.levels)
             feat_dim = 6
+            skipped = False
         elif self.cfg_sdf.encoding.type == "hashgrid":
             # Tri-linear interpolate the corresponding embeddings from the dictionary.
             vol_min, vol_max = self.cfg_sdf.spatialmask.encoding.hashgrid.range
             points_3D_normalized = (points_3D - vol_min) / (vol_max - vol_min)  # Normalize to [0,1].
             tcnn_input = points_3D_normalized.view(-1, 3)
-            tcnn_output = self.mask_tcnn_encoding(tcnn_input)
+            coarse2fine = self.cfg_sdf.spatialmask.encoding.coarse2fine_hash.enabled
+            tcnn_output, skipped = hashgrid_encode(self.mask_tcnn_encoding, tcnn_input,
+                                                   active_levels=self.active_levels if coarse2fine else None)
             points_enc = tcnn_output.view(*points_3D_normalized.shape[:-1], tcnn_output.shape[-1])
             feat_dim = self.cfg_sdf.spatialmask.encoding.hashgrid.dim
         else:
             raise NotImplementedError("Unknown encoding type")
         # Coarse-to-fine.
-        if self.cfg_sdf.spatialmask.encoding.coarse2fine_hash.enabled:
+        if self.cfg_sdf.spatialmask.encoding.coarse2fine_hash.enabled and not skipped:
             mask = self._get_coarse2fine_mask(points_enc, feat_dim=feat_dim)
             points_enc = points_enc * mask
         points_enc = torch.cat([points_3D, points_enc], dim=-1)  # [B,R,N,3+LD]
@@ -194,18 +278,21 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
         if self.cfg_sdf.encoding.type == "fourier":
             points_enc = nerf_util.positional_encoding(points_3D, num_freq_bases=self.cfg_sdf.encoding.levels)
             feat_dim = 6
+            skipped = False
         elif self.cfg_sdf.encoding.type == "hashgrid":
             # Tri-linear interpolate the corresponding embeddings from the dictionary.
             vol_min, vol_max = self.cfg_sdf.encoding.hashgrid.range
             points_3D_normalized = (points_3D - vol_min) / (vol_max - vol_min)  # Normalize to [0,1].
             tcnn_input = points_3D_normalized.view(-1, 3)
-            tcnn_output = self.tcnn_encoding(tcnn_input)
+            coarse2fine = self.cfg_sdf.encoding.coarse2fine.enabled
+            tcnn_output, skipped = hashgrid_encode(self.tcnn_encoding, tcnn_input,
+                                                   active_levels=self.active_levels if coarse2fine else None)
             points_enc = tcnn_output.view(*points_3D_normalized.shape[:-1], tcnn_output.shape[-1])
             feat_dim = self.cfg_sdf.encoding.hashgrid.dim
         else:
             raise NotImplementedError("Unknown encoding type")
         # Coarse-to-fine.
-        if self.cfg_sdf.encoding.coarse2fine.enabled:
+        if self.cfg_sdf.encoding.coarse2fine.enabled and not skipped:
             mask = self._get_coarse2fine_mask(points_enc, feat_dim=feat_dim)
             points_enc = points_enc * mask
         #points_enc = torch.cat([points_3D, points_enc], dim=-1)  # [B,R,N,3+LD]
@@ -239,8 +326,7 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
         #it += 1
 
 
-        mask = torch.zeros_like(points_enc)
-        mask[..., :(self.active_levels * feat_dim)] = 1
+        mask = get_coarse2fine_mask(self._coarse2fine_masks, self.active_levels, points_enc, feat_dim)
         
         #reveal_param = min((it / self.cfg_sdf.encoding.coarse2fine.step)*2, 1)
 
@@ -268,15 +354,10 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
             if self.cfg_sdf.gradient.taps == 6:
                 eps = self.normal_eps
                 # 1st-order gradient
-                eps_x = torch.tensor([eps, 0., 0.], dtype=x.dtype, device=x.device)  # [3]
-                eps_y = torch.tensor([0., eps, 0.], dtype=x.dtype, device=x.device)  # [3]
-                eps_z = torch.tensor([0., 0., eps], dtype=x.dtype, device=x.device)  # [3]
-                sdf_x_pos = self.sdf(x + eps_x)  # [...,1]
-                sdf_x_neg = self.sdf(x - eps_x)  # [...,1]
-                sdf_y_pos = self.sdf(x + eps_y)  # [...,1]
-                sdf_y_neg = self.sdf(x - eps_y)  # [...,1]
-                sdf_z_pos = self.sdf(x + eps_z)  # [...,1]
-                sdf_z_neg = self.sdf(x - eps_z)  # [...,1]
+                taps = torch.tensor([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]],
+                                    dtype=x.dtype, device=x.device)  # [6,3]
+                sdf_taps = get_sdf_taps(self.sdf, x, taps, eps)  # 6x[...,1]
+                sdf_x_pos, sdf_x_neg, sdf_y_pos, sdf_y_neg, sdf_z_pos, sdf_z_neg = sdf_taps
                 gradient_x = (sdf_x_pos - sdf_x_neg) / (2 * eps)
                 gradient_y = (sdf_y_pos - sdf_y_neg) / (2 * eps)
                 gradient_z = (sdf_z_pos - sdf_z_neg) / (2 * eps)
@@ -310,10 +391,10 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
                     #print(eps.shape)
                     #scheduled_eps = torch.ones_like(eps)*(self.normal_eps/np.sqrt(3))
 
-                    k1 = torch.tensor([1, -1, -1], dtype=x.dtype, device=x.device).view(1, 1, 1, 3)  # [3]
-                    k2 = torch.tensor([-1, -1, 1], dtype=x.dtype, device=x.device).view(1, 1, 1, 3)  # [3]
-                    k3 = torch.tensor([-1, 1, -1], dtype=x.dtype, device=x.device).view(1, 1, 1, 3)  # [3]
-                    k4 = torch.tensor([1, 1, 1], dtype=x.dtype, device=x.device).view(1, 1, 1, 3)  # [3]
+                    k1 = torch.tensor([1, -1, -1], dtype=x.dtype, device=x.device)  # [3]
+                    k2 = torch.tensor([-1, -1, 1], dtype=x.dtype, device=x.device)  # [3]
+                    k3 = torch.tensor([-1, 1, -1], dtype=x.dtype, device=x.device)  # [3]
+                    k4 = torch.tensor([1, 1, 1], dtype=x.dtype, device=x.device)  # [3]
 
 
                 else:    
@@ -324,10 +405,8 @@ class SpatialMaskNeuralSDF(torch.nn.Module):
                     k3 = torch.tensor([-1, 1, -1], dtype=x.dtype, device=x.device)  # [3]
                     k4 = torch.tensor([1, 1, 1], dtype=x.dtype, device=x.device)  # [3]
                 
-                sdf1 = self.sdf(x + k1 * eps)  # [...,1]
-                sdf2 = self.sdf(x + k2 * eps)  # [...,1]
-                sdf3 = self.sdf(x + k3 * eps)  # [...,1]
-                sdf4 = self.sdf(x + k4 * eps)  # [...,1]
+                # The 4 taps are evaluated in a single pass (eps is either a scalar or per-point [...,1]).
+                sdf1, sdf2, sdf3, sdf4 = get_sdf_taps(self.sdf, x, torch.stack([k1, k2, k3, k4]), eps)  # 4x[...,1]
             
                 gradient = (k1*sdf1 + k2*sdf2 + k3*sdf3 + k4*sdf4) / (4.0 * eps)    
 
@@ -356,6 +435,7 @@ class NeuralSDF(torch.nn.Module):
         encoding_dim = self.build_encoding(cfg_sdf.encoding)
         input_dim = 3 + encoding_dim
         self.build_mlp(cfg_sdf.mlp, input_dim=input_dim)
+        self._coarse2fine_masks = dict()
 
     def build_encoding(self, cfg_encoding):
         if cfg_encoding.type == "fourier":
@@ -374,7 +454,7 @@ class NeuralSDF(torch.nn.Module):
                 base_resolution=2 ** cfg_encoding.hashgrid.min_logres,
                 per_level_scale=self.growth_rate,
             )
-            self.tcnn_encoding = tcnn.Encoding(3, config)
+            self.tcnn_encoding = get_hashgrid_encoding(cfg_encoding.hashgrid, config)
             self.resolutions = []
             for lv in range(0, num_levels):
                 size = np.floor(r_min * self.growth_rate ** lv).astype(int) + 1
@@ -404,18 +484,21 @@ class NeuralSDF(torch.nn.Module):
         if self.cfg_sdf.encoding.type == "fourier":
             points_enc = nerf_util.positional_encoding(points_3D, num_freq_bases=self.cfg_sdf.encoding.levels)
             feat_dim = 6
+            skipped = False
         elif self.cfg_sdf.encoding.type == "hashgrid":
             # Tri-linear interpolate the corresponding embeddings from the dictionary.
             vol_min, vol_max = self.cfg_sdf.encoding.hashgrid.range
             points_3D_normalized = (points_3D - vol_min) / (vol_max - vol_min)  # Normalize to [0,1].
             tcnn_input = points_3D_normalized.view(-1, 3)
-            tcnn_output = self.tcnn_encoding(tcnn_input)
+            coarse2fine = self.cfg_sdf.encoding.coarse2fine.enabled
+            tcnn_output, skipped = hashgrid_encode(self.tcnn_encoding, tcnn_input,
+                                                   active_levels=self.active_levels if coarse2fine else None)
             points_enc = tcnn_output.view(*points_3D_normalized.shape[:-1], tcnn_output.shape[-1])
             feat_dim = self.cfg_sdf.encoding.hashgrid.dim
         else:
             raise NotImplementedError("Unknown encoding type")
         # Coarse-to-fine.
-        if self.cfg_sdf.encoding.coarse2fine.enabled:
+        if self.cfg_sdf.encoding.coarse2fine.enabled and not skipped:
             mask = self._get_coarse2fine_mask(points_enc, feat_dim=feat_dim)
             points_enc = points_enc * mask
         points_enc = torch.cat([points_3D, points_enc], dim=-1)  # [B,R,N,3+LD]
@@ -435,8 +518,7 @@ class NeuralSDF(torch.nn.Module):
 
     @torch.no_grad()
     def _get_coarse2fine_mask(self, points_enc, feat_dim):
-        mask = torch.zeros_like(points_enc)
-        mask[..., :(self.active_levels * feat_dim)] = 1
+        mask = get_coarse2fine_mask(self._coarse2fine_masks, self.active_levels, points_enc, feat_dim)
         return mask
 
     def compute_gradients(self, x, training=False, sdf=None):
@@ -459,15 +541,10 @@ class NeuralSDF(torch.nn.Module):
             if self.cfg_sdf.gradient.taps == 6:
                 eps = self.normal_eps
                 # 1st-order gradient
-                eps_x = torch.tensor([eps, 0., 0.], dtype=x.dtype, device=x.device)  # [3]
-                eps_y = torch.tensor([0., eps, 0.], dtype=x.dtype, device=x.device)  # [3]
-                eps_z = torch.tensor([0., 0., eps], dtype=x.dtype, device=x.device)  # [3]
-                sdf_x_pos = self.sdf(x + eps_x)  # [...,1]
-                sdf_x_neg = self.sdf(x - eps_x)  # [...,1]
-                sdf_y_pos = self.sdf(x + eps_y)  # [...,1]
-                sdf_y_neg = self.sdf(x - eps_y)  # [...,1]
-                sdf_z_pos = self.sdf(x + eps_z)  # [...,1]
-                sdf_z_neg = self.sdf(x - eps_z)  # [...,1]
+                taps = torch.tensor([[1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0], [0, 0, 1], [0, 0, -1]],
+                                    dtype=x.dtype, device=x.device)  # [6,3]
+                sdf_taps = get_sdf_taps(self.sdf, x, taps, eps)  # 6x[...,1]
+                sdf_x_pos, sdf_x_neg, sdf_y_pos, sdf_y_neg, sdf_z_pos, sdf_z_neg = sdf_taps
                 gradient_x = (sdf_x_pos - sdf_x_neg) / (2 * eps)
                 gradient_y = (sdf_y_pos - sdf_y_neg) / (2 * eps)
                 gradient_z = (sdf_z_pos - sdf_z_neg) / (2 * eps)
@@ -487,10 +564,7 @@ class NeuralSDF(torch.nn.Module):
                 k2 = torch.tensor([-1, -1, 1], dtype=x.dtype, device=x.device)  # [3]
                 k3 = torch.tensor([-1, 1, -1], dtype=x.dtype, device=x.device)  # [3]
                 k4 = torch.tensor([1, 1, 1], dtype=x.dtype, device=x.device)  # [3]
-                sdf1 = self.sdf(x + k1 * eps)  # [...,1]
-                sdf2 = self.sdf(x + k2 * eps)  # [...,1]
-                sdf3 = self.sdf(x + k3 * eps)  # [...,1]
-                sdf4 = self.sdf(x + k4 * eps)  # [...,1]
+                sdf1, sdf2, sdf3, sdf4 = get_sdf_taps(self.sdf, x, torch.stack([k1, k2, k3, k4]), eps)  # 4x[...,1]
                 gradient = (k1*sdf1 + k2*sdf2 + k3*sdf3 + k4*sdf4) / (4.0 * eps)
                 if training:
                     assert sdf is not None  # computed when feed-forwarding through the network
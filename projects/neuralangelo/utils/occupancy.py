@@ -0,0 +1,106 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import numpy as np
+import torch
+
+
+class OccupancyGrid(torch.nn.Module):
+
+    def __init__(self, cfg_occupancy, radius=1.):
+        """Binary occupancy grid over the bounding cube of the (unit) object sphere for empty space skipping.
+        Similar to Instant-NGP, the grid is periodically refreshed from the SDF network. A cell is marked as occupied
+        if the SDF at its center is small enough for the surface to pass through the cell.
+        The grid is not saved in the checkpoints; it is rebuilt with update() after loading.
+        Args:
+            cfg_occupancy (obj): Occupancy grid config (resolution, num_steps, margin, band).
+            radius (float): Radius of the object sphere.
+        """
+        super().__init__()
+        self.cfg_occupancy = cfg_occupancy
+        self.resolution = cfg_occupancy.resolution
+        self.radius = radius
+        self.cell_size = 2 * radius / self.resolution
+        self.initialized = False
+        res = self.resolution
+        self.register_buffer("occupied", torch.ones(res, res, res, dtype=torch.bool), persistent=False)  # [X,Y,Z]
+
+    def get_cell_centers(self):
+        device = self.occupied.device
+        grid_1D = (torch.arange(self.resolution, dtype=torch.float32, device=device) + 0.5) * self.cell_size
+        grid_1D = grid_1D - self.radius  # [X]
+        centers = torch.stack(torch.meshgrid(grid_1D, grid_1D, grid_1D, indexing="ij"), dim=-1)  # [X,Y,Z,3]
+        return centers
+
+    @torch.no_grad()
+    def update(self, sdf_func, band=0., chunk=2 ** 18):
+        """Refresh the occupancy from the SDF values at the cell centers.
+        Args:
+            sdf_func (callable): The SDF function.
+            band (float): Additional distance to the surface to be kept occupied (e.g. the width of the NeuS density).
+            chunk (int): Number of cells to evaluate at once.
+        """
+        centers = self.get_cell_centers().view(-1, 3)  # [XYZ,3]
+        half_diagonal = np.sqrt(3) / 2 * self.cell_size
+        threshold = half_diagonal * self.cfg_occupancy.margin + band
+        occupied = []
+        for c in range(0, len(centers), chunk):
+            sdfs = sdf_func(centers[c:c + chunk])[..., 0]  # [chunk]
+            occupied.append(sdfs.abs() <= threshold)
+        occupied = torch.cat(occupied, dim=0)  # [XYZ]
+        # Cells entirely outside the object sphere are never sampled.
+        occupied &= centers.norm(dim=-1) <= self.radius + half_diagonal
+        self.occupied.copy_(occupied.view_as(self.occupied))
+        self.initialized = True
+
+    def query(self, points_3D):
+        """Look up the occupancy of the cells containing the points.
+        Args:
+            points_3D (tensor [...,3]): 3D points.
+        Returns:
+            occupied (tensor [...]): Whether the points are in occupied cells (False outside the grid).
+        """
+        idx = ((points_3D + self.radius) / self.cell_size).floor().long()  # [...,3]
+        inside = ((idx >= 0) & (idx < self.resolution)).all(dim=-1)  # [...]
+        idx = idx.clamp(min=0, max=self.resolution - 1)
+        occupied = self.occupied[idx[..., 0], idx[..., 1], idx[..., 2]] & inside  # [...]
+        return occupied
+
+    @torch.no_grad()
+    def get_ray_bounds(self, center, ray_unit, near, far):
+        """Shrink the [near,far] range of each ray to the span of the occupied cells it passes through.
+        Args:
+            center (tensor [B,R,3]): Ray origins.
+            ray_unit (tensor [B,R,3]): Unit ray directions.
+            near (tensor [B,R,1]): Near bounds of the rays.
+            far (tensor [B,R,1]): Far bounds of the rays.
+        Returns:
+            near (tensor [B,R,1]): Near bounds of the occupied segments.
+            far (tensor [B,R,1]): Far bounds of the occupied segments.
+            empty (tensor [B,R,1]): Whether the rays do not pass through any occupied cell.
+        """
+        num_steps = self.cfg_occupancy.num_steps
+        steps = torch.linspace(0, 1, num_steps, device=near.device)  # [S]
+        step_size = (far - near) / (num_steps - 1)  # [B,R,1]
+        dists = near + (far - near) * steps  # [B,R,S]
+        points = center[..., None, :] + ray_unit[..., None, :] * dists[..., None]  # [B,R,S,3]
+        occupied = self.query(points)  # [B,R,S]
+        empty = ~occupied.any(dim=-1, keepdim=True)  # [B,R,1]
+        # Index of the first and last occupied steps, dilated by one step to cover the cell boundaries.
+        first = occupied.int().argmax(dim=-1, keepdim=True)  # [B,R,1]
+        last = num_steps - 1 - occupied.flip(dims=[-1]).int().argmax(dim=-1, keepdim=True)  # [B,R,1]
+        near_occupied = near + (first - 1).clamp(min=0) * step_size  # [B,R,1]
+        far_occupied = near + (last + 1).clamp(max=num_steps - 1) * step_size  # [B,R,1]
+        # Keep the original bounds for empty rays (their samples are masked out).
+        near = torch.where(empty, near, near_occupied)
+        far = torch.where(empty, far, far_occupied)
+        return near, far, empty
@@ -0,0 +1,92 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import torch
+
+
+class ErrorMapSampler:
+
+    def __init__(self, cfg_sampler, num_images, image_size):
+        """Importance sampler of the training pixels, driven by a low-resolution running error map of each image.
+        Pixels are drawn proportionally to the (L1) error of their cell, mixed with a uniform floor so that every pixel
+        keeps a nonzero probability. The per-ray weights 1/(HW*p) keep the reweighted losses unbiased.
+        The error map is kept in shared memory, so the updates from the trainer reach the data loader workers.
+        Args:
+            cfg_sampler (obj): Importance sampling config (resolution, uniform_ratio, decay).
+            num_images (int): Number of training images.
+            image_size (int [2]): Image size [H,W].
+        """
+        self.H, self.W = image_size
+        self.res_H, self.res_W = min(cfg_sampler.resolution[0], self.H), min(cfg_sampler.resolution[1], self.W)
+        self.uniform_ratio = cfg_sampler.uniform_ratio
+        self.decay = cfg_sampler.decay
+        # Cell (i,j) contains the pixels (y,x) with y*res_H//H == i and x*res_W//W == j.
+        self.y_bounds = (torch.arange(self.res_H + 1) * self.H + self.res_H - 1) // self.res_H  # [h+1]
+        self.x_bounds = (torch.arange(self.res_W + 1) * self.W + self.res_W - 1) // self.res_W  # [w+1]
+        self.cell_sizes = (self.y_bounds.diff()[:, None] * self.x_bounds.diff()[None, :]).flatten()  # [hw]
+        # Start from a constant error (i.e. uniform sampling).
+        self.error_map = torch.ones(num_images, self.res_H * self.res_W).share_memory_()  # [N,hw]
+
+    def get_cell_probs(self, idx):
+        """Probabilities of sampling a pixel from each cell of an image.
+        Args:
+            idx (int): Index of the image.
+        Returns:
+            probs (tensor [hw]): The cell probabilities.
+        """
+        error = self.error_map[idx] * self.cell_sizes  # [hw]
+        probs_error = error / error.sum().clamp(min=1e-8)
+        probs_uniform = self.cell_sizes / (self.H * self.W)
+        probs = (1 - self.uniform_ratio) * probs_error + self.uniform_ratio * probs_uniform  # [hw]
+        return probs
+
+    def sample(self, idx, num_rays, generator=None):
+        """Sample the ray (pixel) indices of an image (with replacement) according to the error map.
+        Args:
+            idx (int): Index of the image.
+            num_rays (int): Number of rays to sample.
+            generator (torch.Generator): Random number generator.
+        Returns:
+            ray_idx (tensor [R]): Indices of the sampled pixels (in the flattened [HW] image).
+            ray_weight (tensor [R]): Importance weights of the sampled rays (1 in expectation).
+        """
+        probs = self.get_cell_probs(idx)  # [hw]
+        cells = torch.multinomial(probs, num_rays, replacement=True, generator=generator)  # [R]
+        # Sample a pixel uniformly within each cell.
+        cell_y, cell_x = cells // self.res_W, cells % self.res_W  # [R]
+        y_min, x_min = self.y_bounds[cell_y], self.x_bounds[cell_x]  # [R]
+        y_size, x_size = self.y_bounds[cell_y + 1] - y_min, self.x_bounds[cell_x + 1] - x_min  # [R]
+        rands = torch.rand(2, num_rays, generator=generator)  # [2,R]
+        y = y_min + (rands[0] * y_size).long()  # [R]
+        x = x_min + (rands[1] * x_size).long()  # [R]
+        ray_idx = y * self.W + x  # [R]
+        # The probability of a pixel is the probability of its cell divided by the cell size.
+        ray_weight = self.cell_sizes[cells] / (self.H * self.W * probs[cells])  # [R]
+        return ray_idx, ray_weight
+
+    @torch.no_grad()
+    def update(self, idx, ray_idx, residual):
+        """Update the running error map with the residuals of the sampled rays.
+        Args:
+            idx (tensor [B]): Indices of the images.
+            ray_idx (tensor [B,R]): Indices of the sampled pixels.
+            residual (tensor [B,R]): Per-ray (unweighted) L1 residuals.
+        """
+        idx, ray_idx, residual = idx.cpu(), ray_idx.cpu(), residual.float().cpu()
+        y, x = ray_idx // self.W, ray_idx % self.W  # [B,R]
+        cells = (y * self.res_H // self.H) * self.res_W + x * self.res_W // self.W  # [B,R]
+        cells = (idx[:, None] * self.res_H * self.res_W + cells).flatten()  # [BR]
+        error_map = self.error_map.view(-1)  # [Nhw]
+        error_sum = torch.zeros_like(error_map).index_add_(0, cells, residual.flatten())
+        count = torch.zeros_like(error_map).index_add_(0, cells, torch.ones_like(residual.flatten()))
+        visited = count > 0
+        error_map[visited] = self.decay * error_map[visited] + (1 - self.decay) * error_sum[visited] / count[visited]
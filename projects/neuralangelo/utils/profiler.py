@@ -0,0 +1,201 @@
+'''
+-----------------------------------------------------------------------------
+Copyright (c) 2023, NVIDIA CORPORATION. All rights reserved.
+
+NVIDIA CORPORATION and its licensors retain all intellectual property
+and proprietary rights in and to this software, related documentation
+and any modifications thereto. Any use, reproduction, disclosure or
+distribution of this software and related documentation without an express
+license agreement from NVIDIA CORPORATION is strictly prohibited.
+-----------------------------------------------------------------------------
+'''
+
+import contextlib
+import json
+import time
+import weakref
+from collections import defaultdict
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_leaves
+
+_active_profiler = None  # The profiler recording the regions (None when profiling is disabled).
+_null_region = contextlib.nullcontext()
+
+
+def region(name, samples=None):
+    """Named (nestable) timing region of the rendering pipeline. This is a no-op unless a StageProfiler is active.
+    Args:
+        name (str): Name of the region (nested regions are reported as "parent/child").
+        samples (int or tensor [...,C]): Number of samples (e.g. rays or points) processed in the region. For a tensor,
+                                         all the dimensions but the last one are counted.
+    Returns:
+        context (obj): The context manager of the region.
+    """
+    if _active_profiler is None:
+        return _null_region
+    return _active_profiler.region(name, samples=samples)
+
+
+class StorageTracker(TorchDispatchMode):
+    """Track the bytes of the (CPU) tensor storages allocated by the operators run under this mode. The storages
+    allocated before entering the mode (e.g. the inputs and the model parameters) are not counted.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.live = dict()
+        self.current = 0
+        self.peak = 0
+
+    def _free(self, key):
+        self.current -= self.live.pop(key)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        outputs = func(*args, **(kwargs or {}))
+        for output in tree_leaves(outputs):
+            if not isinstance(output, torch.Tensor) or output.device.type != "cpu":
+                continue
+            storage = output.untyped_storage()
+            key = storage.data_ptr()
+            if key in self.live or storage.nbytes() == 0:
+                continue
+            self.live[key] = storage.nbytes()
+            self.current += storage.nbytes()
+            self.peak = max(self.peak, self.current)
+            weakref.finalize(storage, self._free, key)
+        return outputs
+
+
+class StageProfiler(object):
+
+    def __init__(self, synchronize=True, track_memory=None):
+        """Record the wall time, the number of samples and the peak memory of the regions entered with region() while
+        the profiler is active (used as a context manager). The records can be aggregated into a JSON report or
+        exported as a Chrome trace (chrome://tracing or https://ui.perfetto.dev). The peak memory of a region is
+        counted on top of the memory allocated when entering it. Without CUDA, it is measured by tracking the CPU
+        tensor storages (see StorageTracker), which slows the profiled code down a lot, so the timings and the memory
+        should be recorded in separate runs.
+        Args:
+            synchronize (bool): Synchronize CUDA at the region boundaries to attribute the GPU time correctly.
+            track_memory (bool): Record the peak memory of the regions (default: only with CUDA).
+        """
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.track_memory = torch.cuda.is_available() if track_memory is None else track_memory
+        self.storage_tracker = None
+        if self.track_memory and not torch.cuda.is_available():
+            self.storage_tracker = StorageTracker()
+        self.events = []
+        self._stack = []
+        self._previous = None
+        self._origin = time.perf_counter()
+
+    def __enter__(self):
+        global _active_profiler
+        self._previous, _active_profiler = _active_profiler, self
+        if self.storage_tracker is not None:
+            self.storage_tracker.__enter__()
+        return self
+
+    def __exit__(self, *args):
+        global _active_profiler
+        if self.storage_tracker is not None:
+            self.storage_tracker.__exit__(*args)
+        _active_profiler = self._previous
+
+    def _sync(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+
+    def _memory(self):
+        if self.storage_tracker is not None:
+            return self.storage_tracker.current
+        return torch.cuda.memory_allocated()
+
+    def _max_memory(self):
+        if self.storage_tracker is not None:
+            return self.storage_tracker.peak
+        return torch.cuda.max_memory_allocated()
+
+    def _reset_peak_memory(self):
+        if self.storage_tracker is not None:
+            self.storage_tracker.peak = self.storage_tracker.current
+        else:
+            torch.cuda.reset_peak_memory_stats()
+
+    @contextlib.contextmanager
+    def region(self, name, samples=None):
+        if isinstance(samples, torch.Tensor):
+            samples = samples.shape[:-1].numel()
+        path = "/".join([frame["name"] for frame in self._stack] + [name])
+        frame = dict(name=name, path=path, peak_memory=0, base_memory=0)
+        if self.track_memory:
+            # Keep the peak of the enclosing region before resetting the peak statistics for this one.
+            if self._stack:
+                self._stack[-1]["peak_memory"] = max(self._stack[-1]["peak_memory"], self._max_memory())
+            self._reset_peak_memory()
+            frame["base_memory"] = self._memory()
+        self._stack.append(frame)
+        self._sync()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._sync()
+            end = time.perf_counter()
+            self._stack.pop()
+            peak_memory = None
+            if self.track_memory:
+                # The peaks are propagated to the enclosing regions as totals, and reported on top of the memory
+                # allocated when entering the region.
+                peak_total = max(frame["peak_memory"], self._max_memory())
+                if self._stack:
+                    self._stack[-1]["peak_memory"] = max(self._stack[-1]["peak_memory"], peak_total)
+                peak_memory = peak_total - frame["base_memory"]
+            self.events.append(dict(name=name, path=path, start=start - self._origin, duration=end - start,
+                                    samples=samples, peak_memory=peak_memory, depth=len(self._stack)))
+
+    def report(self):
+        """Aggregate the recorded regions by path.
+        Returns:
+            report (dict): For each region path: the number of calls, the total/mean wall time (ms), the total number
+                           of samples, the throughput (samples/s) and the peak memory (MB, None if not tracked).
+        """
+        groups = defaultdict(list)
+        for event in self.events:
+            groups[event["path"]].append(event)
+        report = dict()
+        for path, events in sorted(groups.items()):
+            total_time = sum(event["duration"] for event in events)
+            samples = [event["samples"] for event in events if event["samples"] is not None]
+            peak_memory = [event["peak_memory"] for event in events if event["peak_memory"] is not None]
+            report[path] = dict(
+                calls=len(events),
+                total_ms=total_time * 1e3,
+                mean_ms=total_time / len(events) * 1e3,
+                samples=sum(samples) if samples else None,
+                samples_per_sec=sum(samples) / total_time if samples and total_time > 0 else None,
+                peak_memory_mb=max(peak_memory) / 2 ** 20 if peak_memory else None,
+            )
+        return report
+
+    def save_report(self, fname):
+        with open(fname, "w") as file:
+            json.dump(self.report(), file, indent=4)
+
+    def save_chrome_trace(self, fname):
+        trace_events = []
+        for event in self.events:
+            trace_events.append(dict(
+                name=event["name"],
+                cat=event["path"],
+                ph="X",  # Complete event.
+                ts=event["start"] * 1e6,
+                dur=event["duration"] * 1e6,
+                pid=0,
+                tid=0,
+                args=dict(samples=event["samples"], peak_memory=event["peak_memory"]),
+            ))
+        with open(fname, "w") as file:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit="ms"), file)